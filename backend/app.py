@@ -1,25 +1,187 @@
+import base64
+import binascii
 import datetime
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 from flask_swagger_ui import get_swaggerui_blueprint
 from functools import wraps
+import hashlib
+import hmac
 import json
 import jwt
 import os
 import random
-from storage import read_data, sync_data
+import re
+import time
+from auth import PasswordPool, PoolBusy, TokenCache
+from changes import ChangeFeed
+from metrics import Metrics, SamplingProfiler, collect_spans, span, start_spans
+from records import RecordList
+from repository import CharacterRepository, UserRepository
+from responses import BodyCache, FastJSONProvider, compress_response, negotiate_encoding
+from storage import (JournaledJsonCharacterStorage, JournaledJsonUserStorage, JsonCharacterStorage,
+                     SqliteCharacterStorage, SqliteUserStorage, StorageError)
 
 # Loads and sets the environment variables
 load_dotenv()
 SECRET_KEY = os.getenv('SECRET_KEY')
+# 'json' (default) keeps the data in characters.json/users.json, 'json-journal' appends
+# character changes to characters.json.journal instead, 'sqlite' uses DATABASE_PATH.
+# With both JSON backends new users are appended to users.json.journal
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'thrones.db')
+# Binary snapshot of characters.json written on every save and memory-mapped by the workers
+# instead of parsing the JSON file (see snapshot.py); empty disables it. Not used with sqlite
+CHARACTERS_SNAPSHOT = os.getenv('CHARACTERS_SNAPSHOT', '')
+# Seconds between checks of the journal size by the background compactor
+COMPACT_INTERVAL = int(os.getenv('COMPACT_INTERVAL', 60))
+# Number of verified tokens kept in memory (0 disables the cache) and for how many seconds
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+# PBKDF2 iterations for stored passwords, hashing threads and the maximum number of
+# hashing jobs waiting or running before logins/registrations are turned away
+PASSWORD_HASH_ITERATIONS = int(os.getenv('PASSWORD_HASH_ITERATIONS', 260000))
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', os.cpu_count() or 1))
+PASSWORD_QUEUE_SIZE = int(os.getenv('PASSWORD_QUEUE_SIZE', 64))
+# JSON responses smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+# Bearer token a scraper must send to read /metrics (if unset, /metrics is open)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# Fraction of requests profiled and saved to PROFILE_DIR (0 disables the sampling; admins can
+# always profile a request with ?profile=1), and milliseconds between two stack samples
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 5))
+# File shared by the workers with the latest character changes served by /api/characters/changes,
+# and how many changes it keeps (clients further behind must read all the characters again)
+CHANGE_FEED_PATH = os.getenv('CHANGE_FEED_PATH', 'characters.changes')
+CHANGE_FEED_SIZE = int(os.getenv('CHANGE_FEED_SIZE', 1024))
+# Longest a long-poll request waits for a change, and seconds after which an event stream is
+# closed (EventSource clients reconnect on their own with the Last-Event-ID header)
+CHANGE_FEED_MAX_WAIT = int(os.getenv('CHANGE_FEED_MAX_WAIT', 30))
+CHANGE_FEED_STREAM_SECONDS = int(os.getenv('CHANGE_FEED_STREAM_SECONDS', 300))
 
 app = Flask(__name__)
+# Serializes with orjson when it is installed (see responses.py)
+app.json = FastJSONProvider(app)
 # This will enable CORS for all routes
 CORS(app, resources={r"/*": {"origins": "*"}}, allow_headers=['Authorization', 'Content-Type'])
 
+# Number of characters serialized per chunk of a streamed response
+STREAM_CHUNK_SIZE = 100
+
+# Maximum number of changes per /api/characters/changes response, and seconds between two
+# keep-alive comments of an idle event stream
+CHANGE_FEED_BATCH_SIZE = 500
+CHANGE_FEED_HEARTBEAT = 15
+
+# Cache-Control of the cacheable character reads: clients and proxies may store
+# them, but must revalidate (cheaply, with the ETag) before reusing them
+CHARACTER_CACHE_CONTROL = 'public, no-cache'
+
 VALID_ATTRIBUTES = ['age', 'animal', 'death', 'house', 'name', 'nickname', 'role', 'strength', 'symbol']
 
+# Types of the character fields accepted when adding or updating characters
+CHARACTER_FIELDS = {
+    'name': str,
+    'age': int,
+    'animal': str,
+    'death': str,
+    'house': str,
+    'nickname': str,
+    'role': str,
+    'strength': str,
+    'symbol': str
+}
+
+# Maximum number of operations in one request to /api/characters/bulk
+BULK_MAX_OPERATIONS = int(os.getenv('BULK_MAX_OPERATIONS', 10000))
+
+# Attributes searched by /api/characters/search and their weight in the ranking
+SEARCH_FIELDS = {'name': 3, 'nickname': 2, 'house': 1.5, 'role': 1, 'symbol': 1}
+
+# Low-cardinality attributes the repository stores dictionary-encoded: each distinct value
+# is kept once and each character only stores a small code (see records.py)
+DICTIONARY_FIELDS = ['age', 'animal', 'death', 'house', 'role', 'strength', 'symbol']
+
+if STORAGE_BACKEND == 'sqlite':
+    characters_storage = SqliteCharacterStorage(DATABASE_PATH)
+    users_storage = SqliteUserStorage(DATABASE_PATH)
+elif STORAGE_BACKEND == 'json-journal':
+    characters_storage = JournaledJsonCharacterStorage('characters.json', snapshot_path=CHARACTERS_SNAPSHOT)
+    characters_storage.start_compactor(COMPACT_INTERVAL)
+    users_storage = JournaledJsonUserStorage('users.json')
+else:
+    characters_storage = JsonCharacterStorage('characters.json', CHARACTERS_SNAPSHOT)
+    users_storage = JournaledJsonUserStorage('users.json')
+
+# Numbered history of the character changes, shared by all the workers
+change_feed = ChangeFeed(CHANGE_FEED_PATH, CHANGE_FEED_SIZE)
+
+# Keeps the parsed characters and users in memory between requests
+characters_repository = CharacterRepository(characters_storage, indexed_fields=VALID_ATTRIBUTES,
+                                            search_fields=SEARCH_FIELDS, dictionary_fields=DICTIONARY_FIELDS,
+                                            change_feed=change_feed)
+users_repository = UserRepository(users_storage)
+
+# Payloads of already verified tokens, used by token_required
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+# Runs the password hashing off the request threads, with a bounded queue
+password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE, PASSWORD_HASH_ITERATIONS)
+
+# Serialized (and compressed) bodies of /api/all_characters for the current dataset version
+body_cache = BodyCache()
+
+# Request counters and latency histograms served by /metrics
+metrics = Metrics()
+metrics.describe('thrones_requests_total', 'counter', 'Requests by method, route and status code.')
+metrics.describe('thrones_request_duration_seconds', 'histogram', 'Request latency by method and route.')
+metrics.describe('thrones_span_duration_seconds', 'histogram',
+                 'Time spent per request in each kind of span (storage_read, filter, auth, ...) by route.')
+
+
+@app.errorhandler(StorageError)
+def storage_error(error):
+    """Response returned when a change could not be stored, which the
+    repositories have already dropped from memory."""
+    print(f"Error: {error}")
+    return jsonify({"error": "The change could not be saved, please try again later."}), 500
+
+
+def password_pool_busy():
+    """Response returned when the password pool refuses new work."""
+    response = jsonify({"message": "Too many logins in progress, please try again shortly."})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+def decode_token():
+    """Verifies the JWT of the request's 'Authorization' header, using
+    token_cache for tokens that were already verified. Returns a tuple of
+    (payload, None), or (None, 401 response) if the token is missing, expired
+    or invalid."""
+    # Extracts the JWT from the Authorization header of the incoming request
+    token = request.headers.get('Authorization')
+
+    if not token or not token.startswith('Bearer '):
+        return None, (jsonify({'message': 'Token is missing or invalid format'}), 401)
+
+    token = token.split(' ')[1]  # Extract the token part only
+
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            # Decode the JWT token
+            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            return None, (jsonify({'message': 'Token has expired'}), 401)
+        except jwt.InvalidTokenError:
+            return None, (jsonify({'message': 'Invalid token'}), 401)
+        token_cache.put(token, payload)
+    return payload, None
+
 
 def token_required(f):
     """ Middleware (decorator) to protect routes by requiring a valid JWT token.
@@ -29,30 +191,19 @@ def token_required(f):
     with a 401 Unauthorized response. If the token is valid, the decoded payload
     (containing user information such as 'username' and 'role') is passed to the
     route handler as a parameter, but no role-based access control is enforced in
-    this function. It takes f (which is the protected route function) as an argument."""
+    this function. It takes f (which is the protected route function) as an argument.
+    Verified payloads are kept in token_cache until the token expires, so repeated
+    requests with the same token skip the signature verification."""
     @wraps(f)
     def decorated(*args, **kwargs):
         """The decorated function is the inner function that will actually wrap around
         the protected route. It receives the same arguments (*args, **kwargs) that the
         protected route would have received."""
 
-        # Extracts the JWT from the Authorization header of the incoming request
-        token = request.headers.get('Authorization')
-        # print(f"Token received: {token}")
-
-        if not token or not token.startswith('Bearer '):
-            return jsonify({'message': 'Token is missing or invalid format'}), 401
-
-        if token.startswith('Bearer '):
-            token = token.split(' ')[1]  # Extract the token part only
-
-        try:
-            # Decode the JWT token
-            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        except jwt.ExpiredSignatureError:
-            return jsonify({'message': 'Token has expired'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'message': 'Invalid token'}), 401
+        with span('auth'):
+            payload, error = decode_token()
+        if error is not None:
+            return error
 
         # Pass the payload to the route function
         return f(payload, *args, **kwargs)
@@ -60,13 +211,272 @@ def token_required(f):
     return decorated
 
 
+def encode_cursor(sort_field, descending, value, character_id):
+    """Encodes the sort key and id of the last character of a page into an
+    opaque cursor string for keyset pagination."""
+    cursor = json.dumps({'sort': sort_field, 'desc': descending, 'value': value, 'id': character_id})
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_field, descending):
+    """Decodes a cursor created by encode_cursor(). Returns the (value, id)
+    pair it points at, or None if the cursor is malformed or was created for
+    a different sort order."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if (not isinstance(data, dict) or data.get('sort') != sort_field
+            or data.get('desc') is not descending):
+        return None
+    value, character_id = data.get('value'), data.get('id')
+    if type(character_id) is not int or not (value is None or type(value) in (int, str)):
+        return None
+    return value, character_id
+
+
+def parse_filters(other_params):
+    """Reads the attribute filters of a request ('house=stark', 'age_more_than=30',
+    ...) into the filter tuples understood by the repository. Query parameters
+    other than the filters must be listed in other_params. Returns a tuple of
+    (filters, None), or (None, error response) for an invalid parameter."""
+    filter_params = {
+        'age': request.args.get('age'),
+        'animal': request.args.get('animal'),
+        'death': request.args.get('death'),
+        'house': request.args.get('house'),
+        'name': request.args.get('name'),
+        'nickname': request.args.get('nickname'),
+        'role': request.args.get('role'),
+        'strength': request.args.get('strength'),
+        'symbol': request.args.get('symbol'),
+        'age_more_than': request.args.get('age_more_than'),
+        'age_less_than': request.args.get('age_less_than')
+    }
+
+    # Validates that all filter parameters are valid attributes
+    for key in request.args:
+        if (key not in VALID_ATTRIBUTES and
+                key not in ['age_more_than', 'age_less_than', 'profile'] + other_params):
+            return None, (jsonify({"error": f"Invalid filter attribute: '{key}' is not a valid "
+                                            f"character attribute."}), 400)
+
+    # Filters are collected first and answered by the repository's indexes
+    filters = []
+    for key, value in filter_params.items():
+        if value:
+            if key in ['age', 'age_more_than', 'age_less_than']:
+                try:
+                    value = int(value)
+                except ValueError:
+                    return None, (jsonify({"error": f"Invalid {key} parameter. Age must be an integer."}), 400)
+
+                if key == 'age_more_than':
+                    filters.append(('age', 'range', value, None))
+                elif key == 'age_less_than':
+                    filters.append(('age', 'range', None, value))
+                elif key == 'age':
+                    filters.append(('age', 'range', value, value))
+            else:
+                filters.append((key, 'contains', value))
+    return filters, None
+
+
+def validate_character(character, new):
+    """Checks the types of the fields of a character sent by a client. For a
+    new character the missing fields are set to None. Returns an error
+    message, or None if the character is valid."""
+    for field, field_type in CHARACTER_FIELDS.items():
+        if new and field not in character:
+            character[field] = None
+
+        if character.get(field) is not None and not isinstance(character[field], field_type):
+            if new:
+                return f"'{field}' must be of type {field_type.__name__} or null."
+            return f"'{field}' must be of type {field_type.__name__}."
+    return None
+
+
+def parse_fields():
+    """Reads the 'fields' query parameter, a comma separated list of the
+    character fields to return (e.g. 'id,name'). Returns a tuple of (sorted
+    list of fields or None for all of them, None), or (None, error response)
+    for an unknown field."""
+    if 'fields' not in request.args:
+        return None, None
+    fields = sorted({field for field in request.args.get('fields').split(',') if field})
+    for field in fields:
+        if field != 'id' and field not in VALID_ATTRIBUTES:
+            return None, (jsonify({"error": f"Invalid fields parameter: '{field}' is not a valid "
+                                            f"character attribute."}), 400)
+    if not fields:
+        return None, (jsonify({"error": "The 'fields' parameter must list at least one field."}), 400)
+    return fields, None
+
+
+def project(characters, fields):
+    """Returns the characters reduced to the given fields (all of them if
+    fields is None). Only the requested values are copied into the new
+    dictionaries; without fields a list of characters is returned as is. A
+    RecordList from the repository is materialized straight to the fields."""
+    if isinstance(characters, RecordList):
+        return characters.materialize(fields)
+    if fields is None:
+        return characters
+    return [{field: character.get(field) for field in fields} for character in characters]
+
+
+def usable_last_modified(last_modified):
+    """Returns the last modification time truncated to whole seconds, as sent
+    in Last-Modified, or None while that second is not over: a later write in
+    the same second would have the same Last-Modified, so it can only
+    validate a copy once no more writes can fall in its second."""
+    if time.time() < int(last_modified) + 1:
+        return None
+    return int(last_modified)
+
+
+def not_modified(etag, last_modified):
+    """Returns True if the request's conditional headers show that the client
+    already has the current representation. If-None-Match takes precedence
+    over If-Modified-Since and uses the weak comparison, as proxies weaken
+    the ETags of the bodies they compress. If-Modified-Since is compared
+    with second precision, so only once the second of the last write is
+    over (see usable_last_modified())."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag) or request.if_none_match.star_tag
+    seconds = usable_last_modified(last_modified)
+    if request.if_modified_since is not None and seconds is not None:
+        return seconds <= request.if_modified_since.timestamp()
+    return False
+
+
+def conditional_response(etag, last_modified, build_response):
+    """Returns an empty 304 response if the client's copy is current (see
+    not_modified()), so the body is not serialized at all, or else the response
+    returned by build_response(). Both carry the validators and the caching
+    headers of the representation. A compressed body has the content coding
+    appended to its ETag, here or by compress_response(), as compressed and
+    uncompressed bodies must not share it; both ETags are accepted back."""
+    encoding = negotiate_encoding(request.accept_encodings)
+    etags = [etag] if encoding is None else [etag, f"{etag}-{encoding}"]
+    matched = next((candidate for candidate in etags if not_modified(candidate, last_modified)), None)
+    if matched is not None:
+        response = Response(status=304)
+        response.set_etag(matched)
+    else:
+        response = build_response()
+        coding = response.headers.get('Content-Encoding')
+        response.set_etag(f"{etag}-{coding}" if coding else etag)
+    response.vary.add('Accept-Encoding')
+    seconds = usable_last_modified(last_modified)
+    if seconds is not None:
+        response.last_modified = datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+    response.headers['Cache-Control'] = CHARACTER_CACHE_CONTROL
+    response.vary.add('Accept')
+    response.vary.add('Authorization')
+    return response
+
+
+@app.before_request
+def start_request():
+    """Starts timing the request, and profiling it if an admin asked for it with
+    ?profile=1 or it was picked by PROFILE_SAMPLE_RATE."""
+    g.request_start = time.perf_counter()
+    start_spans()
+    g.profile_report = False
+    if request.args.get('profile') in ['1', 'true']:
+        payload, _ = decode_token()
+        g.profile_report = payload is not None and payload.get('role') == 'admin'
+    g.profiler = None
+    if g.profile_report or random.random() < PROFILE_SAMPLE_RATE:
+        g.profiler = SamplingProfiler(PROFILE_INTERVAL / 1000)
+        g.profiler.start()
+
+
+@app.after_request
+def finish_request(response):
+    """Records the latency and the spans of the request in the metrics. This
+    hook is registered before compress() so that it runs after it and the
+    compression is timed too. A profiled request's profile is saved to
+    PROFILE_DIR and, for ?profile=1, returned instead of the response."""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    spans = collect_spans()
+    metrics.increment('thrones_requests_total',
+                      (('method', request.method), ('route', route), ('status', response.status_code)))
+    metrics.observe('thrones_request_duration_seconds', (('method', request.method), ('route', route)), elapsed)
+    for name, seconds in spans.items():
+        metrics.observe('thrones_span_duration_seconds', (('route', route), ('span', name)), seconds)
+
+    if g.get('profiler') is None:
+        return response
+    g.profiler.stop()
+    report = profile_report(response.status_code, elapsed, spans, g.profiler)
+    save_profile(route, report)
+    if g.profile_report:
+        return Response(report, mimetype='text/plain')
+    return response
+
+
+def profile_report(status, elapsed, spans, profiler):
+    """Returns the profile of the current request: a header with its latency
+    and spans as '#' comments, then the sampled stacks in the folded format
+    (flamegraph.pl and speedscope ignore the comments)."""
+    samples = sum(profiler.stacks.values())
+    lines = [f"# {request.method} {request.full_path.rstrip('?')} -> {status} in {elapsed * 1000:.2f} ms",
+             f"# {samples} samples every {PROFILE_INTERVAL:g} ms",
+             '# spans: ' + ', '.join(f"{name} {seconds * 1000:.2f} ms" for name, seconds in
+                                     sorted(spans.items(), key=lambda item: -item[1]))]
+    return '\n'.join(lines) + '\n' + profiler.collapsed()
+
+
+def save_profile(route, report):
+    """Writes a profile to PROFILE_DIR, named after the time and the route."""
+    name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{timestamp}-{request.method}-{name}.folded"), 'w') as fileobj:
+            fileobj.write(report)
+    except OSError as error:
+        print(f"Could not save the profile: {error}")
+
+
+@app.after_request
+def compress(response):
+    """Compresses large JSON responses for clients that accept gzip or brotli."""
+    return compress_response(response, negotiate_encoding(request.accept_encodings), COMPRESS_MIN_SIZE)
+
+
+def stream_characters(characters, ndjson, fields=None):
+    """Returns a streamed response for a list of characters. The records are
+    serialized in small chunks from a generator, so the first bytes are sent
+    right away and the whole body is never held in memory. With ndjson the body
+    has one JSON object per line, otherwise it is a regular JSON array. The
+    records are projected to fields (see project()) chunk by chunk."""
+    def generate():
+        if not ndjson:
+            yield '['
+        separator = '\n' if ndjson else ','
+        for start in range(0, len(characters), STREAM_CHUNK_SIZE):
+            chunk = separator.join(app.json.dumps(character) for character in
+                                   project(characters[start:start + STREAM_CHUNK_SIZE], fields))
+            if ndjson:
+                yield chunk + '\n'
+            else:
+                yield chunk if start == 0 else ',' + chunk
+        if not ndjson:
+            yield ']'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
 @app.route('/api/register', methods=['POST'])
 def register_user():
     """API to register a new user."""
 
-    # Modified to be a local variable intead of a global variable
-    users = read_data('users.json')
-
     new_user = request.get_json()
 
     username = new_user.get('username')
@@ -75,19 +485,23 @@ def register_user():
     if not username or not password:
         return jsonify({"message": "Username and password are required."}), 400
 
-    if username in users:
+    if not isinstance(password, str):
+        return jsonify({"message": "Password must be a string."}), 400
+
+    # Saves hashing a password for a username that is already taken
+    if users_repository.get(username) is not None:
         return jsonify({"message": "Username already exists."}), 400
 
+    # Only the salted hash of the password is stored
+    try:
+        password_hash = password_pool.hash(password)
+    except PoolBusy:
+        return password_pool_busy()
+
     # Creates a new user entry with a default role
-    # users[username] = {"password": password, "role": "user"}
-    users.update({
-        username: {
-            "password": password,
-            "role": "user"
-        }
-    })
+    if not users_repository.add(username, {"password": password_hash, "role": "user"}):
+        return jsonify({"message": "Username already exists."}), 400
 
-    sync_data('users.json', users)
     return jsonify({"message": "User registered successfully."}), 200
 
 
@@ -95,19 +509,27 @@ def register_user():
 def login():
     """Login endpoint to authenticate users and return a JWT."""
 
-    # Modified to be a local variable instead of a global variable
-    users = read_data('users.json')
-
     auth_data = request.get_json()
 
     username = auth_data.get('username')
     password = auth_data.get('password')
 
-    if username in users and users[username]['password'] == password:
+    user = users_repository.get(username)
+    try:
+        # Unknown users are verified against a dummy hash, so they are not answered faster
+        valid, needs_rehash = (password_pool.verify(password, user['password'] if user is not None else None)
+                               if isinstance(password, str) else (False, False))
+    except PoolBusy:
+        return password_pool_busy()
+
+    if valid:
+        if needs_rehash:
+            rehash_password(username, password, user['password'])
+
         # JWT payload creation
         payload = {
             'username': username,
-            'role': users[username]['role'],
+            'role': user['role'],
             'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)  # Token expires in 1 hour
         }
 
@@ -118,6 +540,41 @@ def login():
         return jsonify({'message': 'Invalid username or password'}), 401
 
 
+def rehash_password(username, password, old_password):
+    """Replaces a user's plaintext (or outdated) stored password with a fresh hash
+    after a successful login. If the pool is busy or the new hash cannot be stored
+    the migration is simply retried at the next login."""
+    try:
+        password_hash = password_pool.hash(password)
+    except PoolBusy:
+        return
+
+    try:
+        users_repository.replace_password(username, old_password, password_hash)
+    except StorageError as e:
+        print(f"Error: {e}")
+
+
+@app.route('/api/password_pool', methods=['GET'])
+@token_required
+def get_password_pool_stats(payload):
+    """Returns the queue depth and counters of the password hashing pool (admins only)."""
+    if payload.get('role') != 'admin':
+        return jsonify({"error": "Only admins can view the password pool statistics."}), 403
+
+    return jsonify(password_pool.stats()), 200
+
+
+@app.route('/api/token_cache', methods=['GET'])
+@token_required
+def get_token_cache_stats(payload):
+    """Returns the hit/miss counters of the verified-token cache (admins only)."""
+    if payload.get('role') != 'admin':
+        return jsonify({"error": "Only admins can view the token cache statistics."}), 403
+
+    return jsonify(token_cache.stats()), 200
+
+
 @app.route('/api/characters', methods=['GET'])
 @token_required
 def get_characters(payload):
@@ -126,53 +583,20 @@ def get_characters(payload):
     parameters are not provided, a random selection of 20 characters is returned by default.
     Filtering by attributes such as age, house, and role is supported, allowing multiple
     filters to be applied simultaneously. Additionally, characters can be sorted in
-    ascending or descending order by any specified attribute."""
+    ascending or descending order by any specified attribute. The 'fields'
+    parameter (e.g. 'id,name') limits the fields returned for each character."""
 
-    characters = read_data('characters.json')
+    characters = characters_repository.all()
 
     # Filtering
-    filter_params = {
-        'age': request.args.get('age'),
-        'animal': request.args.get('animal'),
-        'death': request.args.get('death'),
-        'house': request.args.get('house'),
-        'name': request.args.get('name'),
-        'nickname': request.args.get('nickname'),
-        'role': request.args.get('role'),
-        'strength': request.args.get('strength'),
-        'symbol': request.args.get('symbol'),
-        'age_more_than': request.args.get('age_more_than'),
-        'age_less_than': request.args.get('age_less_than')
-    }
-
-    # Validates that all filter parameters are valid attributes
-    for key in request.args:
-        if (key not in VALID_ATTRIBUTES and
-                key not in ['age_more_than', 'age_less_than', 'limit', 'skip', 'sort_asc', 'sort_desc']):
-            return jsonify({"error": f"Invalid filter attribute: '{key}' is not a valid character attribute."}), 400
-
-    filtered_characters = characters
-    for key, value in filter_params.items():
-        if value:
-            if key in ['age', 'age_more_than', 'age_less_than']:
-                try:
-                    value = int(value)
-                except ValueError:
-                    return jsonify({"error": f"Invalid {key} parameter. Age must be an integer."}), 400
+    filters, error = parse_filters(['limit', 'skip', 'sort_asc', 'sort_desc', 'cursor', 'fields'])
+    if error:
+        return error
 
-                if key == 'age_more_than':
-                    filtered_characters = [character for character in filtered_characters
-                                           if character['age'] is not None and character['age'] >= value]
-                elif key == 'age_less_than':
-                    filtered_characters = [character for character in filtered_characters
-                                           if character['age'] is not None and character['age'] <= value]
-                elif key == 'age':
-                    filtered_characters = [character for character in filtered_characters
-                                           if character['age'] is not None and character['age'] == value]
-            else:
-                filtered_characters = [character for character in filtered_characters
-                                       if character.get(key) is not None
-                                       and value.lower() in character[key].lower()]
+    # Projection to a subset of the fields
+    fields, error = parse_fields()
+    if error:
+        return error
 
     # Sort by any of the character's attributes
     sort_asc = request.args.get('sort_asc')
@@ -184,15 +608,11 @@ def get_characters(payload):
                                  "/ 'strength' / 'symbol'"}), 400
 
     if sort_asc in VALID_ATTRIBUTES:
-        sorted_characters = sorted(filtered_characters, key=lambda x: (x.get(sort_asc) is None, x.get(sort_asc)))
-        # return jsonify(sorted_characters), 200
-
+        sort_field, descending = sort_asc, False
     elif sort_desc in VALID_ATTRIBUTES:
-        sorted_characters = sorted(filtered_characters,
-                                   key=lambda x: (x.get(sort_desc) is None, x.get(sort_desc)), reverse=True)
-        # return jsonify(sorted_characters), 200
+        sort_field, descending = sort_desc, True
     else:
-        sorted_characters = filtered_characters
+        sort_field, descending = None, False
 
     # Pagination
     limit = 20
@@ -214,31 +634,225 @@ def get_characters(payload):
         except ValueError:
             return jsonify({"error": "Invalid skip parameter. Must be an integer."}), 400
 
-    if skip >= len(sorted_characters):
+    # Keyset pagination: the cursor points right after the last character of the previous
+    # page, so deep pages cost the same as the first one and are not shifted by writes
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        if 'skip' in request.args:
+            return jsonify({"error": "Use either the 'skip' or the 'cursor' parameter, not both."}), 400
+
+        cursor_field = sort_field or 'id'
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, cursor_field, descending)
+            if after is None:
+                return jsonify({"error": "Invalid cursor parameter."}), 400
+
+        total, page = characters_repository.query(filters, cursor_field, descending, 0, limit + 1, after)
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(cursor_field, descending, page[-1].get(cursor_field), page[-1]['id'])
+        return jsonify({'characters': project(page, fields), 'next_cursor': next_cursor, 'total': total}), 200
+
+    # Only the requested page is sorted, using the repository's presorted orders
+    total, paginated_characters = characters_repository.query(filters, sort_field, descending, skip, limit)
+
+    if skip >= total:
         return jsonify({"error": f"Skip is exceeding the length of the"
-                                 f" characters database (Total characters: {len(sorted_characters)})"}), 400
+                                 f" characters database (Total characters: {total})"}), 400
 
-    # if skip + limit > len(sorted_characters):
+    # if skip + limit > total:
     #     return jsonify({"error": "Requested page exceeds available characters."}), 400
 
     if ('limit' not in request.args and 'skip' not in request.args and not sort_asc
-            and not sort_desc and not any(filter_params.values())):
+            and not sort_desc and not filters):
         random_characters = random.sample(characters, min(20, len(characters)))
-        return jsonify(random_characters), 200
+        return jsonify(project(random_characters, fields)), 200
+
+    return jsonify(project(paginated_characters, fields)), 200
+
 
-    paginated_characters = sorted_characters[skip:skip + limit]
+@app.route('/api/characters/stats', methods=['GET'])
+@token_required
+def get_character_stats(payload):
+    """Returns statistics about the characters: their total number, the number
+    of characters per value of each attribute listed in 'group_by' (comma
+    separated, default 'house'), and the count, min, max, mean and histogram
+    of their ages, in buckets of 'bucket_size' years (default 10). The same
+    filters as for /api/characters can be applied. Unfiltered statistics come
+    from aggregates the repository updates on every write, so the characters
+    are not scanned."""
+
+    filters, error = parse_filters(['group_by', 'bucket_size'])
+    if error:
+        return error
+
+    group_by = [field for field in request.args.get('group_by', 'house').split(',') if field]
+    for field in group_by:
+        if field not in VALID_ATTRIBUTES:
+            return jsonify({"error": f"Invalid group_by attribute: '{field}' is not a valid character attribute."}), 400
+
+    bucket_size = 10
+    if 'bucket_size' in request.args:
+        try:
+            bucket_size = int(request.args.get('bucket_size'))
+            if bucket_size <= 0:
+                return jsonify({"error": "Bucket size must be greater than 0."}), 400
+        except ValueError:
+            return jsonify({"error": "Invalid bucket_size parameter. Must be an integer."}), 400
 
-    return jsonify(paginated_characters), 200
+    total, stats = characters_repository.stats(set(group_by) | {'age'}, filters)
+    return jsonify({
+        'total': total,
+        'groups': {field: stats[field].groups() for field in group_by},
+        'age': stats['age'].summary(bucket_size)
+    }), 200
 
 
-@app.route('/api/all_characters', methods=['GET'])
+@app.route('/api/characters/search', methods=['GET'])
 @token_required
-def get_all_characters(payload):
-    """Returns a JSON file containing the list of all characters from Game of Thrones."""
+def search_characters(payload):
+    """Returns the characters matching the words of the 'q' query parameter in
+    their name, nickname, house, role or symbol, best matches first. Words may
+    be incomplete (e.g. 'tyr lan'), which allows searching while typing, and
+    misspelled words match similar ones. The number of results is set with
+    'limit' (default 10). The search uses the repository's inverted index
+    instead of scanning the characters."""
+
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({"error": "The 'q' parameter is required."}), 400
+
+    limit = 10
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args.get('limit'))
+            if limit <= 0:
+                return jsonify({"error": "Limit must be greater than 0."}), 400
+        except ValueError:
+            return jsonify({"error": "Invalid limit parameter. Must be an integer."}), 400
 
-    characters = read_data('characters.json')
+    total, characters = characters_repository.search(text, limit)
+    return jsonify({'characters': characters, 'total': total}), 200
 
-    return jsonify(characters), 200
+
+@app.route('/api/all_characters', methods=['GET'])
+@token_required
+def get_all_characters(payload):
+    """Returns a JSON file containing the list of all characters from Game of Thrones.
+    Clients sending 'Accept: application/x-ndjson' receive a streamed response with
+    one character per line, and '?stream=1' streams the regular JSON array.
+    The ETag is the dataset version (the same in every worker process), so a
+    client sending it back in If-None-Match gets an empty 304 response until
+    a character is added, updated or deleted. With 'fields' (e.g. 'id,name')
+    only these fields of the characters are returned."""
+
+    fields, error = parse_fields()
+    if error:
+        return error
+
+    characters, version, modified_at = characters_repository.versioned_all()
+
+    ndjson = request.accept_mimetypes.best_match(['application/json',
+                                                  'application/x-ndjson']) == 'application/x-ndjson'
+    stream = ndjson or request.args.get('stream') in ['1', 'true']
+    # Each representation has its own ETag, as their bodies differ
+    etag = f"{version}-ndjson" if ndjson else f"{version}-stream" if stream else version
+    # Projections are separate representations and separate cached bodies
+    variant = 'all' if fields is None else f"all:{','.join(fields)}"
+    if fields is not None:
+        etag = f"{etag}-{','.join(fields)}"
+
+    if stream:
+        return conditional_response(etag, modified_at, lambda: stream_characters(characters, ndjson, fields))
+
+    def cached_response():
+        # The body is serialized and compressed once per dataset version
+        def serialize():
+            with span('serialize'):
+                return f"{app.json.dumps(project(characters, fields))}\n".encode()
+
+        encoding = negotiate_encoding(request.accept_encodings)
+        if len(body_cache.get(version, variant, None, serialize)) < COMPRESS_MIN_SIZE:
+            encoding = None
+        body = body_cache.get(version, variant, encoding, serialize)
+        response = Response(body, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    return conditional_response(etag, modified_at, cached_response)
+
+
+@app.route('/api/characters/changes', methods=['GET'])
+@token_required
+def get_character_changes(payload):
+    """Returns the characters added, updated and deleted after the sequence
+    number 'since', oldest first, so clients can follow the data without
+    downloading it again. When there are no newer changes the request waits
+    up to 'timeout' seconds for one (long-polling). Clients sending
+    'Accept: text/event-stream' receive the changes as Server-Sent Events
+    as they happen. The history is bounded (see ChangeFeed in changes.py):
+    clients that fell further behind get a resync signal and must read all
+    the characters again. Without 'since' only the current sequence number
+    is returned, which a client reads before loading the characters."""
+
+    event_stream = request.accept_mimetypes.best_match(['application/json',
+                                                        'text/event-stream']) == 'text/event-stream'
+    since = request.args.get('since', request.headers.get('Last-Event-ID') if event_stream else None)
+    timeout = request.args.get('timeout', CHANGE_FEED_MAX_WAIT)
+    try:
+        since = None if since is None else int(since)
+        timeout = min(int(timeout), CHANGE_FEED_MAX_WAIT)
+    except ValueError:
+        since = timeout = -1
+    if (since is not None and since < 0) or timeout < 0:
+        return jsonify({"error": "'since' and 'timeout' must be non-negative integers."}), 400
+
+    if since is None:
+        since = change_feed.last_seq()
+        if not event_stream:
+            return jsonify({"changes": [], "last_seq": since, "resync": False})
+    if event_stream:
+        return stream_changes(since)
+
+    change_feed.wait(since, timeout)
+    changes, last = change_feed.changes(since, CHANGE_FEED_BATCH_SIZE)
+    if changes is None:
+        response = jsonify({"changes": [], "last_seq": last, "resync": True})
+    else:
+        response = jsonify({"changes": changes, "last_seq": changes[-1]['seq'] if changes else since,
+                            "resync": False})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def stream_changes(since):
+    """Returns an event stream of the changes after sequence number since.
+    Each change is a 'change' event with the sequence number as its id; a
+    'resync' event ends the stream when the client fell behind the history.
+    The stream is closed after CHANGE_FEED_STREAM_SECONDS."""
+    def generate():
+        position = since
+        end = time.monotonic() + CHANGE_FEED_STREAM_SECONDS
+        while time.monotonic() < end:
+            changes, last = change_feed.changes(position, CHANGE_FEED_BATCH_SIZE)
+            if changes is None:
+                yield f"id: {last}\nevent: resync\ndata: {app.json.dumps({'last_seq': last})}\n\n"
+                return
+            for change in changes:
+                yield f"id: {change['seq']}\nevent: change\ndata: {app.json.dumps(change)}\n\n"
+            if changes:
+                position = changes[-1]['seq']
+            elif change_feed.wait(position, min(CHANGE_FEED_HEARTBEAT, end - time.monotonic())) == position:
+                yield ': keep-alive\n\n'
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-store'
+    # Stops proxies such as nginx from buffering the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/api/characters/<int:character_id>', methods=['GET'])
@@ -246,13 +860,20 @@ def get_all_characters(payload):
 def get_character_by_id(payload, character_id):
     """Returns a JSON representation of the character whose 'id'
     matches the provided 'character_id'. If the character is not found,
-    a 404 error is returned with an appropriate message."""
+    a 404 error is returned with an appropriate message. The ETag is a hash
+    of the character itself, so it only changes when this character does.
+    With 'fields' only these fields of the character are returned."""
 
-    characters = read_data('characters.json')
+    fields, error = parse_fields()
+    if error:
+        return error
 
-    for character in characters:
-        if character['id'] == character_id:
-            return jsonify(character), 200
+    character, _, modified_at = characters_repository.versioned_get(character_id)
+    if character is not None:
+        if fields is not None:
+            character = project([character], fields)[0]
+        etag = hashlib.sha1(json.dumps(character, sort_keys=True).encode()).hexdigest()[:20]
+        return conditional_response(etag, modified_at, lambda: jsonify(character))
 
     return jsonify({"error": f"Character with ID {character_id} not found."}), 400
 
@@ -263,34 +884,15 @@ def add_character(payload):
     """Adds a new character to the character list, ensuring all required fields
     are filled and have the correct data types."""
 
-    characters = read_data('characters.json')
     new_character = request.get_json()  # Retrieves data from the request
 
     # print("Received data:", new_character)  # Log the incoming request
 
-    required_fields = {
-        'name': str,
-        'age': int,
-        'animal': str,
-        'death': str,
-        'house': str,
-        'nickname': str,
-        'role': str,
-        'strength': str,
-        'symbol': str
-    }
-
-    for field, field_type in required_fields.items():
-        if field not in new_character:
-            new_character[field] = None
+    error = validate_character(new_character, new=True)
+    if error:
+        return jsonify({"error": error}), 400
 
-        if new_character[field] is not None and not isinstance(new_character[field], field_type):
-            return jsonify({"error": f"'{field}' must be of type {field_type.__name__} or null."}), 400
-
-    new_character['id'] = max([char['id'] for char in characters]) + 1 if characters else 1
-    characters.append(new_character)
-    # For in-memory saving of a new character comment next line
-    sync_data('characters.json', characters)
+    characters_repository.add(new_character)
     return jsonify(new_character), 200
 
 
@@ -300,14 +902,9 @@ def delete_character(payload, id):
     """Deletes a character based on the ID specified in the URL. If the character
      exists, it is deleted, if it does not exist, an error message is returned."""
 
-    characters = read_data('characters.json')
-
-    for character in characters:
-        if character['id'] == id:
-            characters.remove(character)
-            sync_data('characters.json', characters)
-            return jsonify({"message": f"Character with id {id} has been deleted"
-                                       f" successfully."}), 200
+    if characters_repository.delete(id):
+        return jsonify({"message": f"Character with id {id} has been deleted"
+                                   f" successfully."}), 200
     return jsonify({"message": f"Character with id {id} not found."}), 404
 
 
@@ -318,47 +915,106 @@ def update_character(payload, id):
     found, it updates only the fields provided in the request body, leaving
     any unspecified fields unchanged. """
 
-    characters = read_data('characters.json')
     data = request.get_json()
 
-    required_fields = {
-        'name': str,
-        'age': int,
-        'animal': str,
-        'death': str,
-        'house': str,
-        'nickname': str,
-        'role': str,
-        'strength': str,
-        'symbol': str
-    }
+    error = validate_character(data, new=False)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Only the known character fields are updated, any other keys are ignored
+    updates = {field: data[field] for field in CHARACTER_FIELDS if field in data}
 
-    for field, expected_type in required_fields.items():
-        if field in data and data[field] is not None:
-            if not isinstance(data[field], expected_type):
-                return jsonify({"error": f"'{field}' must be of type {expected_type.__name__}."}), 400
-        elif field in data and data[field] is None:
-            data[field] = None   # Allow null values if explicitly sent
-
-    for character in characters:
-        if character['id'] == id:
-            character['name'] = data.get('name', character['name'])
-            character['age'] = data.get('age', character['age'])
-            character['animal'] = data.get('animal', character['animal'])
-            character['death'] = data.get('death', character['death'])
-            character['house'] = data.get('house', character['house'])
-            character['nickname'] = data.get('nickname', character['nickname'])
-            character['role'] = data.get('role', character['role'])
-            character['strength'] = data.get('strength', character['strength'])
-            character['symbol'] = data.get('symbol', character['symbol'])
-
-            sync_data('characters.json', characters)
-
-            return jsonify({"message": f"Character with id {id} has been updated "
-                                       f"successfully.", "id": id}), 200
+    if characters_repository.update(id, updates) is not None:
+        return jsonify({"message": f"Character with id {id} has been updated "
+                                   f"successfully.", "id": id}), 200
     return jsonify({"error": f"Character with id {id} not found!"}), 404
 
 
+@app.route('/api/characters/bulk', methods=['POST'])
+@token_required
+def bulk_characters(payload):
+    """Adds, updates and deletes many characters in one request. The body is a
+    list of operations: {"op": "create", "character": {...}},
+    {"op": "update", "id": 5, "character": {...}} or {"op": "delete", "id": 5}.
+    Every operation is validated like the single character routes, the valid
+    ones are applied in order and saved with a single storage write, and the
+    response lists the result of each operation with its own status code."""
+
+    operations = request.get_json(silent=True)
+    if not isinstance(operations, list):
+        return jsonify({"error": "The request body must be a list of operations."}), 400
+    if len(operations) > BULK_MAX_OPERATIONS:
+        return jsonify({"error": f"At most {BULK_MAX_OPERATIONS} operations can be sent at once."}), 400
+
+    # Validates everything first, so the valid operations are applied together
+    results = [None] * len(operations)
+    valid = []  # (position in the request, repository operation)
+    for position, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            operation = {}
+        op, character_id, character = operation.get('op'), operation.get('id'), operation.get('character')
+
+        error = None
+        if op not in ['create', 'update', 'delete']:
+            error = "'op' must be 'create', 'update' or 'delete'."
+        elif op != 'create' and type(character_id) is not int:
+            error = "'id' must be an integer."
+        elif op != 'delete' and not isinstance(character, dict):
+            error = "'character' must be an object."
+        elif op != 'delete':
+            error = validate_character(character, new=op == 'create')
+
+        if error:
+            results[position] = {"status": 400, "error": error}
+        elif op == 'create':
+            valid.append((position, ('add', character)))
+        elif op == 'update':
+            updates = {field: character[field] for field in CHARACTER_FIELDS if field in character}
+            valid.append((position, ('update', character_id, updates)))
+        else:
+            valid.append((position, ('delete', character_id)))
+
+    outcomes = characters_repository.bulk([operation for _, operation in valid])
+    for (position, operation), outcome in zip(valid, outcomes):
+        if operation[0] == 'add':
+            results[position] = {"status": 200, "character": outcome}
+        elif operation[0] == 'update':
+            if outcome is not None:
+                results[position] = {"status": 200, "character": outcome}
+            else:
+                results[position] = {"status": 404, "error": f"Character with id {operation[1]} not found!"}
+        elif outcome:
+            results[position] = {"status": 200, "message": f"Character with id {operation[1]} has been deleted"
+                                                           f" successfully."}
+        else:
+            results[position] = {"status": 404, "error": f"Character with id {operation[1]} not found."}
+
+    return jsonify({"results": results}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Returns the request counters, the latency histograms of the routes and of
+    their spans, and the token cache and password pool counters in the
+    Prometheus text format. Requires 'Bearer <METRICS_TOKEN>' if it is set."""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                 f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'message': 'Token is missing or invalid'}), 401
+
+    cache, pool = token_cache.stats(), password_pool.stats()
+    gauges = [
+        ('thrones_token_cache_hits_total', 'counter', 'Requests whose token was found in the cache.', cache['hits']),
+        ('thrones_token_cache_misses_total', 'counter', 'Tokens verified and added to the cache.', cache['misses']),
+        ('thrones_token_cache_evictions_total', 'counter', 'Tokens evicted from the full cache.', cache['evictions']),
+        ('thrones_token_cache_size', 'gauge', 'Tokens currently cached.', cache['size']),
+        ('thrones_password_pool_pending', 'gauge', 'Password hashing jobs waiting or running.', pool['pending']),
+        ('thrones_password_pool_completed_total', 'counter', 'Password hashing jobs completed.', pool['completed']),
+        ('thrones_password_pool_rejected_total', 'counter', 'Password hashing jobs rejected.', pool['rejected']),
+        ('thrones_character_changes_total', 'counter', 'Character changes in the change feed.', change_feed.last_seq())
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
 SWAGGER_URL = "/api/docs"  # swagger endpoint e.g. HTTP://localhost:5002/api/docs
 API_URL = "/static/swagger_data.json"
 
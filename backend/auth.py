@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import os
+import threading
+import time
+from metrics import span
+
+PASSWORD_HASH_ALGORITHM = 'pbkdf2_sha256'
+
+
+class TokenCache:
+    """Bounded LRU cache of verified JWT payloads keyed by the raw token, so
+    that a client reusing the same bearer token does not pay for the signature
+    verification on every request. An entry expires at the token's 'exp'
+    claim, or after 'ttl' seconds if that comes first (so a changed
+    SECRET_KEY is picked up), after which the token is verified again. When
+    more than 'capacity' tokens are cached, the least recently used one is
+    evicted; a capacity of 0 disables the cache."""
+
+    def __init__(self, capacity=1024, ttl=300):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # token -> (expiry time, payload)
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns a copy of the cached payload for the token, or None."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return dict(entry[1])
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        """Caches the payload of a token that has just been verified."""
+        if self.capacity <= 0 or 'exp' not in payload:
+            return
+        expires = min(payload['exp'], time.time() + self.ttl)
+        with self._lock:
+            self._entries[token] = (expires, dict(payload))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the cache counters."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+def hash_password(password, iterations):
+    """Returns a salted PBKDF2-SHA256 hash of the password, formatted as
+    'pbkdf2_sha256$<iterations>$<salt>$<hash>'."""
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"{PASSWORD_HASH_ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, stored, iterations):
+    """Checks a password against a stored hash. Returns a (valid, needs_rehash)
+    tuple; needs_rehash is True when the stored value is a legacy plaintext
+    password or was hashed with a different number of iterations, so it
+    should be replaced by hash_password() after a successful login."""
+    if not isinstance(stored, str):
+        return False, False
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] != PASSWORD_HASH_ALGORITHM:
+        # Users registered before passwords were hashed
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    try:
+        stored_iterations, salt = int(parts[1]), bytes.fromhex(parts[2])
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, stored_iterations)
+    except (ValueError, OverflowError):
+        # Malformed hashes, e.g. with a zero or negative number of iterations
+        return False, False
+    return hmac.compare_digest(digest.hex(), parts[3]), stored_iterations != iterations
+
+
+class PoolBusy(Exception):
+    """Raised when the password pool has too many pending jobs."""
+
+
+class PasswordPool:
+    """Bounded pool of worker threads running the password hashing, so a burst
+    of logins cannot occupy every request thread with slow key derivations
+    (hashlib releases the GIL while hashing, so the workers run in parallel).
+    At most 'max_pending' jobs may wait or run at once; further jobs are
+    rejected with PoolBusy right away instead of queueing without limit."""
+
+    def __init__(self, workers=None, max_pending=64, iterations=260000):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.iterations = iterations
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        # Verified for unknown users: never matches, but costs as much as a real hash
+        self._dummy_hash = f"{PASSWORD_HASH_ALGORITHM}${iterations}${os.urandom(16).hex()}${'0' * 64}"
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password')
+        self._lock = threading.Lock()
+
+    def _run(self, function, *args):
+        """Runs the function in the pool and waits for its result."""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolBusy()
+            self.pending += 1
+        try:
+            with span('password_hash'):
+                return self._executor.submit(function, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.iterations)
+
+    def verify(self, password, stored):
+        """Returns a (valid, needs_rehash) tuple, see verify_password(). For an
+        unknown user (stored is None) a dummy hash is verified instead, so the
+        answer takes as long as for an existing user and does not tell which
+        usernames exist."""
+        if stored is None:
+            return self._run(verify_password, password, self._dummy_hash, self.iterations)[0], False
+        return self._run(verify_password, password, stored, self.iterations)
+
+    def stats(self):
+        """Returns the queue depth and counters of the pool."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
@@ -0,0 +1,90 @@
+"""Helpers shared by the micro-benchmarks and the load driver: loading the app
+on a generated dataset, latency percentiles and baseline comparison."""
+import importlib
+import json
+import math
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Secret used to sign the benchmark tokens when SECRET_KEY is not set
+DEFAULT_SECRET_KEY = 'benchmark-secret-key-benchmark-secret-key'
+
+
+def load_app(data_dir):
+    """Imports the Flask app module so that it uses the characters.json and
+    users.json of data_dir (the app opens them relative to the working
+    directory) and returns it."""
+    os.environ.setdefault('SECRET_KEY', DEFAULT_SECRET_KEY)
+    os.chdir(data_dir)
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    return importlib.import_module('app')
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value below which the given fraction of the sorted values
+    lie (nearest-rank method), or None for no values."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Returns the p50/p95/p99 latencies in milliseconds and the throughput
+    of a list of request latencies (in seconds) measured over elapsed seconds."""
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None
+    }
+
+
+def compare(results, baseline, metrics, tolerance):
+    """Compares results with a baseline of the same shape ({name: {metric:
+    value}}). metrics maps each compared metric to True if higher is better.
+    Returns a list of (name, metric, baseline value, value) regressions worse
+    than the baseline by more than the tolerance (e.g. 0.2 for 20%)."""
+    regressions = []
+    for name, values in results.items():
+        for metric, higher_is_better in metrics.items():
+            expected = baseline.get(name, {}).get(metric)
+            value = values.get(metric)
+            if not expected or value is None:
+                continue
+            if higher_is_better and value < expected * (1 - tolerance):
+                regressions.append((name, metric, expected, value))
+            elif not higher_is_better and value > expected * (1 + tolerance):
+                regressions.append((name, metric, expected, value))
+    return regressions
+
+
+def report(results, columns, baseline_path=None, save_baseline=None, metrics=None, tolerance=0.2):
+    """Prints the results as a table, saves them as a new baseline and/or
+    compares them with a stored one. Returns the process exit code: 1 if any
+    metric regressed, 0 otherwise."""
+    print(f"{'benchmark':<28}" + ''.join(f"{column:>12}" for column in columns))
+    for name, values in results.items():
+        print(f"{name:<28}" + ''.join(f"{values.get(column, ''):>12}" for column in columns))
+
+    if save_baseline:
+        with open(save_baseline, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2)
+        print(f"Saved the baseline to {save_baseline}")
+
+    if not baseline_path:
+        return 0
+    with open(baseline_path) as fileobj:
+        baseline = json.load(fileobj)
+    regressions = compare(results, baseline, metrics, tolerance)
+    for name, metric, expected, value in regressions:
+        print(f"REGRESSION {name} {metric}: {value} (baseline {expected})")
+    if not regressions:
+        print(f"No regressions beyond {tolerance:.0%} of {baseline_path}")
+    return 1 if regressions else 0
@@ -0,0 +1,127 @@
+"""Generates synthetic characters.json/users.json files for the benchmarks.
+
+    python -m benchmarks.dataset 100k              # -> benchmarks/data/100k
+    python -m benchmarks.dataset 1m --seed 7 --out /tmp/thrones-1m
+
+The sizes 10k, 100k and 1m are predefined, any number of characters can
+also be given. The same seed always produces the same files."""
+import argparse
+import os
+import random
+from auth import hash_password
+from storage import sync_data
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Password of every generated user; 'bench_admin' is an admin
+PASSWORD = 'bench123#'
+
+# House -> (relative frequency, animal, symbol); None is for characters without a house
+HOUSES = {
+    'Stark': (12, 'Direwolf', 'Wolf'),
+    'Lannister': (12, 'Lion', 'Lion'),
+    'Baratheon': (10, 'Stag', 'Crowned Stag'),
+    'Frey': (8, None, 'Twin Towers'),
+    'Greyjoy': (8, 'Kraken', 'Kraken'),
+    'Tyrell': (7, None, 'Rose'),
+    'Targaryen': (6, 'Dragon', 'Dragon'),
+    'Martell': (6, 'Viper', 'Spear'),
+    'Tully': (5, 'Trout', 'Trout'),
+    'Arryn': (5, 'Falcon', 'Falcon'),
+    'Bolton': (4, None, 'Flayed Man'),
+    'Free Folk': (4, None, None),
+    'Dothraki': (4, 'Horse', 'Horse'),
+    'Mormont': (3, 'Bear', 'Bear'),
+    None: (17, None, None)
+}
+
+FIRST_NAMES = ['Aegon', 'Alys', 'Arya', 'Benjen', 'Bran', 'Brienne', 'Cersei', 'Daenerys', 'Edmure', 'Elia',
+               'Gendry', 'Jaime', 'Jeyne', 'Jon', 'Jorah', 'Lyanna', 'Lysa', 'Margaery', 'Myrcella', 'Oberyn',
+               'Osha', 'Petyr', 'Rickon', 'Robb', 'Robert', 'Roslin', 'Sansa', 'Stannis', 'Theon', 'Tommen',
+               'Tyrion', 'Tywin', 'Viserys', 'Walder', 'Willas', 'Yara', 'Ygritte']
+
+# Surnames of characters without a house
+BASTARD_NAMES = ['Snow', 'Sand', 'Rivers', 'Pyke', 'Flowers', 'Stone', 'Waters', 'Hill', None]
+
+NICKNAMES = ['The Young Wolf', 'Kingslayer', 'The Imp', 'Littlefinger', 'The Hound', 'Reek', 'The Red Viper',
+             'Queen of Thorns', 'The Bold', 'The Broken', 'Stormborn', 'The Mad', 'The Late']
+
+# Role -> relative frequency
+ROLES = {'Knight': 20, 'Lord': 15, 'Lady': 12, 'Soldier': 15, 'Maester': 4, 'King': 2, 'Queen': 2,
+         'Prince': 4, 'Princess': 4, 'Servant': 10, 'Mercenary': 6, 'Warrior': 6}
+
+STRENGTHS = ['Cunning', 'Physically strong', 'Intelligence', 'Loyalty', 'Bravery', 'Leadership']
+
+
+def generate_characters(count, seed=0):
+    """Returns a list of count characters with ids 1 to count. Houses and
+    roles follow skewed distributions, ages are roughly normal around 34,
+    and about half of the characters are dead (a death episode from 1 to 8)."""
+    rng = random.Random(seed)
+    houses = list(HOUSES)
+    house_weights = [HOUSES[house][0] for house in houses]
+    roles = list(ROLES)
+    role_weights = list(ROLES.values())
+
+    characters = []
+    for character_id in range(1, count + 1):
+        house = rng.choices(houses, house_weights)[0]
+        _, animal, symbol = HOUSES[house]
+        surname = house if house and house not in ['Free Folk', 'Dothraki'] else rng.choice(BASTARD_NAMES)
+        first_name = rng.choice(FIRST_NAMES)
+        age = min(90, max(5, int(rng.gauss(34, 15)))) if rng.random() > 0.03 else None
+        characters.append({
+            'id': character_id,
+            'name': f"{first_name} {surname}" if surname else first_name,
+            'house': house,
+            'animal': animal if rng.random() < 0.25 else None,
+            'symbol': symbol if rng.random() < 0.8 else None,
+            'nickname': rng.choice(NICKNAMES) if rng.random() < 0.35 else None,
+            'role': rng.choices(roles, role_weights)[0],
+            'age': age,
+            'death': rng.randint(1, 8) if rng.random() < 0.45 else None,
+            'strength': rng.choice(STRENGTHS)
+        })
+    return characters
+
+
+def generate_users(count, iterations=260000):
+    """Returns count users, all with the password PASSWORD. The password is
+    hashed once and the hash shared, as hashing is what logins measure."""
+    stored = hash_password(PASSWORD, iterations)
+    users = {'bench_admin': {'password': stored, 'role': 'admin'}}
+    for number in range(1, count):
+        users[f'user{number}'] = {'password': stored, 'role': 'user'}
+    return users
+
+
+def write_dataset(directory, count, seed=0, users=1000, iterations=260000):
+    """Writes characters.json and users.json for count characters to directory."""
+    os.makedirs(directory, exist_ok=True)
+    sync_data(os.path.join(directory, 'characters.json'), generate_characters(count, seed))
+    sync_data(os.path.join(directory, 'users.json'), generate_users(users, iterations))
+
+
+def parse_size(size):
+    """Returns the number of characters of a size name (e.g. '100k') or number."""
+    return SIZES[size.lower()] if size.lower() in SIZES else int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic dataset for the benchmarks.')
+    parser.add_argument('size', help="number of characters, or one of 10k, 100k, 1m")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--users', type=int, default=1000, help='number of users (default 1000)')
+    parser.add_argument('--iterations', type=int, default=260000, help='PBKDF2 iterations of the passwords')
+    parser.add_argument('--out', help='output directory (default benchmarks/data/<size>)')
+    args = parser.parse_args()
+
+    directory = args.out or os.path.join(DATA_DIR, args.size.lower())
+    write_dataset(directory, parse_size(args.size), args.seed, args.users, args.iterations)
+    print(f"Wrote {parse_size(args.size)} characters and {args.users} users to {directory}")
+
+
+if __name__ == '__main__':
+    main()
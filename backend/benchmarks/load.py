@@ -0,0 +1,179 @@
+"""Concurrent load driver reporting the latency percentiles and throughput of
+the main endpoints.
+
+    python -m benchmarks.load benchmarks/data/100k                        # Flask test client
+    python -m benchmarks.load benchmarks/data/100k --mode gunicorn --workers 4
+    python -m benchmarks.load benchmarks/data/100k --mode http --url http://localhost:5000
+
+In 'client' mode the requests go through the Flask test client in the
+benchmark process, which measures the application code without a network
+stack. 'gunicorn' starts a local gunicorn on the dataset, and 'http' sends
+the requests to an already running server (which must use the same
+SECRET_KEY, as the tokens are signed locally). Each endpoint is loaded by
+--concurrency threads in turn. With --baseline the exit code is 1 if a p95
+latency or a throughput is worse than the baseline by more than --tolerance."""
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import requests
+from benchmarks.common import BACKEND_DIR, DEFAULT_SECRET_KEY, load_app, report, summarize
+from benchmarks.micro import make_token
+
+# Endpoint name -> path; {id} is replaced by a random character id per request
+ENDPOINTS = {
+    'characters_random': '/api/characters',
+    'characters_page': '/api/characters?limit=20&skip=100&sort_asc=age',
+    'characters_filter': '/api/characters?house=stark&age_more_than=30&limit=50',
+    'characters_cursor': '/api/characters?cursor=&limit=50&sort_desc=name',
+    'characters_fields': '/api/characters?limit=100&fields=id,name',
+    'character_by_id': '/api/characters/{id}',
+    'search': '/api/characters/search?q=jon sta',
+    'stats': '/api/characters/stats?group_by=house,death',
+    'all_characters': '/api/all_characters',
+}
+
+
+def client_sender(app):
+    """Returns a function creating per-thread senders using the Flask test client."""
+    def create():
+        client = app.test_client()
+
+        def send(path, headers):
+            return client.get(path, headers=headers).status_code
+        return send
+    return create
+
+
+def http_sender(base_url):
+    """Returns a function creating per-thread senders using a requests session."""
+    def create():
+        session = requests.Session()
+
+        def send(path, headers):
+            response = session.get(base_url + path, headers=headers)
+            response.content  # Reads the whole body
+            return response.status_code
+        return send
+    return create
+
+
+def load(create_sender, path, headers, total_requests, concurrency, max_id, warmup=2):
+    """Sends total_requests requests to path from concurrency threads and
+    returns the summary of their latencies (see summarize()). Each thread
+    first sends 'warmup' requests that are not measured, so that loading the
+    data in a fresh worker process does not count as request latency."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency + 1)
+    per_thread = max(1, total_requests // concurrency)
+
+    def worker(seed):
+        send = create_sender()
+        rng = random.Random(seed)
+        own_latencies, own_errors = [], 0
+        for _ in range(warmup):
+            send(path.replace('{id}', str(rng.randint(1, max_id))), headers)
+        ready.wait()
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            status = send(path.replace('{id}', str(rng.randint(1, max_id))), headers)
+            own_latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                own_errors += 1
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - start, sum(errors))
+
+
+def start_gunicorn(data_dir, workers, threads):
+    """Starts gunicorn serving the app on the dataset and returns the process
+    and its base URL once it accepts connections."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                                '--threads', str(threads), '--bind', f'127.0.0.1:{port}',
+                                '--chdir', data_dir, '--pythonpath', BACKEND_DIR, 'app:app'], env=env)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a concurrent load against the API endpoints.')
+    parser.add_argument('data_dir', help='directory with characters.json and users.json')
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'http'], default='client')
+    parser.add_argument('--url', default='http://localhost:5000', help="server URL in 'http' mode")
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--requests', type=int, default=400, help='requests per endpoint')
+    parser.add_argument('--endpoints', help='comma separated endpoint names (default all)')
+    parser.add_argument('--gzip', action='store_true', help="send 'Accept-Encoding: gzip'")
+    parser.add_argument('--baseline', help='baseline JSON file to compare with')
+    parser.add_argument('--save-baseline', help='file to save the results to as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression (default 0.2)')
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    save_baseline = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    endpoints = {name: ENDPOINTS[name] for name in args.endpoints.split(',')} if args.endpoints else ENDPOINTS
+
+    process = None
+    if args.mode == 'client':
+        app_module = load_app(data_dir)
+        max_id = len(app_module.characters_repository.all())
+        create_sender = client_sender(app_module.app)
+        secret_key = app_module.SECRET_KEY
+    else:
+        from storage import read_data
+        max_id = len(read_data(os.path.join(data_dir, 'characters.json')))
+        secret_key = os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY)
+        base_url = args.url.rstrip('/')
+        if args.mode == 'gunicorn':
+            process, base_url = start_gunicorn(data_dir, args.workers, args.threads)
+        create_sender = http_sender(base_url)
+
+    headers = {'Authorization': f'Bearer {make_token(secret_key)}'}
+    if args.gzip:
+        headers['Accept-Encoding'] = 'gzip'
+    try:
+        if create_sender()(ENDPOINTS['character_by_id'].replace('{id}', '1'), headers) == 401:
+            raise RuntimeError('The benchmark token was rejected, check SECRET_KEY')
+        results = {name: load(create_sender, path, headers, args.requests, args.concurrency, max_id)
+                   for name, path in endpoints.items()}
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    sys.exit(report(results, ['requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'rps'], baseline,
+                    save_baseline, {'p95_ms': False, 'rps': True}, args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Micro-benchmarks of the hot paths of the backend on a generated dataset.
+
+    python -m benchmarks.dataset 100k
+    python -m benchmarks.micro benchmarks/data/100k --save-baseline baseline-micro.json
+    python -m benchmarks.micro benchmarks/data/100k --baseline baseline-micro.json
+
+Each benchmark is run 'repeat' times and the median and best time of one
+call are reported in milliseconds. With --baseline the exit code is 1 if a
+median is slower than the baseline by more than --tolerance."""
+import argparse
+import datetime
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import jwt
+from benchmarks.common import load_app, report
+
+
+def measure(function, repeat, number=1):
+    """Calls function 'number' times per round for 'repeat' rounds and returns
+    the median and minimum time of one call in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return {'median_ms': round(statistics.median(timings) * 1000, 4),
+            'min_ms': round(min(timings) * 1000, 4)}
+
+
+def make_token(secret_key, number=0):
+    """Returns a valid token; different numbers give different tokens."""
+    payload = {'username': 'bench_admin', 'role': 'admin', 'jti': str(number),
+               'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}
+    return jwt.encode(payload, secret_key, algorithm='HS256')
+
+
+def run(data_dir, repeat):
+    """Runs all the micro-benchmarks and returns {name: timings}."""
+    data_dir = os.path.abspath(data_dir)
+    app_module = load_app(data_dir)
+    from repository import CharacterRepository
+    from storage import JsonCharacterStorage, read_data, sync_data
+
+    characters_path = os.path.join(data_dir, 'characters.json')
+    characters = read_data(characters_path)
+    count = len(characters)
+    rng = random.Random(0)
+    results = {}
+
+    # Storage: parsing and atomically rewriting the whole file
+    results['read_data'] = measure(lambda: read_data(characters_path), repeat)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copy_path = os.path.join(tmp_dir, 'characters.json')
+        shutil.copy(characters_path, copy_path)
+        results['sync_data'] = measure(lambda: sync_data(copy_path, characters), repeat)
+
+    # Repository: cold load from the JSON file and from a snapshot (indexes are built on first
+    # use, i.e. during the first query), then the get_characters query paths
+    fields = app_module.VALID_ATTRIBUTES
+    results['repository_load'] = measure(
+        lambda: CharacterRepository(characters_path, fields, app_module.SEARCH_FIELDS).all(), max(1, repeat // 2))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage = JsonCharacterStorage(characters_path, os.path.join(tmp_dir, 'characters.snapshot'))
+        storage.load_snapshot()  # Writes the snapshot
+        results['repository_load_snapshot'] = measure(
+            lambda: CharacterRepository(storage, fields, app_module.SEARCH_FIELDS).all(), repeat)
+    repository = CharacterRepository(characters_path, fields, app_module.SEARCH_FIELDS)
+    repository.all()
+    queries = {
+        'query_first_page': ((), None, False, 0, 20),
+        'query_filter_house': ([('house', 'contains', 'stark')], None, False, 0, 20),
+        'query_filter_sort': ([('house', 'contains', 'lannister'), ('age', 'range', 30, None)], 'age', True, 20, 20),
+        'query_deep_page': ((), 'name', False, count // 2, 20),
+        'query_keyset_page': ((), 'name', False, 0, 20, ('Jon Snow', count // 2)),
+    }
+    for name, args in queries.items():
+        results[name] = measure(lambda args=args: repository.query(*args), repeat, 10)
+    results['search'] = measure(lambda: repository.search('tyr lann', 20), repeat, 10)
+    results['materialize_all'] = measure(lambda: repository.all().materialize(), repeat)
+    results['stats_filtered'] = measure(
+        lambda: repository.stats(['house', 'age'], [('age', 'range', 20, 30)]), repeat)
+
+    # By-id lookups of random ids
+    ids = [rng.randint(1, count) for _ in range(1000)]
+    results['get_by_id_x1000'] = measure(lambda: [repository.get(character_id) for character_id in ids], repeat)
+
+    # token_required: signature verification (new tokens) versus the token cache
+    protected = app_module.token_required(lambda payload: payload)
+    secret_key = app_module.SECRET_KEY
+    tokens = [make_token(secret_key, number) for number in range(repeat * 100)]
+    fresh = iter(tokens)
+
+    def call(token):
+        with app_module.app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+            return protected()
+
+    if not isinstance(call(make_token(secret_key, -1)), dict):
+        raise RuntimeError('The benchmark token was rejected, check SECRET_KEY')
+    results['token_required_miss'] = measure(lambda: call(next(fresh)), repeat, 100)
+    results['token_required_hit'] = measure(lambda: call(tokens[0]), repeat, 100)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the micro-benchmarks on a generated dataset.')
+    parser.add_argument('data_dir', help='directory with characters.json and users.json')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', help='baseline JSON file to compare with')
+    parser.add_argument('--save-baseline', help='file to save the results to as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown (default 0.2)')
+    args = parser.parse_args()
+
+    # The paths are resolved before load_app() changes the working directory
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    save_baseline = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    results = run(args.data_dir, args.repeat)
+    sys.exit(report(results, ['median_ms', 'min_ms'], baseline, save_baseline,
+                    {'median_ms': False}, args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Last sequence number, number of slots and bytes per slot
+HEADER = struct.Struct('QQQ')
+
+# Sequence number and payload length at the start of each slot
+SLOT_HEADER = struct.Struct('QI')
+
+
+class ChangeFeed:
+    """Bounded history of the character changes, for clients that follow the
+    data instead of downloading it again. Each change gets the next sequence
+    number and is kept as a JSON event in a ring buffer of 'capacity' slots,
+    so only the latest changes are available; a client asking for older
+    ones must resync (read everything again).
+
+    The ring buffer is a memory-mapped file, like the generation counter of
+    StorageLock, so all the worker processes share one history and one
+    sequence. append() must be called while holding the storage's write
+    lock, which orders the writers. Readers take no lock: a slot is written
+    with its sequence number last and readers check that number before and
+    after reading the event, so an event that was being overwritten reads
+    as missing and the client resyncs. Events larger than a slot are kept
+    without their 'character', which clients then read by id."""
+
+    # Seconds between two checks for changes made by other processes while waiting
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, path, capacity=1024, slot_size=2048):
+        self.path = path
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self._map = None
+        self._open_lock = threading.Lock()
+        self._condition = threading.Condition()
+
+    def _open(self):
+        """Maps the file on first use. A file made for another capacity or
+        slot size is cleared, keeping its last sequence number."""
+        if self._map is not None:
+            return self._map
+        with self._open_lock:
+            if self._map is None:
+                size = HEADER.size + self.capacity * self.slot_size
+                file_descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    header = os.read(file_descriptor, HEADER.size)
+                    layout = HEADER.unpack(header) if len(header) == HEADER.size else (0, None, None)
+                    cleared = layout[1:] != (self.capacity, self.slot_size)
+                    if cleared:
+                        os.ftruncate(file_descriptor, 0)
+                        os.ftruncate(file_descriptor, size)
+                    ring = mmap.mmap(file_descriptor, size)
+                    if cleared:
+                        HEADER.pack_into(ring, 0, layout[0], self.capacity, self.slot_size)
+                    self._map = ring
+                finally:
+                    os.close(file_descriptor)
+        return self._map
+
+    def last_seq(self):
+        """Returns the sequence number of the latest change (0 before the first)."""
+        return HEADER.unpack_from(self._open())[0]
+
+    def append(self, *events):
+        """Adds events (dictionaries with 'op' and 'id', plus 'character' for
+        additions and updates) with the next sequence numbers and a
+        timestamp. Returns the last sequence number."""
+        ring = self._open()
+        seq = self.last_seq()
+        for event in events:
+            seq += 1
+            event = dict(event, seq=seq, time=round(time.time(), 3))
+            payload = json.dumps(event).encode()
+            if SLOT_HEADER.size + len(payload) > self.slot_size:
+                event.pop('character', None)
+                payload = json.dumps(event).encode()
+            offset = HEADER.size + (seq - 1) % self.capacity * self.slot_size
+            SLOT_HEADER.pack_into(ring, offset, 0, len(payload))
+            ring[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(payload)] = payload
+            SLOT_HEADER.pack_into(ring, offset, seq, len(payload))
+            struct.pack_into('Q', ring, 0, seq)
+        with self._condition:
+            self._condition.notify_all()
+        return seq
+
+    def _read(self, seq):
+        """Returns the event with the given sequence number, or None if its
+        slot was reused."""
+        ring = self._open()
+        offset = HEADER.size + (seq - 1) % self.capacity * self.slot_size
+        slot_seq, length = SLOT_HEADER.unpack_from(ring, offset)
+        if slot_seq != seq:
+            return None
+        payload = ring[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length]
+        if SLOT_HEADER.unpack_from(ring, offset)[0] != seq:
+            return None
+        return json.loads(payload)
+
+    def changes(self, since, limit=100):
+        """Returns a (changes, last_seq) tuple, where changes lists the (at
+        most limit) oldest events after sequence number since. changes is
+        None if the history no longer goes back to since, or if since is
+        ahead of the feed (e.g. its file was deleted): the client must
+        resync."""
+        last = self.last_seq()
+        if since > last or since < last - self.capacity:
+            return None, last
+        events = []
+        for seq in range(since + 1, min(last, since + limit) + 1):
+            event = self._read(seq)
+            if event is None:
+                return None, last
+            events.append(event)
+        return events, last
+
+    def wait(self, since, timeout):
+        """Waits up to timeout seconds for a change after sequence number
+        since and returns the last sequence number. Changes made in this
+        process wake the waiters at once, others are noticed within
+        POLL_INTERVAL seconds."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                last = self.last_seq()
+                remaining = deadline - time.monotonic()
+                if last != since or remaining <= 0:
+                    return last
+                self._condition.wait(min(self.POLL_INTERVAL, remaining))
@@ -0,0 +1,24 @@
+import sys
+from storage import convert_json_to_snapshot, convert_snapshot_to_json
+
+
+def main():
+    """Converts a characters JSON file to a binary snapshot, or a snapshot
+    back to JSON, depending on the extension of the first argument:
+
+        python convert_snapshot.py characters.json characters.snapshot
+        python convert_snapshot.py characters.snapshot characters.json
+    """
+    if len(sys.argv) != 3:
+        print(main.__doc__)
+        sys.exit(1)
+    source, target = sys.argv[1:]
+    if source.endswith('.json'):
+        convert_json_to_snapshot(source, target)
+    else:
+        convert_snapshot_to_json(source, target)
+    print(f"Converted {source} to {target}.")
+
+
+if __name__ == "__main__":
+    main()
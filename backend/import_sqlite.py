@@ -0,0 +1,15 @@
+import sys
+from storage import import_json_to_sqlite
+
+
+def main():
+    """Imports characters.json and users.json into the SQLite database given as
+    the first argument (thrones.db by default), to be used with
+    STORAGE_BACKEND=sqlite."""
+    database_path = sys.argv[1] if len(sys.argv) > 1 else 'thrones.db'
+    import_json_to_sqlite(database_path)
+    print(f"Imported characters.json and users.json into {database_path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+from bisect import bisect_left, bisect_right, insort
+import heapq
+import math
+import re
+
+# Words of the searchable text: runs of letters, digits and underscores
+WORD = re.compile(r"\w+")
+
+
+def trigrams(text):
+    """Returns the set of three character sequences contained in the text."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def words(text):
+    """Returns the lower-cased words of a text (nothing for non-strings)."""
+    return WORD.findall(text.lower()) if isinstance(text, str) else []
+
+
+def word_trigrams(word):
+    """Returns the trigrams of a word padded with spaces, so that short words
+    have trigrams too and the start and end of the word weigh more."""
+    return trigrams(f"  {word} ")
+
+
+class AttributeIndex:
+    """Secondary index over a single character attribute. String values are
+    stored lower-cased (once, when the character is indexed) together with a
+    trigram index over the distinct values, so substring filters only check
+    the values that share all of the query's trigrams. Integer values are kept
+    in a sorted list of (value, id) pairs, so equality and range filters are
+    answered with bisect."""
+
+    def __init__(self):
+        self.values = {}     # lower-cased string value -> set of ids
+        self.trigrams = {}   # trigram -> set of lower-cased string values
+        self.numbers = []    # sorted list of (integer value, id)
+
+    def add(self, character_id, value):
+        """Adds a character's attribute value to the index."""
+        if isinstance(value, bool):
+            return
+        if isinstance(value, int):
+            insort(self.numbers, (value, character_id))
+        elif isinstance(value, str):
+            lowered = value.lower()
+            ids = self.values.get(lowered)
+            if ids is None:
+                ids = self.values[lowered] = set()
+                for trigram in trigrams(lowered):
+                    self.trigrams.setdefault(trigram, set()).add(lowered)
+            ids.add(character_id)
+
+    def build(self, items):
+        """Adds many (id, value) pairs at once, sorting the integer values
+        once instead of inserting them one at a time."""
+        numbers = []
+        for character_id, value in items:
+            if type(value) is int:
+                numbers.append((value, character_id))
+            else:
+                self.add(character_id, value)
+        self.numbers = sorted(self.numbers + numbers)
+
+    def remove(self, character_id, value):
+        """Removes a character's attribute value from the index."""
+        if isinstance(value, bool):
+            return
+        if isinstance(value, int):
+            position = bisect_left(self.numbers, (value, character_id))
+            if position < len(self.numbers) and self.numbers[position] == (value, character_id):
+                del self.numbers[position]
+        elif isinstance(value, str):
+            lowered = value.lower()
+            ids = self.values.get(lowered)
+            if ids is None:
+                return
+            ids.discard(character_id)
+            if not ids:
+                del self.values[lowered]
+                for trigram in trigrams(lowered):
+                    values = self.trigrams[trigram]
+                    values.discard(lowered)
+                    if not values:
+                        del self.trigrams[trigram]
+
+    def matching_values(self, text):
+        """Returns the distinct indexed string values that contain the text."""
+        text = text.lower()
+        if len(text) < 3:
+            candidates = self.values
+        else:
+            sets = []
+            for trigram in trigrams(text):
+                values = self.trigrams.get(trigram)
+                if not values:
+                    return []
+                sets.append(values)
+            sets.sort(key=len)
+            candidates = sets[0].intersection(*sets[1:])
+        return [value for value in candidates if text in value]
+
+    def number_range(self, low=None, high=None):
+        """Returns the (start, end) positions in the sorted numbers list of the
+        values between low and high (both inclusive, None means unbounded)."""
+        start = 0 if low is None else bisect_left(self.numbers, (low,))
+        end = len(self.numbers) if high is None else bisect_right(self.numbers, (high, float('inf')))
+        return start, max(start, end)
+
+
+def parse_int(text):
+    """Returns the text as an integer, or None if it is not one."""
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def plan_filter(index, operator, *args):
+    """Prepares one filter against an index. Returns a tuple of
+    (estimated number of matches, function returning the matching ids,
+    function checking a single attribute value against the filter)."""
+    if operator == 'contains':
+        text = args[0]
+        lowered = text.lower()
+        number = parse_int(text)
+        values = index.matching_values(text)
+        start, end = index.number_range(number, number) if number is not None else (0, 0)
+        estimate = sum(len(index.values[value]) for value in values) + end - start
+
+        def fetch():
+            ids = set()
+            for value in values:
+                ids.update(index.values[value])
+            ids.update(character_id for _, character_id in index.numbers[start:end])
+            return ids
+
+        def check(value):
+            if isinstance(value, str):
+                return lowered in value.lower()
+            return number is not None and type(value) is int and value == number
+
+        return estimate, fetch, check
+
+    low, high = args
+    start, end = index.number_range(low, high)
+
+    def fetch():
+        return {character_id for _, character_id in index.numbers[start:end]}
+
+    def check(value):
+        return (type(value) is int and (low is None or value >= low)
+                and (high is None or value <= high))
+
+    return end - start, fetch, check
+
+
+def select_ids(indexes, filters, matcher):
+    """Query planner for a list of filters. Each filter is a tuple of
+    (field, 'contains', text) or (field, 'range', low, high). The filters are
+    estimated against their indexes, the most selective one is read from its
+    index and the resulting candidates are checked against the others, so the
+    work done is proportional to the smallest match set instead of the number
+    of characters. matcher(field, check) must return a function telling if
+    the field of a character (by id) passes check(value), see
+    CharacterTable.matcher() in records.py. Returns the set of matching ids."""
+    plans = sorted(((field,) + plan_filter(indexes[field], operator, *args)
+                    for field, operator, *args in filters), key=lambda plan: plan[1])
+    if not plans or plans[0][1] == 0:
+        return set()
+
+    candidates = plans[0][2]()
+    for field, _, _, check in plans[1:]:
+        matches = matcher(field, check)
+        candidates = {character_id for character_id in candidates if matches(character_id)}
+        if not candidates:
+            break
+    return candidates
+
+
+class SortOrder:
+    """Presorted order of the character ids by one attribute, kept up to date
+    on every write with bisect instead of being re-sorted per request. Entries
+    are (value is None, value is a string, value, id) tuples, so missing values
+    sort last, integers and strings never get compared with each other and
+    equal values are ordered by id (which is also the file order, as new
+    characters are appended with the next highest id)."""
+
+    def __init__(self):
+        self.entries = []
+
+    @staticmethod
+    def entry(character_id, value):
+        return value is None, isinstance(value, str), value, character_id
+
+    def add(self, character_id, value):
+        insort(self.entries, self.entry(character_id, value))
+
+    def build(self, items):
+        """Adds many (id, value) pairs at once with a single sort."""
+        entry = self.entry
+        self.entries = sorted(self.entries + [entry(character_id, value) for character_id, value in items])
+
+    def remove(self, character_id, value):
+        entry = self.entry(character_id, value)
+        index = bisect_left(self.entries, entry)
+        if index < len(self.entries) and self.entries[index] == entry:
+            del self.entries[index]
+
+    def ids(self, descending=False, after=None):
+        """Yields the ids in ascending order, or in descending order with
+        missing values first (the same order as sorted(..., reverse=True)
+        with a (value is None, value) key). Equal values are yielded by
+        ascending id in both directions. If after is a (value, id) pair,
+        iteration starts right after that entry, whether it still exists or
+        not, which is what keyset pagination needs."""
+        entries = self.entries
+        if not descending:
+            start = 0 if after is None else bisect_right(entries, self.entry(after[1], after[0]))
+            for index in range(start, len(entries)):
+                yield entries[index][3]
+            return
+
+        if after is None:
+            end = len(entries)
+        else:
+            # Finishes the run of values equal to the cursor first
+            entry = self.entry(after[1], after[0])
+            run_end = bisect_right(entries, entry[:3] + (float('inf'),))
+            for index in range(bisect_right(entries, entry), run_end):
+                yield entries[index][3]
+            end = bisect_left(entries, entry[:3])
+        while end > 0:
+            # Finds the start of the run of equal values ending at 'end'
+            start = bisect_left(entries, entries[end - 1][:3])
+            for index in range(start, end):
+                yield entries[index][3]
+            end = start
+
+
+class SearchIndex:
+    """Inverted index for ranked full-text search over several character
+    attributes. Every word of the indexed attributes maps to the ids of the
+    characters containing it, weighted by the attribute it appears in (a match
+    in the name counts more than one in the symbol). The words are also kept
+    sorted, for prefix matching while the user is typing, and in a trigram
+    index, for fuzzy matching of misspelled words. Characters are added and
+    removed one at a time, so the index follows writes without a rebuild."""
+
+    # Match quality of a word found by prefix or by trigram similarity,
+    # relative to an exact match
+    PREFIX_QUALITY = 0.7
+    FUZZY_QUALITY = 0.5
+    # Minimum trigram similarity (Dice coefficient) of a fuzzy match
+    FUZZY_THRESHOLD = 0.4
+    # Maximum number of indexed words a query word is expanded to
+    MAX_EXPANSIONS = 50
+
+    def __init__(self, field_weights):
+        self.field_weights = dict(field_weights)
+        self.postings = {}   # word -> {id: weight}
+        self.words = []      # sorted list of the indexed words
+        self.trigrams = {}   # trigram -> set of words
+        self.size = 0        # number of indexed characters
+
+    def _weights(self, character):
+        """Returns the weight of each word of a character's searchable attributes."""
+        weights = {}
+        for field, weight in self.field_weights.items():
+            for word in words(character.get(field)):
+                weights[word] = weights.get(word, 0) + weight
+        return weights
+
+    def add(self, character_id, character):
+        """Adds a character's searchable attributes to the index."""
+        for word in self._add(character_id, character):
+            insort(self.words, word)
+
+    def build(self, items):
+        """Adds many (id, character) pairs at once, sorting the new words
+        once instead of inserting them one at a time."""
+        new_words = []
+        for character_id, character in items:
+            new_words.extend(self._add(character_id, character))
+        self.words = sorted(self.words + new_words)
+
+    def _add(self, character_id, character):
+        """Adds a character to the postings and returns the words that were
+        not indexed yet, which the caller adds to the sorted words."""
+        self.size += 1
+        new_words = []
+        for word, weight in self._weights(character).items():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                new_words.append(word)
+                for trigram in word_trigrams(word):
+                    self.trigrams.setdefault(trigram, set()).add(word)
+            postings[character_id] = weight
+        return new_words
+
+    def remove(self, character_id, character):
+        """Removes a character from the index. The character must still have
+        the attribute values it was added with."""
+        self.size -= 1
+        for word in self._weights(character):
+            postings = self.postings.get(word)
+            if postings is None:
+                continue
+            postings.pop(character_id, None)
+            if not postings:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+                for trigram in word_trigrams(word):
+                    words_with_trigram = self.trigrams[trigram]
+                    words_with_trigram.discard(word)
+                    if not words_with_trigram:
+                        del self.trigrams[trigram]
+
+    def expand(self, query_word):
+        """Returns the indexed words matching a query word, as a dictionary of
+        word -> match quality: 1 for the word itself, PREFIX_QUALITY for words
+        starting with it and, if neither exists, up to FUZZY_QUALITY for words
+        with similar trigrams."""
+        matches = {}
+        if query_word in self.postings:
+            matches[query_word] = 1.0
+        start = bisect_left(self.words, query_word)
+        for word in self.words[start:start + self.MAX_EXPANSIONS + 1]:
+            if not word.startswith(query_word):
+                break
+            matches.setdefault(word, self.PREFIX_QUALITY)
+        if matches or len(query_word) < 3:
+            return matches
+
+        query_trigrams = word_trigrams(query_word)
+        shared = {}
+        for trigram in query_trigrams:
+            for word in self.trigrams.get(trigram, ()):
+                shared[word] = shared.get(word, 0) + 1
+        for word, count in shared.items():
+            similarity = 2 * count / (len(query_trigrams) + len(word_trigrams(word)))
+            if similarity >= self.FUZZY_THRESHOLD:
+                matches[word] = self.FUZZY_QUALITY * similarity
+        return dict(heapq.nlargest(self.MAX_EXPANSIONS, matches.items(), key=lambda match: match[1]))
+
+    def search(self, query, limit):
+        """Returns a (total, ids) tuple for the characters matching every word
+        of the query, with the ids of the best limit matches ordered by
+        relevance. A character's score for a query word is the best match
+        quality times the attribute weight times the inverse document frequency
+        of the matched word, so rare words count more than common ones."""
+        query_words = words(query)
+        if not query_words:
+            return 0, []
+
+        scores = None
+        for query_word in dict.fromkeys(query_words):
+            word_scores = {}
+            for word, quality in self.expand(query_word).items():
+                postings = self.postings[word]
+                idf = math.log(1 + self.size / len(postings))
+                for character_id, weight in postings.items():
+                    score = quality * weight * idf
+                    if score > word_scores.get(character_id, 0):
+                        word_scores[character_id] = score
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {character_id: score + word_scores[character_id]
+                          for character_id, score in scores.items() if character_id in word_scores}
+            if not scores:
+                return 0, []
+
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return len(scores), [character_id for character_id, _ in best]
+
+
+class FieldStats:
+    """Running aggregates of one character attribute: the number of characters
+    per distinct value, plus the count and sum of the integer values. They are
+    updated as characters are added and removed, and the statistics are
+    derived from the distinct values, so they cost nothing per character."""
+
+    def __init__(self):
+        self.counts = {}       # value -> number of characters with that value
+        self.number_count = 0  # number of integer values
+        self.number_sum = 0    # sum of the integer values
+
+    def add(self, value, count=1):
+        """Counts a character's attribute value (or count characters with that value)."""
+        self.counts[value] = self.counts.get(value, 0) + count
+        if type(value) is int:
+            self.number_count += count
+            self.number_sum += value * count
+
+    def remove(self, value):
+        """Uncounts a character's attribute value."""
+        count = self.counts.get(value, 0) - 1
+        if count < 0:
+            return
+        if count:
+            self.counts[value] = count
+        else:
+            del self.counts[value]
+        if type(value) is int:
+            self.number_count -= 1
+            self.number_sum -= value
+
+    def copy(self):
+        """Returns an independent copy of the aggregates."""
+        copy = FieldStats()
+        copy.counts = dict(self.counts)
+        copy.number_count = self.number_count
+        copy.number_sum = self.number_sum
+        return copy
+
+    def groups(self):
+        """Returns a list of {'value', 'count'} dictionaries, most common value
+        first (equal counts are ordered by value, with missing values last)."""
+        return [{'value': value, 'count': count} for value, count in
+                sorted(self.counts.items(), key=lambda item: (-item[1],) + SortOrder.entry(0, item[0])[:3])]
+
+    def summary(self, bucket_size=10):
+        """Returns the count, min, max and mean of the integer values, the
+        number of missing values and a histogram of the integer values in
+        buckets of bucket_size (only non-empty buckets are listed)."""
+        numbers = [value for value in self.counts if type(value) is int]
+        histogram = {}
+        for value in numbers:
+            start = value // bucket_size * bucket_size
+            histogram[start] = histogram.get(start, 0) + self.counts[value]
+        return {
+            'count': self.number_count,
+            'missing': self.counts.get(None, 0),
+            'min': min(numbers, default=None),
+            'max': max(numbers, default=None),
+            'mean': round(self.number_sum / self.number_count, 2) if self.number_count else None,
+            'histogram': [{'from': start, 'to': start + bucket_size - 1, 'count': histogram[start]}
+                          for start in sorted(histogram)]
+        }
@@ -0,0 +1,165 @@
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Durations of the spans of the current request, or None outside of requests
+_spans = contextvars.ContextVar('spans', default=None)
+
+
+def start_spans():
+    """Starts collecting the spans of the current request."""
+    _spans.set({})
+
+
+def collect_spans():
+    """Stops collecting spans and returns the total seconds spent in each kind
+    of span during the current request."""
+    spans = _spans.get() or {}
+    _spans.set(None)
+    return spans
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block as part of the current request (e.g. 'auth',
+    'filter', 'serialize'). Spans of the same name add up. Outside of a
+    request nothing is recorded."""
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[name] = spans.get(name, 0) + time.perf_counter() - start
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their sum and count."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels):
+    """Returns the labels (a tuple of (name, value) pairs) in the Prometheus
+    text format, e.g. '{route="/api/characters"}'."""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """Registry of counters and latency histograms, each identified by a
+    metric name and a tuple of (label, value) pairs. render() returns them
+    in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._help = {}        # name -> (type, description)
+        self._lock = threading.Lock()
+
+    def describe(self, name, metric_type, description):
+        self._help[name] = (metric_type, description)
+
+    def increment(self, name, labels=(), amount=1):
+        with self._lock:
+            self._counters[name, labels] = self._counters.get((name, labels), 0) + amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = Histogram()
+            histogram.observe(value)
+
+    def render(self, gauges=()):
+        """Returns all the metrics as text. gauges is a list of (name, type,
+        description, value) tuples for values read from elsewhere (e.g. the
+        token cache statistics), which are rendered after the others."""
+        lines = []
+        described = set()
+
+        def header(name, metric_type, description):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(((key, histogram.counts[:], histogram.sum, histogram.count)
+                                 for key, histogram in self._histograms.items()), key=lambda item: item[0])
+
+        for (name, labels), value in counters:
+            header(name, *self._help.get(name, ('counter', name)))
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), counts, total, count in histograms:
+            header(name, *self._help.get(name, ('histogram', name)))
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for name, metric_type, description, value in gauges:
+            header(name, metric_type, description)
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Statistical profiler for a single request: a background thread takes a
+    snapshot of the request thread's stack every 'interval' seconds and counts
+    how often each stack was seen. Unlike cProfile it adds no overhead to the
+    profiled code and can run in several threads at once. collapsed() returns
+    the stacks in the folded format read by flame graph tools."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}  # 'outer;...;inner' -> number of samples
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self):
+        """Returns one 'stack count' line per sampled stack, most frequent first."""
+        return ''.join(f"{stack} {count}\n" for stack, count in
+                       sorted(self.stacks.items(), key=lambda item: -item[1]))
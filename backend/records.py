@@ -0,0 +1,545 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Sequence
+
+# Marks the value of an attribute a character does not have
+MISSING = object()
+
+# Next wider typecode for the code arrays of dictionary columns
+WIDER_CODES = {'B': 'H', 'H': 'I', 'I': 'Q'}
+
+# Number of records materialized at a time when iterating over a RecordList
+ITERATION_CHUNK_SIZE = 1000
+
+
+class DictionaryColumn:
+    """Column of a low-cardinality attribute (e.g. house or role). Each
+    distinct value is stored once in a dictionary, and each row only stores
+    the value's code in an array, using one byte per row while there are
+    fewer than 255 distinct values (the array is widened when the dictionary
+    grows). Code 0 marks a missing value. Only strings, integers and None are
+    encoded; encode() returns None for other values, which the table keeps
+    with the row's extra attributes."""
+
+    def __init__(self, values=None, codes=None):
+        self.values = [MISSING] if values is None else values  # code -> value
+        self.lookup = {value: code for code, value in enumerate(self.values)  # value -> code
+                       if code and (value is None or type(value) is str or type(value) is int)}
+        self.codes = array('B') if codes is None else codes
+
+    def encode(self, value):
+        """Returns the code of a value, adding the value to the dictionary if
+        needed, or None if the value cannot be encoded."""
+        if value is not None and type(value) is not str and type(value) is not int:
+            return None
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            if code >= 1 << (8 * self.codes.itemsize):
+                self.codes = array(WIDER_CODES[self.codes.typecode], self.codes)
+            self.values.append(value)
+            self.lookup[value] = code
+        return code
+
+    def append(self, value):
+        """Appends a row; returns False if the value must be kept elsewhere."""
+        code = self.encode(value) if value is not MISSING else 0
+        self.codes.append(code or 0)
+        return code is not None
+
+    def set(self, row, value):
+        """Sets a row's value; returns False if it must be kept elsewhere."""
+        code = self.encode(value)
+        self.codes[row] = code or 0
+        return code is not None
+
+    def clear(self, row):
+        self.codes[row] = 0
+
+    def get(self, row):
+        return self.values[self.codes[row]]
+
+    def take(self, rows):
+        """Keeps only the given rows, in the given order."""
+        codes = self.codes
+        self.codes = array(codes.typecode, [codes[row] for row in rows])
+
+    def truncate(self, length):
+        del self.codes[length:]
+
+    def copy(self):
+        return DictionaryColumn(self.values[:], array(self.codes.typecode, self.codes))
+
+    def column_values(self, rows=None):
+        """Returns the values of the given rows (all rows by default) as a list."""
+        values = self.values
+        codes = self.codes if rows is None else [self.codes[row] for row in rows]
+        return [values[code] for code in codes]
+
+    def matcher(self, check):
+        """Returns a function telling if a row's value passes check(value). The
+        check runs once per distinct value, not once per row. Rows with a
+        missing value return None, as their value may be kept elsewhere."""
+        codes, values = self.codes, self.values
+        results = {}
+
+        def match(row):
+            code = codes[row]
+            if not code:
+                return None
+            result = results.get(code)
+            if result is None:
+                result = results[code] = check(values[code])
+            return result
+        return match
+
+    def value_counts(self, rows):
+        """Returns a tuple of ({value: number of rows}, rows with a missing value)."""
+        codes, values = self.codes, self.values
+        counts = Counter(map(codes.__getitem__, rows))
+        missing = [row for row in rows if not codes[row]] if counts.pop(0, 0) else []
+        return {values[code]: count for code, count in counts.items()}, missing
+
+
+class MappedColumn(DictionaryColumn):
+    """Read-only dictionary column of a table opened from a snapshot (see
+    snapshot.py). The codes are a memoryview of the memory-mapped file and
+    values is a SnapshotValues, which decodes values when they are first
+    read. The table replaces it with a DictionaryColumn or a PlainColumn
+    before its first change."""
+
+    def __init__(self, codes, values):
+        self.values = values
+        self.lookup = None
+        self.codes = codes
+
+    def column_values(self, rows=None):
+        if rows is None:
+            values = self.values.tolist()
+            return [values[code] for code in self.codes]
+        values, codes = self.values, self.codes
+        return [values[codes[row]] for row in rows]
+
+    def copy(self):
+        return self
+
+    def thaw(self, dictionary):
+        """Returns a writable copy, a DictionaryColumn if dictionary is true
+        and a PlainColumn otherwise."""
+        if dictionary:
+            return DictionaryColumn(self.values.tolist()[:], array(self.codes.format, self.codes.tobytes()))
+        return PlainColumn(self.column_values())
+
+
+class PlainColumn:
+    """Column of a high-cardinality attribute (e.g. name), kept as a list of
+    values with one entry per row."""
+
+    def __init__(self, values=None):
+        self.values = [] if values is None else values
+
+    def append(self, value):
+        self.values.append(value)
+        return True
+
+    def set(self, row, value):
+        self.values[row] = value
+        return True
+
+    def clear(self, row):
+        self.values[row] = MISSING
+
+    def get(self, row):
+        return self.values[row]
+
+    def take(self, rows):
+        values = self.values
+        self.values = [values[row] for row in rows]
+
+    def truncate(self, length):
+        del self.values[length:]
+
+    def copy(self):
+        return PlainColumn(self.values[:])
+
+    def column_values(self, rows=None):
+        if rows is None:
+            return self.values[:]
+        values = self.values
+        return [values[row] for row in rows]
+
+    def matcher(self, check):
+        values = self.values
+
+        def match(row):
+            value = values[row]
+            return None if value is MISSING else check(value)
+        return match
+
+    def value_counts(self, rows):
+        values = self.values
+        counts = Counter(map(values.__getitem__, rows))
+        missing = [row for row in rows if values[row] is MISSING] if counts.pop(MISSING, 0) else []
+        return dict(counts), missing
+
+
+class CharacterTable:
+    """Compact in-memory store of the characters. Instead of one dictionary
+    per character, each attribute listed in fields is a column with one entry
+    per row: a DictionaryColumn for the attributes listed in
+    dictionary_fields, a PlainColumn for the others. The ids are kept in an
+    array, and any other attribute of a character (or a value a dictionary
+    column cannot encode) is kept in a per-character dictionary of extras.
+    Characters are materialized into new dictionaries only when they are
+    read, e.g. to be serialized.
+
+    Rows are in insertion order, so the row of a character is also its
+    position in the file. While the ids are in ascending order (as when every
+    new character gets the next id) the row of an id is found in the id array
+    itself, by its offset from the first id or else by bisection; otherwise a
+    dictionary maps ids to rows. Deleted rows are left in place until the
+    next read by position, which compacts the table, except at the end of
+    the table where they are dropped right away, so last_id() is a lookup.
+
+    from_snapshot() opens a table over a memory-mapped snapshot without
+    copying it; the ids and columns are copied into arrays and lists on the
+    first change."""
+
+    def __init__(self, fields=(), dictionary_fields=()):
+        self.fields = list(fields)
+        self.dictionary_fields = set(dictionary_fields)
+        self._columns = {field: DictionaryColumn() if field in self.dictionary_fields else PlainColumn()
+                         for field in self.fields}
+        self._ids = array('q')
+        self._rows = None     # id -> row, once the ids are not in ascending order
+        self._extras = {}     # id -> {attribute: value} of the attributes not kept in columns
+        self._deleted = set()  # rows of the deleted characters until the table is compacted
+        self._mapped = False  # True while the ids and columns are views of a snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot, fields=(), dictionary_fields=()):
+        """Returns a table over a Snapshot (see snapshot.py), with a column
+        for each attribute of the snapshot, in the snapshot's order, and for
+        each of the given fields."""
+        table = cls((), dictionary_fields)
+        table.fields = list(dict.fromkeys(snapshot.fields + list(fields)))
+        table._columns = {field: MappedColumn(*snapshot.column(field, MISSING)) for field in table.fields}
+        table._ids = snapshot.ids
+        table._mapped = True
+        if not snapshot.ascending:
+            table._map_rows()
+        return table
+
+    def _thaw(self):
+        """Copies a table opened from a snapshot into writable columns."""
+        if not self._mapped:
+            return
+        self._ids = array('q', self._ids.tobytes())
+        self._columns = {field: column.thaw(field in self.dictionary_fields)
+                         for field, column in self._columns.items()}
+        self._mapped = False
+
+    def copy(self):
+        """Returns an independent copy of the table. Columns and ids still
+        mapped from a snapshot are read-only and shared."""
+        table = CharacterTable((), self.dictionary_fields)
+        table.fields = self.fields[:]
+        table._columns = {field: column.copy() for field, column in self._columns.items()}
+        table._ids = self._ids if self._mapped else array('q', self._ids)
+        table._rows = None if self._rows is None else dict(self._rows)
+        table._extras = {character_id: dict(extras) for character_id, extras in self._extras.items()}
+        table._deleted = set(self._deleted)
+        table._mapped = self._mapped
+        return table
+
+    def __len__(self):
+        return len(self._ids) - len(self._deleted)
+
+    def __contains__(self, character_id):
+        return self._row(character_id) is not None
+
+    def _row(self, character_id):
+        """Returns the row of a stored character, or None."""
+        if self._rows is not None:
+            return self._rows.get(character_id)
+        ids = self._ids
+        if type(character_id) is not int or not ids:
+            return None
+        row = character_id - ids[0]
+        if not (0 <= row < len(ids) and ids[row] == character_id):
+            row = bisect_left(ids, character_id)
+            if row == len(ids) or ids[row] != character_id:
+                return None
+        return None if row in self._deleted else row
+
+    def _map_rows(self):
+        """Switches to a dictionary from ids to rows."""
+        self._rows = {character_id: row for row, character_id in enumerate(self._ids)
+                      if row not in self._deleted}
+
+    def ids(self):
+        """Returns the ids of the characters in file order."""
+        self.compact()
+        return self._ids.tolist()
+
+    def position(self, character_id):
+        """Returns a number ordering the character by its position in the file."""
+        return self._row(character_id)
+
+    def add(self, character):
+        """Appends a character (a dictionary with an 'id') to the table. The
+        values are copied, so the dictionary is not kept."""
+        self._thaw()
+        character_id = character['id']
+        if self._row(character_id) is not None:
+            self.delete(character_id)
+        row = len(self._ids)
+        if self._rows is None and row and character_id <= self._ids[-1]:
+            self._map_rows()
+        self._ids.append(character_id)
+        if self._rows is not None:
+            self._rows[character_id] = row
+
+        extras = {}
+        present = 0
+        for field, column in self._columns.items():
+            value = character.get(field, MISSING)
+            if value is not MISSING:
+                present += 1
+            if not column.append(value):
+                extras[field] = value
+        if len(character) - 1 > present:
+            extras.update((field, value) for field, value in character.items()
+                          if field != 'id' and field not in self._columns)
+        if extras:
+            self._extras[character_id] = extras
+
+    def set(self, character_id, field, value):
+        """Sets one attribute of a stored character."""
+        self._thaw()
+        row = self._row(character_id)
+        column = self._columns.get(field)
+        extras = self._extras.get(character_id)
+        if column is not None and column.set(row, value):
+            if extras is not None and field in extras:
+                del extras[field]
+                if not extras:
+                    del self._extras[character_id]
+            return
+        self._extras.setdefault(character_id, {})[field] = value
+
+    def delete(self, character_id):
+        """Removes a character. Returns False if it is not stored."""
+        row = self._row(character_id)
+        if row is None:
+            return False
+        self._thaw()
+        if self._rows is not None:
+            del self._rows[character_id]
+        for column in self._columns.values():
+            column.clear(row)
+        self._extras.pop(character_id, None)
+        self._deleted.add(row)
+        if row == len(self._ids) - 1:
+            while row >= 0 and row in self._deleted:
+                self._deleted.remove(row)
+                row -= 1
+            del self._ids[row + 1:]
+            for column in self._columns.values():
+                column.truncate(row + 1)
+        return True
+
+    def last_id(self):
+        """Returns the highest id stored (0 if the table is empty). While the
+        ids are in ascending order this is the id of the last row."""
+        if self._rows is not None:
+            return max(self._rows, default=0)
+        return self._ids[-1] if self._ids else 0
+
+    def compact(self):
+        """Drops the rows of deleted characters."""
+        if not self._deleted:
+            return
+        rows = [row for row in range(len(self._ids)) if row not in self._deleted]
+        for column in self._columns.values():
+            column.take(rows)
+        self._ids = array('q', [self._ids[row] for row in rows])
+        self._deleted = set()
+        if self._rows is not None:
+            self._map_rows()
+
+    def field_values(self, field):
+        """Returns an attribute of all the characters in file order (None for
+        those without it), e.g. to build an index."""
+        self.compact()
+        if field == 'id':
+            return self._ids.tolist()
+        column = self._columns.get(field)
+        if column is None:
+            return [self._extras.get(character_id, {}).get(field) for character_id in self._ids]
+        values = column.column_values()
+        if MISSING in values:
+            values = [self.value(character_id, field) if value is MISSING else value
+                      for character_id, value in zip(self._ids, values)]
+        return values
+
+    def value(self, character_id, field):
+        """Returns one attribute of a stored character (None if it has none)."""
+        if field == 'id':
+            return character_id
+        column = self._columns.get(field)
+        if column is not None:
+            value = column.get(self._row(character_id))
+            if value is not MISSING:
+                return value
+        extras = self._extras.get(character_id)
+        return extras.get(field) if extras else None
+
+    def getter(self, field):
+        """Returns a function returning the given attribute of a character by
+        id, like value() but with the column looked up once."""
+        if field == 'id':
+            return lambda character_id: character_id
+        column, row_of, extras = self._columns.get(field), self._row, self._extras
+        if column is None:
+            return lambda character_id: extras.get(character_id, {}).get(field)
+
+        def get(character_id):
+            value = column.get(row_of(character_id))
+            if value is MISSING:
+                return extras.get(character_id, {}).get(field)
+            return value
+        return get
+
+    def matcher(self, field, check):
+        """Returns a function telling if an attribute of a character (by id)
+        passes check(value). For a dictionary column the check only runs
+        once per distinct value."""
+        column, row_of, extras = self._columns.get(field), self._row, self._extras
+        if column is None:
+            return lambda character_id: check(extras.get(character_id, {}).get(field))
+        match = column.matcher(check)
+
+        def matches(character_id):
+            result = match(row_of(character_id))
+            if result is None:
+                return check(extras.get(character_id, {}).get(field))
+            return result
+        return matches
+
+    def value_counts(self, field, character_ids):
+        """Returns {value: number of characters} of an attribute over the given
+        characters, counting dictionary codes instead of values."""
+        column = self._columns.get(field)
+        if column is None:
+            return dict(Counter(self.value(character_id, field) for character_id in character_ids))
+        counts, missing = column.value_counts(list(map(self._row, character_ids)))
+        for row in missing:
+            value = self.value(self._ids[row], field)
+            counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def get(self, character_id):
+        """Returns a stored character as a new dictionary, or None."""
+        row = self._row(character_id)
+        if row is None:
+            return None
+        character = {'id': character_id}
+        for field, column in self._columns.items():
+            value = column.get(row)
+            if value is not MISSING:
+                character[field] = value
+        extras = self._extras.get(character_id)
+        if extras:
+            character.update(extras)
+        return character
+
+    def records(self, character_ids=None, fields=None):
+        """Materializes characters (all of them by default, in file order)
+        into a list of new dictionaries. With fields only those attributes
+        are included, and attributes a character does not have are None."""
+        if character_ids is None:
+            self.compact()
+            return self._materialize(self._ids.tolist(), None, fields)
+        character_ids = list(character_ids)
+        return self._materialize(character_ids, list(map(self._row, character_ids)), fields)
+
+    def slice(self, start, stop, fields=None):
+        """Materializes the characters at positions start to stop (see records())."""
+        self.compact()
+        rows = range(len(self._ids))[start:stop]
+        if len(rows) == len(self._ids):
+            rows = None  # Whole columns are read faster
+        return self._materialize(self._ids[start:stop].tolist(), rows, fields)
+
+    def _materialize(self, ids, rows, fields):
+        """Builds the dictionaries of the characters with the given ids,
+        stored in the given rows (None for all rows), column by column."""
+        keys = [field for field in (self.fields if fields is None else fields) if field in self._columns]
+        columns = [ids] + [self._columns[field].column_values(rows) for field in keys]
+        keys = ['id'] + keys
+        if fields is not None and 'id' not in fields:
+            del keys[0], columns[0]
+
+        if any(MISSING in column for column in columns if column is not ids):
+            records = [{key: value for key, value in zip(keys, values) if value is not MISSING}
+                       for values in zip(*columns)]
+        else:
+            records = [dict(zip(keys, values)) for values in zip(*columns)]
+
+        if self._extras:
+            for character_id, record in zip(ids, records):
+                extras = self._extras.get(character_id)
+                if extras:
+                    record.update(extras if fields is None else
+                                  {field: value for field, value in extras.items() if field in fields})
+        if fields is not None:
+            for record in records:
+                for field in fields:
+                    record.setdefault(field, None)
+        return records
+
+
+class RecordList(Sequence):
+    """Read-only list view of the characters of a CharacterTable in file
+    order, as returned by the repository. Items are materialized into new
+    dictionaries when they are read, a chunk at a time when iterating, and
+    materialize() builds them all at once, e.g. to serialize them. The
+    table is read under the repository's lock. freeze() switches a view to
+    a copy of the table, so it keeps the characters it had when the table
+    changes."""
+
+    def __init__(self, table, lock):
+        self._table = table
+        self._lock = lock
+
+    def freeze(self, table):
+        """Reads from the given copy of the table from now on."""
+        with self._lock:
+            self._table = table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, index):
+        with self._lock:
+            if isinstance(index, slice):
+                if index.step not in (None, 1):
+                    return self._table.records()[index]
+                return self._table.slice(index.start, index.stop)
+            if index < 0:
+                index += len(self._table)
+            if not 0 <= index < len(self._table):
+                raise IndexError('record index out of range')
+            return self._table.slice(index, index + 1)[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), ITERATION_CHUNK_SIZE):
+            yield from self[start:start + ITERATION_CHUNK_SIZE]
+
+    def materialize(self, fields=None):
+        """Returns all the characters as a list of dictionaries (see
+        CharacterTable.records())."""
+        with self._lock:
+            return self._table.records(fields=fields)
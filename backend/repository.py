@@ -0,0 +1,555 @@
+from collections import Counter
+import hashlib
+import heapq
+from itertools import islice
+import math
+import threading
+import time
+import weakref
+from indexes import AttributeIndex, FieldStats, SearchIndex, SortOrder, select_ids
+from metrics import span
+from records import CharacterTable, RecordList
+from storage import JsonCharacterStorage, JsonUserStorage
+
+
+class CharacterRepository:
+    """In-memory view of the stored characters. The loaded list is kept
+    between requests and is only re-loaded when the storage's stamp changes
+    (for the JSON file, its modification time or size), so read routes do not
+    parse the data on every call. Writes go through the repository, which
+    persists them with the storage (see storage.py) and then records the new
+    stamp so its own writes do not trigger a reload. Writes hold the storage's
+    inter-process write lock and reload stale data first, so several worker
+    processes can write without losing updates or reusing ids. A file path
+    can be passed instead of a storage for the JSON file storage.
+
+    The characters are kept in a compact CharacterTable (see records.py)
+    with one column per attribute, where the attributes listed in
+    dictionary_fields are dictionary-encoded, and are only materialized into
+    dictionaries when they are returned. The table maps ids to rows and the
+    highest id in use is tracked, so lookups, updates, deletes and id
+    allocation do not scan the whole list. New characters get the highest id
+    in use plus one, like after a reload or in another process, so the id of
+    a deleted last character is given again. If the storage has a snapshot
+    (see snapshot.py) the table is opened over it instead of parsing the
+    JSON file, so a (re)load does not depend on the number of characters.
+
+    The attributes listed in indexed_fields get a secondary index and a
+    presorted order (see indexes.py) used by find() and query(); a presorted
+    order by id is kept for keyset pagination. The indexed attributes also
+    have running value counts (FieldStats) used by stats(). search_fields
+    maps the attributes used by search() to their weight in the relevance
+    ranking. Each index is built from the table the first time it is used
+    after a load and then kept up to date on every write, so a load only
+    pays for the indexes the requests actually need.
+
+    With a change_feed (see changes.py) every persisted change is also
+    appended to the feed while the storage's write lock is held, so the
+    sequence numbers follow the order of the writes in all processes."""
+
+    def __init__(self, storage='characters.json', indexed_fields=(), search_fields=None, dictionary_fields=(),
+                 change_feed=None):
+        if isinstance(storage, str):
+            storage = JsonCharacterStorage(storage)
+        self.storage = storage
+        self.change_feed = change_feed
+        self._lock = threading.RLock()
+        self.indexed_fields = list(indexed_fields)
+        self.search_fields = dict(search_fields or {})
+        self.dictionary_fields = list(dictionary_fields)
+        self._fields = list(dict.fromkeys(self.indexed_fields + list(self.search_fields) + self.dictionary_fields))
+        self._table = CharacterTable(self._fields, self.dictionary_fields)
+        self._records = RecordList(self._table, self._lock)
+        self._versioned = weakref.WeakSet()  # Views returned by versioned_all() still in use
+        self._max_id = 0
+        self._indexes = {}
+        self._orders = {}
+        self._stats = {}
+        self._search = None
+        self._stamp = None
+        self._modified_at = 0
+
+    def _load(self):
+        """Reloads the data from the storage if it changed since the last read."""
+        stamp = self.storage.stamp()
+        if stamp is not None and stamp == self._stamp:
+            return
+        with self._lock:
+            stamp = self.storage.stamp()
+            if stamp is not None and stamp == self._stamp:
+                return
+            with span('storage_read'):
+                snapshot, characters = self._read()
+                if self.storage.stamp() != stamp:
+                    # A write landed while reading, so the data may be newer than the
+                    # stamp; it is read again with the writers held off
+                    with self.storage.write_lock():
+                        stamp = self.storage.stamp()
+                        snapshot, characters = self._read()
+            with span('index_build'):
+                self._build(characters, snapshot)
+            self._stamp = stamp
+
+    def _read(self):
+        """Returns a (snapshot, characters) tuple read from the storage, with
+        characters None if there is a snapshot."""
+        snapshot = self.storage.load_snapshot()
+        return snapshot, self.storage.load() if snapshot is None else None
+
+    def _build(self, characters, snapshot=None):
+        """Rebuilds the table from a freshly loaded list of characters, which
+        is not kept, or from a snapshot, and drops the indexes."""
+        if snapshot is not None:
+            self._table = CharacterTable.from_snapshot(snapshot, self._fields, self.dictionary_fields)
+        else:
+            # The columns follow the attribute order of the file, which rewrites then keep
+            order = {field: position for position, field in enumerate(characters[0])} if characters else {}
+            fields = sorted(self._fields, key=lambda field: order.get(field, len(order)))
+            self._table = CharacterTable(fields, self.dictionary_fields)
+            for character in characters:
+                self._table.add(character)
+        self._records = RecordList(self._table, self._lock)
+        self._versioned = weakref.WeakSet()  # The lists of the old table keep reading it
+        self._max_id = max(self._table.ids(), default=0)
+        self._modified_at = time.time()
+        self._indexes = {}
+        self._orders = {}
+        self._stats = {}
+        self._search = None
+
+    def _attribute_index(self, field):
+        """Returns the AttributeIndex of an attribute, built on first use."""
+        index = self._indexes.get(field)
+        if index is None:
+            with span('index_build'):
+                index = AttributeIndex()
+                index.build(zip(self._table.ids(), self._table.field_values(field)))
+                self._indexes[field] = index
+        return index
+
+    def _order(self, field):
+        """Returns the SortOrder of an attribute, built on first use."""
+        order = self._orders.get(field)
+        if order is None:
+            with span('index_build'):
+                order = SortOrder()
+                order.build(zip(self._table.ids(), self._table.field_values(field)))
+                self._orders[field] = order
+        return order
+
+    def _field_stats(self, field):
+        """Returns the running FieldStats of an attribute, built on first use."""
+        stats = self._stats.get(field)
+        if stats is None:
+            with span('index_build'):
+                stats = FieldStats()
+                for value, count in Counter(self._table.field_values(field)).items():
+                    stats.add(value, count)
+                self._stats[field] = stats
+        return stats
+
+    def _search_index(self):
+        """Returns the SearchIndex, built on first use."""
+        if self._search is None:
+            with span('index_build'):
+                fields = list(self.search_fields)
+                search = SearchIndex(self.search_fields)
+                columns = [self._table.field_values(field) for field in fields]
+                search.build((character_id, dict(zip(fields, values)))
+                             for character_id, *values in zip(self._table.ids(), *columns))
+                self._search = search
+        return self._search
+
+    def _select(self, filters):
+        """Returns the set of ids matching the filters (see find())."""
+        indexes = {field: self._attribute_index(field) for field, *_ in filters}
+        return select_ids(indexes, filters, self._table.matcher)
+
+    def _index(self, character):
+        """Adds a character to the attribute indexes built so far."""
+        for field, index in self._indexes.items():
+            index.add(character['id'], character.get(field))
+        for field, order in self._orders.items():
+            order.add(character['id'], character.get(field))
+        for field, stats in self._stats.items():
+            stats.add(character.get(field))
+        if self._search is not None:
+            self._search.add(character['id'], character)
+
+    def _unindex(self, character):
+        """Removes a character from the attribute indexes built so far."""
+        for field, index in self._indexes.items():
+            index.remove(character['id'], character.get(field))
+        for field, order in self._orders.items():
+            order.remove(character['id'], character.get(field))
+        for field, stats in self._stats.items():
+            stats.remove(character.get(field))
+        if self._search is not None:
+            self._search.remove(character['id'], character)
+
+    def _persist(self, operation, argument):
+        """Persists a single change with the storage and refreshes the stamp.
+        If the storage fails (e.g. with a StorageError), the change already made
+        in memory is dropped by reloading the data, and the error is raised."""
+        try:
+            with span('storage_write'):
+                getattr(self.storage, operation)(argument, self._list)
+        except Exception:
+            self._stamp = None
+            self._load()
+            raise
+        if self.change_feed is not None:
+            changes = argument if operation == 'batch' else [(operation, argument)]
+            self.change_feed.append(*(self._change_event(*change) for change in changes))
+        self._stamp = self.storage.stamp()
+        self._modified_at = time.time()
+
+    @staticmethod
+    def _change_event(operation, argument):
+        """Returns the change feed event of a persisted change."""
+        if operation == 'delete':
+            return {'op': 'delete', 'id': argument}
+        return {'op': 'add' if operation == 'insert' else 'update', 'id': argument['id'], 'character': argument}
+
+    def all(self):
+        """Returns a read-only RecordList of all the characters (see
+        records.py), which materializes them when they are read."""
+        self._load()
+        return self._records
+
+    def versioned_all(self):
+        """Returns a (characters, version, modified_at) tuple read together, so
+        the version always describes the returned list. The list is a
+        RecordList that keeps the characters of that version: before the
+        next write changes the table, the lists still in use are frozen on a
+        copy of it (see _freeze_versioned()), so a response serialized later
+        still matches its ETag. The version is a hash
+        of the storage stamp, which changes with every write and is the same in
+        all processes sharing the storage, so it can be used as an ETag.
+        modified_at is the time of the last write or reload seen by this
+        repository, which is never earlier than the actual change."""
+        with self._lock:
+            self._load()
+            characters = RecordList(self._table, self._lock)
+            self._versioned.add(characters)
+            return characters, self._version(), self._modified_at
+
+    def _freeze_versioned(self):
+        """Moves the lists returned by versioned_all() that are still in use
+        to a copy of the table, which is about to change. The table is only
+        copied while a request is still reading an older version."""
+        views = list(self._versioned)
+        self._versioned = weakref.WeakSet()
+        if views:
+            table = self._table.copy()
+            for view in views:
+                view.freeze(table)
+
+    def versioned_get(self, character_id):
+        """Returns a (character, version, modified_at) tuple for the character
+        with the given id (None if not found), like versioned_all()."""
+        with self._lock:
+            self._load()
+            return self._table.get(character_id), self._version(), self._modified_at
+
+    def _version(self):
+        """Returns a short hash of the current storage stamp."""
+        return hashlib.sha1(repr(self._stamp).encode()).hexdigest()[:20]
+
+    def _list(self):
+        """Returns all the characters as a new list of dictionaries, for the
+        storages that rewrite the whole data set."""
+        return self._table.records()
+
+    def get(self, character_id):
+        """Returns the character with the given id as a new dictionary, or
+        None if not found."""
+        with self._lock:
+            self._load()
+            return self._table.get(character_id)
+
+    def find(self, filters):
+        """Returns the characters matching all the filters, in file order.
+        Each filter is a tuple of (field, 'contains', text), matching string
+        values case-insensitively (and integer values equal to the text), or
+        (field, 'range', low, high) matching integer values between low and
+        high, where either bound may be None."""
+        with self._lock:
+            self._load()
+            with span('filter'):
+                ids = self._select(filters)
+            with span('sort'):
+                ids = sorted(ids, key=self._table.position)
+            with span('materialize'):
+                return self._table.records(ids)
+
+    def query(self, filters=(), sort=None, descending=False, skip=0, limit=20, after=None):
+        """Returns a (total, page) tuple for the characters matching the
+        filters (see find()), optionally sorted by an indexed attribute. Only
+        the requested page is ordered: without filters the presorted order is
+        walked up to skip + limit entries, and with filters either the
+        presorted order is walked skipping non-matching ids, or a heap picks
+        the top skip + limit candidates, whichever is estimated cheaper.
+
+        For keyset pagination, after is the (sort value, id) pair of the last
+        character of the previous page; the page then starts right after it,
+        so its cost does not depend on how deep the page is. Without a sort
+        attribute keyset pages are ordered by id."""
+        with self._lock:
+            self._load()
+            table = self._table
+            if after is not None and sort is None:
+                sort = 'id'
+
+            with span('filter'):
+                ids = self._select(filters) if filters else None
+            with span('sort'):
+                total = len(table) if ids is None else len(ids)
+                wanted = skip + limit
+
+                if sort is None:
+                    if ids is None:
+                        with span('materialize'):
+                            return total, table.slice(skip, wanted)
+                    page_ids = heapq.nsmallest(wanted, ids, key=table.position)[skip:]
+                else:
+                    page_ids = self._sorted_page(ids, sort, descending, skip, wanted, after)
+            with span('materialize'):
+                return total, table.records(page_ids)
+
+    def _sorted_page(self, ids, sort, descending, skip, wanted, after):
+        """Returns the ids of a page of the matching ids (all ids if None)
+        ordered by an attribute, see query()."""
+        table = self._table
+        order = self._order(sort).ids(descending, after)
+        if ids is None:
+            return list(islice(order, skip, wanted))
+        if not ids:
+            return []
+        if wanted * len(table) / len(ids) < len(ids) * math.log2(wanted + 1):
+            # Matches are dense enough in the presorted order to find them quickly
+            return list(islice((character_id for character_id in order if character_id in ids), skip, wanted))
+
+        value_of = table.getter(sort)
+
+        def sort_key(character_id):
+            null, is_string, value, _ = SortOrder.entry(character_id, value_of(character_id))
+            # Ties are ordered by ascending id in both directions
+            return null, is_string, value, -character_id if descending else character_id
+
+        if after is not None:
+            null, is_string, value, last_id = SortOrder.entry(after[1], after[0])
+            last = null, is_string, value, -last_id if descending else last_id
+            if descending:
+                ids = [character_id for character_id in ids if sort_key(character_id) < last]
+            else:
+                ids = [character_id for character_id in ids if sort_key(character_id) > last]
+        pick = heapq.nlargest if descending else heapq.nsmallest
+        return pick(wanted, ids, key=sort_key)[skip:]
+
+    def stats(self, fields, filters=()):
+        """Returns a (total, stats) tuple, where stats maps each of the given
+        indexed attributes to its FieldStats (see indexes.py). Without filters
+        these are copies of the running aggregates kept up to date on every
+        write; with filters (see find()) they are computed from the matching
+        characters only, which the indexes select without scanning the
+        others."""
+        with self._lock:
+            self._load()
+            if not filters:
+                return len(self._table), {field: self._field_stats(field).copy() for field in fields}
+            with span('filter'):
+                ids = self._select(filters)
+            with span('aggregate'):
+                stats = {field: FieldStats() for field in fields}
+                for field, field_stats in stats.items():
+                    for value, count in self._table.value_counts(field, ids).items():
+                        field_stats.add(value, count)
+            return len(ids), stats
+
+    def search(self, text, limit=10):
+        """Returns a (total, characters) tuple for a full-text search over the
+        search fields, with the best limit matches ordered by relevance. Words
+        of the text may be incomplete, and misspelled words are matched to
+        similar ones (see SearchIndex in indexes.py)."""
+        with self._lock:
+            self._load()
+            with span('search'):
+                total, ids = self._search_index().search(text, limit)
+            with span('materialize'):
+                return total, self._table.records(ids)
+
+    def add(self, character):
+        """Assigns the next free id to the character, stores and returns it."""
+        with self._lock, self.storage.write_lock():
+            self._load()
+            self._freeze_versioned()
+            self._add(character)
+            self._persist('insert', character)
+            return character
+
+    def update(self, character_id, data):
+        """Updates the given fields of an existing character. Returns the
+        updated character, or None if no character has that id."""
+        with self._lock, self.storage.write_lock():
+            self._load()
+            self._freeze_versioned()
+            character = self._update(character_id, data)
+            if character is not None:
+                self._persist('update', character)
+            return character
+
+    def delete(self, character_id):
+        """Removes the character with the given id. Returns True if a character
+        was deleted and False if it did not exist."""
+        with self._lock, self.storage.write_lock():
+            self._load()
+            self._freeze_versioned()
+            if not self._delete(character_id):
+                return False
+            self._persist('delete', character_id)
+            return True
+
+    def bulk(self, operations):
+        """Applies a list of operations, each one a tuple of ('add', character),
+        ('update', id, data) or ('delete', id), and returns the result of each
+        one as returned by add(), update() and delete(). All the changes are
+        persisted together with the storage's batch(), in a single write, and
+        ids are allocated in order from the highest id in use. Updates and
+        deletes of missing characters change nothing."""
+        with self._lock, self.storage.write_lock():
+            self._load()
+            self._freeze_versioned()
+            results = []
+            changes = []
+            for operation, *args in operations:
+                if operation == 'add':
+                    result = self._add(args[0])
+                    changes.append(('insert', result))
+                elif operation == 'update':
+                    result = self._update(*args)
+                    if result is not None:
+                        changes.append(('update', result))
+                else:
+                    result = self._delete(args[0])
+                    if result:
+                        changes.append(('delete', args[0]))
+                results.append(result)
+            if changes:
+                self._persist('batch', changes)
+            return results
+
+    def _add(self, character):
+        """Adds a character in memory with the next free id."""
+        self._max_id += 1
+        character['id'] = self._max_id
+        self._table.add(character)
+        self._index(character)
+        return character
+
+    def _update(self, character_id, data):
+        """Updates a character in memory, see update()."""
+        character = self._table.get(character_id)
+        if character is None:
+            return None
+        searched = self._search is not None and any(field in self.search_fields for field in data)
+        if searched:
+            self._search.remove(character_id, character)
+        for field, value in data.items():
+            if field == 'id':
+                continue
+            old_value = character.get(field)
+            for index in (self._indexes.get(field), self._orders.get(field)):
+                if index is not None:
+                    index.remove(character_id, old_value)
+                    index.add(character_id, value)
+            stats = self._stats.get(field)
+            if stats is not None:
+                stats.remove(old_value)
+                stats.add(value)
+            self._table.set(character_id, field, value)
+            character[field] = value
+        if searched:
+            self._search.add(character_id, character)
+        return character
+
+    def _delete(self, character_id):
+        """Removes a character in memory, see delete()."""
+        character = self._table.get(character_id)
+        if character is None:
+            return False
+        self._unindex(character)
+        self._table.delete(character_id)
+        if character_id == self._max_id:
+            self._max_id = self._table.last_id()
+        return True
+
+
+class UserRepository:
+    """In-memory directory of the stored users keyed by username, reloaded only
+    when the storage's stamp changes (like CharacterRepository), so a login is
+    a dictionary lookup. New users are persisted one at a time through the
+    storage's insert(), which for the journaled and SQLite storages does not
+    rewrite the other users. A file path can be passed instead of a storage
+    for the JSON file storage."""
+
+    def __init__(self, storage='users.json'):
+        if isinstance(storage, str):
+            storage = JsonUserStorage(storage)
+        self.storage = storage
+        self._users = {}
+        self._stamp = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        """Reloads the users from the storage if they changed since the last read."""
+        stamp = self.storage.stamp()
+        if stamp is not None and stamp == self._stamp:
+            return
+        with self._lock:
+            stamp = self.storage.stamp()
+            if stamp is not None and stamp == self._stamp:
+                return
+            with span('storage_read'):
+                self._users = self.storage.load() or {}
+            self._stamp = stamp
+
+    def get(self, username):
+        """Returns the user with the given username, or None if not found."""
+        self._load()
+        return self._users.get(username)
+
+    def add(self, username, user):
+        """Stores a new user. Returns False if the username is already taken."""
+        with self._lock, self.storage.write_lock():
+            self._load()
+            if username in self._users:
+                return False
+            self._users[username] = user
+            self._persist(username, user)
+            return True
+
+    def replace_password(self, username, old_password, new_password):
+        """Replaces a user's stored password, unless it is no longer old_password
+        (e.g. it was changed by another request in the meantime)."""
+        with self._lock, self.storage.write_lock():
+            self._load()
+            user = self._users.get(username)
+            if user is None or user['password'] != old_password:
+                return False
+            user = self._users[username] = dict(user, password=new_password)
+            self._persist(username, user)
+            return True
+
+    def _persist(self, username, user):
+        """Persists a single user with the storage and refreshes the stamp. If
+        the storage fails, the users are reloaded (see
+        CharacterRepository._persist()) and the error is raised."""
+        try:
+            with span('storage_write'):
+                self.storage.insert(username, user, lambda: self._users)
+        except Exception:
+            self._stamp = None
+            self._load()
+            raise
+        self._stamp = self.storage.stamp()
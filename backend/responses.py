@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import gzip
+import threading
+from flask.json.provider import DefaultJSONProvider
+from metrics import span
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Only gzip is offered
+    brotli = None
+
+# Content codings offered to clients, in order of preference
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+# Compression levels of bodies compressed per request, and of cached bodies,
+# which are compressed once per dataset version and can afford the best ratio
+DYNAMIC_LEVELS = {'br': 4, 'gzip': 6}
+CACHED_LEVELS = {'br': 11, 'gzip': 9}
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson'}
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson when it is installed,
+    which is several times faster than the standard library for large lists
+    of characters. Keys are still sorted like with the default provider.
+    Calls with options orjson does not support (e.g. the indentation used in
+    debug mode) and values it cannot serialize are handed to the default
+    provider."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and kwargs in ({}, {'separators': (',', ':')}):
+            option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+            try:
+                return orjson.dumps(obj, default=self.default, option=option).decode()
+            except TypeError:  # orjson.JSONEncodeError, e.g. integers above 64 bits
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        with span('serialize'):
+            return super().response(*args, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+
+def negotiate_encoding(accept_encodings):
+    """Returns the preferred content coding accepted by the client (from the
+    request's parsed Accept-Encoding header), or None for no compression."""
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(body, encoding, levels=DYNAMIC_LEVELS):
+    """Compresses a body (bytes) with the given content coding."""
+    with span('compress'):
+        if encoding == 'br':
+            return brotli.compress(body, quality=levels['br'])
+        return gzip.compress(body, compresslevel=levels['gzip'], mtime=0)
+
+
+def compress_response(response, encoding, min_size):
+    """Compresses a complete JSON response in place if the client accepts an
+    encoding and the body is at least min_size bytes long. Streamed responses
+    and responses that already have a Content-Encoding are left alone."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    if response.content_length is None or response.content_length < min_size:
+        return response
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not etag.endswith('-' + encoding):
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+class BodyCache:
+    """Serialized response bodies of the current dataset version, uncompressed
+    and in each content coding that was asked for. The bodies are built on
+    first use and dropped as soon as a request sees a newer version, so a
+    repeated request for the same data only copies bytes from memory. At most
+    max_variants variants (e.g. the full list and its projections on some
+    fields) are kept, the least recently used one being dropped first, so
+    clients asking for many projections cannot hold a copy of the dataset
+    each."""
+
+    def __init__(self, max_variants=8):
+        self.max_variants = max_variants
+        self._version = None
+        self._bodies = OrderedDict()  # variant -> {encoding: bytes}
+        self._lock = threading.RLock()
+
+    def get(self, version, variant, encoding, serialize):
+        """Returns the body of a variant of the data (e.g. the full list) at a
+        dataset version, compressed with encoding (None for no compression).
+        serialize() returns the uncompressed body if it is not cached yet."""
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._bodies = OrderedDict()
+            bodies = self._bodies.get(variant)
+            if bodies is None:
+                bodies = self._bodies[variant] = {}
+                while len(self._bodies) > self.max_variants:
+                    self._bodies.popitem(last=False)
+            self._bodies.move_to_end(variant)
+            body = bodies.get(encoding)
+            if body is None:
+                if encoding is None:
+                    body = serialize()
+                else:
+                    body = compress(self.get(version, variant, None, serialize), encoding, CACHED_LEVELS)
+                bodies[encoding] = body
+            return body
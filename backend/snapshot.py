@@ -0,0 +1,203 @@
+from array import array
+import json
+import mmap
+import struct
+import sys
+
+# First bytes of a snapshot file
+MAGIC = b'THRNSNAP'
+
+# Version of the snapshot format, bumped on every incompatible change
+SNAPSHOT_VERSION = 1
+
+# Magic, format version and header length
+PREAMBLE = struct.Struct('<8sII')
+
+# Typecodes of the code arrays by number of bytes per code
+CODE_TYPES = {1: 'B', 2: 'H', 4: 'I'}
+
+
+class SnapshotError(ValueError):
+    """Raised when a file is not a snapshot this version can read."""
+
+
+def padded(data, padding=b'\0'):
+    """Returns the bytes padded to a multiple of 8 bytes, so that the block
+    following them is aligned."""
+    return data + padding * (-len(data) % 8)
+
+
+def encode_snapshot(characters, source=None):
+    """Returns the characters (a list of dictionaries with an 'id') in the
+    binary snapshot format. source identifies the JSON file the snapshot was
+    made from (see file_stamp() in storage.py), so readers can tell if it is
+    stale.
+
+    The file starts with MAGIC, the format version and the length of a JSON
+    header describing the blocks that follow, each aligned to 8 bytes: the
+    ids as 64-bit integers, then one column block per attribute holding a
+    fixed-width code per character (1, 2 or 4 bytes, code 0 meaning that
+    the character does not have the attribute), then the string table. Each
+    column has its own range of the string table, where the distinct values
+    of the attribute are stored once, JSON-encoded. The string table is an
+    array of 64-bit offsets followed by the encoded values, each one
+    followed by a comma so that a range of values is decoded with a single
+    json.loads() call. All numbers are in the byte order of the machine that
+    wrote the file."""
+    ids = array('q')
+    columns = {}  # attribute -> (codes, {value key: code}, [values]), in order of first appearance
+    for row, character in enumerate(characters):
+        ids.append(character['id'])
+        for field, value in character.items():
+            if field == 'id':
+                continue
+            column = columns.get(field)
+            if column is None:
+                column = columns[field] = (array('I', bytes(4 * len(characters))), {}, [])
+            codes, lookup, values = column
+            try:
+                key = type(value), value
+                code = lookup.get(key)
+            except TypeError:  # Unhashable values (e.g. lists) are told apart by their encoding
+                key = type(value), json.dumps(value)
+                code = lookup.get(key)
+            if code is None:
+                values.append(value)
+                code = lookup[key] = len(values)
+            codes[row] = code
+
+    blocks = [padded(ids.tobytes())]
+    position = len(blocks[0])
+    header_columns = []
+    strings = []
+    for field, (codes, _, values) in columns.items():
+        width = 1 if len(values) < 1 << 8 else 2 if len(values) < 1 << 16 else 4
+        header_columns.append({'name': field, 'width': width, 'codes': position,
+                               'first': len(strings), 'count': len(values)})
+        strings.extend(values)
+        blocks.append(padded(array(CODE_TYPES[width], codes).tobytes()))
+        position += len(blocks[-1])
+
+    data = [json.dumps(value).encode() + b',' for value in strings]
+    offsets = array('Q', [0])
+    for value in data:
+        offsets.append(offsets[-1] + len(value))
+    blocks.append(padded(offsets.tobytes()))
+    header_strings = {'count': len(strings), 'offsets': position, 'data': position + len(blocks[-1])}
+    blocks.append(b''.join(data))
+
+    header = padded(json.dumps({
+        'rows': len(ids),
+        'ascending': all(previous < following for previous, following in zip(ids, ids[1:])),
+        'byteorder': sys.byteorder,
+        'source': source,
+        'fields': list(columns),
+        'columns': header_columns,
+        'strings': header_strings,
+    }).encode(), b' ')
+    # The preamble is 16 bytes, so the blocks that follow the header stay aligned
+    return b''.join([PREAMBLE.pack(MAGIC, SNAPSHOT_VERSION, len(header)), header] + blocks)
+
+
+class SnapshotValues:
+    """Distinct values of a snapshot column by code, decoded from the string
+    table when they are first read. Code 0 returns 'missing'. tolist()
+    decodes all of them at once."""
+
+    def __init__(self, snapshot, first, count, missing=None):
+        self._snapshot = snapshot
+        self._first = first
+        self._count = count
+        self._missing = missing
+        self._values = None  # All the values, once tolist() decoded them
+        self._cache = {}     # code -> value decoded by __getitem__()
+
+    def __len__(self):
+        return self._count + 1
+
+    def __getitem__(self, code):
+        if self._values is not None:
+            return self._values[code]
+        if not code:
+            return self._missing
+        if code in self._cache:
+            return self._cache[code]
+        value = self._cache[code] = self._snapshot.strings(self._first + code - 1, 1)[0]
+        return value
+
+    def tolist(self):
+        if self._values is None:
+            self._values = [self._missing] + self._snapshot.strings(self._first, self._count)
+            self._cache = None
+        return self._values
+
+
+class Snapshot:
+    """Read-only view of a snapshot file (see encode_snapshot()). The file is
+    memory-mapped and nothing is copied when it is opened: ids and the code
+    arrays returned by column() are memoryviews of the mapping, and values
+    are only decoded when they are read. Worker processes opening the same
+    file share its pages through the operating system's page cache.
+
+    Raises SnapshotError if the file is not a snapshot of this format
+    version, and OSError if it cannot be read."""
+
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as fileobj:
+            try:
+                self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                raise SnapshotError(f"{file_path} is empty.")
+        if len(self._map) < PREAMBLE.size:
+            raise SnapshotError(f"{file_path} is not a snapshot.")
+        magic, version, header_length = PREAMBLE.unpack_from(self._map)
+        if magic != MAGIC:
+            raise SnapshotError(f"{file_path} is not a snapshot.")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"{file_path} has format version {version} instead of {SNAPSHOT_VERSION}.")
+        header = json.loads(self._map[PREAMBLE.size:PREAMBLE.size + header_length])
+        if header['byteorder'] != sys.byteorder:
+            raise SnapshotError(f"{file_path} was written on a machine with another byte order.")
+
+        data = memoryview(self._map)[PREAMBLE.size + header_length:]
+        self.rows = header['rows']
+        self.ascending = header['ascending']
+        self.source = tuple(header['source']) if header['source'] is not None else None
+        self.fields = header['fields']
+        self.ids = data[:8 * self.rows].cast('q')
+        self._columns = {column['name']: column for column in header['columns']}
+        self._data = data
+        strings = header['strings']
+        self._offsets = data[strings['offsets']:strings['offsets'] + 8 * (strings['count'] + 1)].cast('Q')
+        self._strings = data[strings['data']:]
+
+    def strings(self, first, count):
+        """Decodes count consecutive values of the string table."""
+        if not count:
+            return []
+        start, end = self._offsets[first], self._offsets[first + count]
+        return json.loads(b'[' + self._strings[start:end - 1].tobytes() + b']')
+
+    def column(self, field, missing=None):
+        """Returns a (codes, values) tuple for an attribute, where codes is a
+        memoryview with the code of each character's value and values a
+        SnapshotValues mapping codes to values, and code 0 (characters
+        without the attribute) to missing. An attribute no character has
+        gets a column of missing values."""
+        column = self._columns.get(field)
+        if column is None:
+            return memoryview(bytes(self.rows)), SnapshotValues(self, 0, 0, missing)
+        start = column['codes']
+        codes = self._data[start:start + column['width'] * self.rows].cast(CODE_TYPES[column['width']])
+        return codes, SnapshotValues(self, column['first'], column['count'], missing)
+
+    def characters(self):
+        """Returns all the characters as a list of dictionaries."""
+        characters = [{'id': character_id} for character_id in self.ids.tolist()]
+        for field in self.fields:
+            codes, values = self.column(field)
+            values = values.tolist()
+            for character, code in zip(characters, codes):
+                if code:
+                    character[field] = values[code]
+        return characters
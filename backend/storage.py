@@ -1,4 +1,20 @@
 import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from snapshot import Snapshot, SnapshotError, encode_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where only threads are serialized
+    fcntl = None
+
+
+class StorageError(Exception):
+    """Raised by the storages when a change cannot be persisted. The change
+    is then not stored, and the caller must not report it as saved."""
 
 
 def read_data(file_path):
@@ -21,17 +37,585 @@ def read_data(file_path):
 
 def sync_data(file_path, characters):
     """Writes data to the JSON file. Handles errors that might occur during
-    the write process."""
+    the write process. The data is written to a temporary file which then
+    replaces the original, so a crash never leaves a truncated file behind."""
     updated_characters = json.dumps(characters)
     try:
-        with open(file_path, 'w') as fileobj:
-            fileobj.write(updated_characters)
+        write_atomic(file_path, updated_characters)
     except IOError:
         print(f"Error: Unable to write to file {file_path}.")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
 
+def store_data(file_path, data):
+    """Writes data to a JSON file like sync_data(), but raises StorageError if
+    the file cannot be written, for the storages persisting changes."""
+    try:
+        write_atomic(file_path, json.dumps(data))
+    except OSError as e:
+        raise StorageError(f"Unable to write to file {file_path}: {e}") from e
+
+
+def write_atomic(file_path, text):
+    """Writes the text (or bytes) to a temporary file next to file_path,
+    flushes it to disk and renames it over file_path."""
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb' if isinstance(text, bytes) else 'w') as fileobj:
+            fileobj.write(text)
+            fileobj.flush()
+            os.fsync(fileobj.fileno())
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def file_stamp(file_path):
+    """Returns a (mtime, size) tuple identifying the current version of a
+    file, or None if the file cannot be accessed."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class StorageLock:
+    """Write lock and generation counter shared by all the processes (e.g.
+    gunicorn workers) using the same storage. The lock is an exclusive
+    flock() on '<path>.lock' and is reentrant within a thread. The generation
+    is an 8 byte counter in '<path>.generation', memory-mapped so that reading
+    it is a plain memory access; writers bump it while holding the lock, so
+    other processes notice that their cached data is stale without touching
+    the data file."""
+
+    def __init__(self, path):
+        self.lock_path = f"{path}.lock"
+        self.generation_path = f"{path}.generation"
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+        self._map = None
+        self._pid = None
+
+    def _open(self):
+        """Opens the lock and generation files once per process, since flock()
+        locks would be shared with a parent process through inherited files."""
+        if self._pid == os.getpid():
+            return
+        self._file = open(self.lock_path, 'a')
+        file_descriptor = os.open(self.generation_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(file_descriptor).st_size < 8:
+                os.ftruncate(file_descriptor, 8)
+            self._map = mmap.mmap(file_descriptor, 8)
+        finally:
+            os.close(file_descriptor)
+        self._pid = os.getpid()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0:
+                self._open()
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+        except Exception:
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def generation(self):
+        """Returns the current generation, or None if it cannot be read."""
+        try:
+            self._open()
+        except OSError:
+            return None
+        return struct.unpack_from('Q', self._map)[0]
+
+    def bump(self):
+        """Increments the generation. Must be called while holding the lock."""
+        struct.pack_into('Q', self._map, 0, struct.unpack_from('Q', self._map)[0] + 1)
+
+
+class JsonCharacterStorage:
+    """Stores the characters as a list in a JSON file. Every change rewrites
+    the whole file with store_data().
+
+    All storages share the same interface: stamp() returns a cheap value that
+    changes whenever the stored data changes, load() returns the list of
+    characters, and insert()/update()/delete() persist a single change.
+    batch() persists a list of (operation, argument) changes, where the
+    operation is the name of one of those three methods, in a single write.
+    The write methods also receive a function returning the full, already
+    modified list of characters, for storages that can only save everything
+    at once, and raise StorageError if the change could not be stored.
+    write_lock() returns the StorageLock that serializes writers across
+    processes; read-modify-write sequences must hold it. load_snapshot() returns a memory-mapped Snapshot of the characters (see
+    snapshot.py) to be used instead of load(), or None if there is none.
+
+    With a snapshot_path, every save also writes a binary snapshot of the
+    file there, which workers open with load_snapshot() instead of parsing
+    the JSON file. The snapshot records the stamp of the JSON file it was
+    made from; a missing or stale one (e.g. after the JSON file was edited
+    by hand) is rewritten from the JSON file by the first worker loading
+    it."""
+
+    def __init__(self, file_path='characters.json', snapshot_path=None):
+        self.file_path = file_path
+        self.snapshot_path = snapshot_path
+        self.lock = StorageLock(file_path)
+
+    def write_lock(self):
+        return self.lock
+
+    def stamp(self):
+        # The generation catches rewrites that keep the same size within the
+        # file system's mtime resolution
+        return self.lock.generation(), file_stamp(self.file_path)
+
+    def load(self):
+        return read_data(self.file_path)
+
+    def load_snapshot(self):
+        if not self.snapshot_path:
+            return None
+        snapshot = self._open_snapshot()
+        if snapshot is None:
+            with self.lock:
+                # Another worker may have written it while this one waited
+                snapshot = self._open_snapshot()
+                if snapshot is None:
+                    write_snapshot(self.snapshot_path, read_data(self.file_path), file_stamp(self.file_path))
+                    snapshot = self._open_snapshot()
+        return snapshot
+
+    def _open_snapshot(self):
+        """Returns the snapshot if it matches the JSON file, or None."""
+        try:
+            snapshot = Snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, SnapshotError) as e:
+            print(f"Error: Unable to read snapshot {self.snapshot_path}: {e}")
+            return None
+        return snapshot if snapshot.source == file_stamp(self.file_path) else None
+
+    def save(self, characters):
+        with self.lock:
+            store_data(self.file_path, characters)
+            if self.snapshot_path:
+                write_snapshot(self.snapshot_path, characters, file_stamp(self.file_path))
+            self.lock.bump()
+
+    def insert(self, character, all_characters):
+        self.save(all_characters())
+
+    def update(self, character, all_characters):
+        self.save(all_characters())
+
+    def delete(self, character_id, all_characters):
+        self.save(all_characters())
+
+    def batch(self, changes, all_characters):
+        self.save(all_characters())
+
+
+class JsonUserStorage:
+    """Stores the users in a JSON file as a dict keyed by username. Every new
+    user rewrites the whole file with store_data()."""
+
+    def __init__(self, file_path='users.json'):
+        self.file_path = file_path
+        self.lock = StorageLock(file_path)
+
+    def write_lock(self):
+        return self.lock
+
+    def stamp(self):
+        return self.lock.generation(), file_stamp(self.file_path)
+
+    def load(self):
+        return read_data(self.file_path)
+
+    def save(self, users):
+        with self.lock:
+            store_data(self.file_path, users)
+            self.lock.bump()
+
+    def insert(self, username, user, all_users):
+        self.save(all_users())
+
+
+class JournalMixin:
+    """Journal shared by the journaled JSON storages, so that a change does not
+    rewrite the whole JSON file. Each change appends one line to a journal file
+    next to the JSON file (e.g. 'characters.json.journal') and fsyncs it, so a
+    write costs O(record) instead of O(dataset). load() reads the snapshot and
+    replays the journal on top of it. compact() folds the journal into a fresh
+    snapshot (written to a temporary file and renamed). It runs periodically
+    in a background thread once start_compactor() is called, and otherwise
+    right after an append that makes the journal larger than
+    compact_threshold bytes.
+
+    Replaying the entries is idempotent, so a crash between writing the
+    snapshot and trimming the journal loses nothing. An incomplete last line
+    (a crash in the middle of an append) is skipped on replay; the next append
+    starts on a new line, so it is not merged into the torn one. Subclasses define how
+    entries are applied with _from_snapshot(), _apply() and _to_snapshot()."""
+
+    def _init_journal(self, journal_path, compact_threshold):
+        self.journal_path = journal_path or f"{self.file_path}.journal"
+        self.compact_threshold = compact_threshold
+        self._compactor = None
+        self._stop = threading.Event()
+
+    def stamp(self):
+        return self.lock.generation(), file_stamp(self.file_path), file_stamp(self.journal_path)
+
+    def _journal_size(self):
+        return (file_stamp(self.journal_path) or (0, 0))[1]
+
+    def _replay(self, snapshot, limit=None):
+        """Applies the journal (up to 'limit' bytes) to the snapshot data."""
+        data = self._from_snapshot(snapshot)
+        try:
+            with open(self.journal_path, 'rb') as fileobj:
+                journal = fileobj.read() if limit is None else fileobj.read(limit)
+        except FileNotFoundError:
+            journal = b''
+        for line in journal.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print(f"Error: Skipping an incomplete entry in {self.journal_path}.")
+                continue
+            self._apply(data, entry)
+        return self._to_snapshot(data)
+
+    def load(self):
+        return self._replay(read_data(self.file_path))
+
+    def _append(self, *entries):
+        """Appends entries to the journal in a single write and fsyncs it."""
+        line = ''.join(json.dumps(entry) + '\n' for entry in entries).encode()
+        with self.lock:
+            self._append_line(line)
+            self.lock.bump()
+            if self._compactor is None and self._journal_size() >= self.compact_threshold:
+                self.compact()
+
+    def _append_line(self, line):
+        """Appends the line to the journal. Must be called while holding the lock."""
+        try:
+            file_descriptor = os.open(self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(file_descriptor).st_size
+                if size and os.pread(file_descriptor, 1, size - 1) != b'\n':
+                    # Terminates a torn last line, which replay then skips
+                    line = b'\n' + line
+                os.write(file_descriptor, line)
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+        except OSError as e:
+            raise StorageError(f"Unable to write to file {self.journal_path}: {e}") from e
+
+    def compact(self):
+        """Folds the journal into a new snapshot. Entries appended while the
+        snapshot is being written are kept in the trimmed journal."""
+        with self.lock:
+            journal_size = self._journal_size()
+            if journal_size == 0:
+                return
+            data = self._replay(read_data(self.file_path), journal_size)
+            try:
+                write_atomic(self.file_path, json.dumps(data))
+                with open(self.journal_path, 'rb') as fileobj:
+                    fileobj.seek(journal_size)
+                    tail = fileobj.read()
+                write_atomic(self.journal_path, tail.decode())
+            except OSError as e:
+                print(f"Error: Unable to compact {self.journal_path}: {e}")
+
+    def start_compactor(self, interval=60):
+        """Starts a daemon thread compacting the journal every 'interval'
+        seconds once it is larger than compact_threshold bytes."""
+        def run():
+            while not self._stop.wait(interval):
+                if self._journal_size() >= self.compact_threshold:
+                    self.compact()
+
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=run, name='journal-compactor', daemon=True)
+            self._compactor.start()
+
+    def stop_compactor(self):
+        self._stop.set()
+
+
+class JournaledJsonCharacterStorage(JournalMixin, JsonCharacterStorage):
+    """Characters JSON file storage with a journal (see JournalMixin). Journal
+    lines are {"op": "put", "character": {...}} with the full record, or
+    {"op": "delete", "id": ...}."""
+
+    def __init__(self, file_path='characters.json', journal_path=None, compact_threshold=1024 * 1024,
+                 snapshot_path=None):
+        super().__init__(file_path, snapshot_path)
+        self._init_journal(journal_path, compact_threshold)
+
+    def load_snapshot(self):
+        # The snapshot mirrors the JSON file, which lacks the journaled changes until compaction
+        if self._journal_size():
+            return None
+        return super().load_snapshot()
+
+    @staticmethod
+    def _from_snapshot(characters):
+        return {character['id']: character for character in characters}
+
+    @staticmethod
+    def _apply(by_id, entry):
+        if entry['op'] == 'put':
+            by_id[entry['character']['id']] = entry['character']
+        elif entry['op'] == 'delete':
+            by_id.pop(entry['id'], None)
+
+    @staticmethod
+    def _to_snapshot(by_id):
+        return list(by_id.values())
+
+    @staticmethod
+    def _entry(operation, argument):
+        if operation == 'delete':
+            return {'op': 'delete', 'id': argument}
+        return {'op': 'put', 'character': argument}
+
+    def insert(self, character, all_characters):
+        self._append(self._entry('insert', character))
+
+    def update(self, character, all_characters):
+        self._append(self._entry('update', character))
+
+    def delete(self, character_id, all_characters):
+        self._append(self._entry('delete', character_id))
+
+    def batch(self, changes, all_characters):
+        if changes:
+            self._append(*(self._entry(operation, argument) for operation, argument in changes))
+
+
+class JournaledJsonUserStorage(JournalMixin, JsonUserStorage):
+    """Users JSON file storage with a journal (see JournalMixin), so that a
+    registration appends one line instead of rewriting users.json. Journal
+    lines are {"op": "put", "username": ..., "user": {...}}."""
+
+    def __init__(self, file_path='users.json', journal_path=None, compact_threshold=64 * 1024):
+        super().__init__(file_path)
+        self._init_journal(journal_path, compact_threshold)
+
+    @staticmethod
+    def _from_snapshot(users):
+        return dict(users or {})
+
+    @staticmethod
+    def _apply(users, entry):
+        if entry['op'] == 'put':
+            users[entry['username']] = entry['user']
+
+    @staticmethod
+    def _to_snapshot(users):
+        return users
+
+    def insert(self, username, user, all_users):
+        self._append({'op': 'put', 'username': username, 'user': user})
+
+
+class SqliteStorage:
+    """Base class for the SQLite storages. Each thread gets its own connection
+    to the database, which runs in WAL mode so that readers are not blocked by
+    a writer. Every write bumps a per-table generation counter in the 'meta'
+    table, which is what stamp() returns. Writers across processes are
+    serialized with a StorageLock next to the database file."""
+
+    table = None
+
+    def __init__(self, database_path='thrones.db'):
+        self.database_path = database_path
+        self.lock = StorageLock(database_path)
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS characters (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    house TEXT,
+                    age,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS characters_house ON characters (house);
+                CREATE INDEX IF NOT EXISTS characters_name ON characters (name);
+                CREATE INDEX IF NOT EXISTS characters_age ON characters (age);
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('characters', 0), ('users', 0);
+            """)
+
+    def _connect(self):
+        """Returns the connection of the current thread, opening it if needed."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def write_lock(self):
+        return self.lock
+
+    def _write(self, statements):
+        """Runs the (sql, parameters) statements and bumps the generation
+        counter in a single transaction."""
+        try:
+            with self.lock, self._connect() as connection:
+                for sql, parameters in statements:
+                    connection.execute(sql, parameters)
+                connection.execute('UPDATE meta SET value = value + 1 WHERE key = ?', (self.table,))
+        except sqlite3.Error as e:
+            raise StorageError(f"Unable to write to database {self.database_path}: {e}") from e
+
+    def stamp(self):
+        try:
+            row = self._connect().execute('SELECT value FROM meta WHERE key = ?', (self.table,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error: Unable to read from database {self.database_path}: {e}")
+            return None
+        return row[0]
+
+
+class SqliteCharacterStorage(SqliteStorage):
+    """Stores the characters in a SQLite table with one row per character.
+    Each change only writes the affected row. The full record is kept as JSON
+    in the 'data' column, next to indexed copies of id, name, house and age."""
+
+    table = 'characters'
+
+    @staticmethod
+    def _row(character):
+        return (character['id'], character.get('name'), character.get('house'),
+                character.get('age'), json.dumps(character))
+
+    def load(self):
+        try:
+            rows = self._connect().execute('SELECT data FROM characters ORDER BY id').fetchall()
+        except sqlite3.Error as e:
+            print(f"Error: Unable to read from database {self.database_path}: {e}")
+            return []
+        return [json.loads(row[0]) for row in rows]
+
+    def load_snapshot(self):
+        return None
+
+    def save(self, characters):
+        """Replaces all stored characters."""
+        self._write([('DELETE FROM characters', ())] +
+                    [('INSERT INTO characters (id, name, house, age, data) VALUES (?, ?, ?, ?, ?)',
+                      self._row(character)) for character in characters])
+
+    @classmethod
+    def _statement(cls, operation, argument):
+        """Returns the (sql, parameters) statement of a single change."""
+        if operation == 'delete':
+            return 'DELETE FROM characters WHERE id = ?', (argument,)
+        character_id, name, house, age, data = cls._row(argument)
+        if operation == 'insert':
+            return ('INSERT INTO characters (id, name, house, age, data) VALUES (?, ?, ?, ?, ?)',
+                    (character_id, name, house, age, data))
+        return ('UPDATE characters SET name = ?, house = ?, age = ?, data = ? WHERE id = ?',
+                (name, house, age, data, character_id))
+
+    def insert(self, character, all_characters):
+        self._write([self._statement('insert', character)])
+
+    def update(self, character, all_characters):
+        self._write([self._statement('update', character)])
+
+    def delete(self, character_id, all_characters):
+        self._write([self._statement('delete', character_id)])
+
+    def batch(self, changes, all_characters):
+        """Writes all the changes in one transaction."""
+        self._write([self._statement(operation, argument) for operation, argument in changes])
+
+
+class SqliteUserStorage(SqliteStorage):
+    """Stores the users in a SQLite table keyed by username."""
+
+    table = 'users'
+
+    def load(self):
+        try:
+            rows = self._connect().execute('SELECT username, data FROM users').fetchall()
+        except sqlite3.Error as e:
+            print(f"Error: Unable to read from database {self.database_path}: {e}")
+            return {}
+        return {username: json.loads(data) for username, data in rows}
+
+    def save(self, users):
+        """Replaces all stored users."""
+        self._write([('DELETE FROM users', ())] +
+                    [('INSERT INTO users (username, data) VALUES (?, ?)', (username, json.dumps(user)))
+                     for username, user in users.items()])
+
+    def insert(self, username, user, all_users):
+        self._write([('INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)',
+                      (username, json.dumps(user)))])
+
+
+def write_snapshot(snapshot_path, characters, source=None):
+    """Writes the characters to a binary snapshot (see snapshot.py). Handles
+    errors like sync_data()."""
+    try:
+        write_atomic(snapshot_path, encode_snapshot(characters, source))
+    except IOError:
+        print(f"Error: Unable to write to file {snapshot_path}.")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+
+
+def convert_json_to_snapshot(characters_path, snapshot_path):
+    """Writes a snapshot of a characters JSON file."""
+    write_snapshot(snapshot_path, read_data(characters_path), file_stamp(characters_path))
+
+
+def convert_snapshot_to_json(snapshot_path, characters_path):
+    """Writes the characters of a snapshot back to a JSON file."""
+    sync_data(characters_path, Snapshot(snapshot_path).characters())
+
+
+def import_json_to_sqlite(database_path, characters_path='characters.json', users_path='users.json'):
+    """One-shot import of the JSON files into a SQLite database. Existing
+    rows in the database are replaced."""
+    SqliteCharacterStorage(database_path).save(read_data(characters_path))
+    SqliteUserStorage(database_path).save(read_data(users_path) or {})
+
+
 def main():
     characters = read_data('characters.json')
     new_character = {
@@ -1,9 +1,13 @@
 import unittest
+import gzip
 import json
-from .app import app
+from .app import StorageError, app, characters_repository
 import jwt
 import os
+import tempfile
+import time
 from datetime import datetime, timedelta
+from unittest import mock
 
 SECRET_KEY = os.getenv('SECRET_KEY')
 
@@ -48,6 +52,17 @@ class APITestCases(unittest.TestCase):
         self.assertEqual(response.status_code, 401)
         self.assertIn('Token is missing or invalid format', str(response.data))
 
+    def test_token_cache_stats(self):
+        """Test that repeated requests with the same token hit the token cache"""
+        headers = {'Authorization': f"Bearer {generate_token('maria', role='admin')}"}
+        before = json.loads(self.app.get('/api/token_cache', headers=headers).data)
+        self.app.get('/api/characters/11', headers=headers)
+        after = json.loads(self.app.get('/api/token_cache', headers=headers).data)
+        self.assertEqual(after['hits'], before['hits'] + 2)
+
+        response = self.app.get('/api/token_cache', headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
     def test_get_characters_success(self):
         """Test fetching characters with valid token"""
         response = self.app.get('/api/characters', headers=self.headers)
@@ -192,6 +207,267 @@ class APITestCases(unittest.TestCase):
         data = json.loads(response.data)
         self.assertTrue(data[0]['age'] <= data[1]['age'])
 
+    def test_filter_by_house_and_age(self):
+        """Test combining a substring filter with an age range filter"""
+        response = self.app.get('/api/characters?house=stark&age_more_than=15&limit=100', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(data)
+        for character in data:
+            self.assertIn('stark', character['house'].lower())
+            self.assertGreaterEqual(character['age'], 15)
+
+    def test_cursor_pagination_walks_all_characters(self):
+        """Test that following next_cursor returns every character once, in order"""
+        expected = json.loads(self.app.get('/api/characters?sort_desc=age&limit=1000', headers=self.headers).data)
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = self.app.get(f'/api/characters?sort_desc=age&limit=7&cursor={cursor}', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            seen.extend(data['characters'])
+            cursor = data['next_cursor']
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = self.app.get('/api/characters?cursor=not-a-cursor', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data['error'], 'Invalid cursor parameter.')
+
+    def test_all_characters_stream(self):
+        """Test that the streamed array matches the regular response"""
+        expected = json.loads(self.app.get('/api/all_characters', headers=self.headers).data)
+        response = self.app.get('/api/all_characters?stream=1', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), expected)
+
+    def test_all_characters_ndjson(self):
+        """Test streaming the characters as newline-delimited JSON"""
+        expected = json.loads(self.app.get('/api/all_characters', headers=self.headers).data)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        response = self.app.get('/api/all_characters', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+    def test_all_characters_not_modified(self):
+        """Test that a matching If-None-Match gets an empty 304 until a write"""
+        response = self.app.get('/api/all_characters', headers=self.headers)
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+        response = self.app.get('/api/all_characters', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        response = self.app.post('/api/characters', json={'name': 'Podrick Payne'}, headers=self.headers)
+        character_id = json.loads(response.data)['id']
+        response = self.app.get('/api/all_characters', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.app.delete(f'/api/characters/{character_id}', headers=self.headers)
+
+    def test_character_by_id_not_modified(self):
+        """Test conditional requests for a single character"""
+        response = self.app.get('/api/characters/11', headers=self.headers)
+        etag = response.headers['ETag']
+        response = self.app.get('/api/characters/11', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.app.get('/api/characters/12', headers=self.headers).headers['ETag'], etag)
+
+        # Proxies compressing the body send the ETag back weakened
+        response = self.app.get('/api/characters/11', headers=dict(self.headers, **{'If-None-Match': f'W/{etag}'}))
+        self.assertEqual(response.status_code, 304)
+
+        # Last-Modified is only sent, and If-Modified-Since only used, once the second of the last write is over
+        with mock.patch('time.time', return_value=time.time() - 10):
+            self.assertNotIn('Last-Modified', self.app.get('/api/characters/11', headers=self.headers).headers)
+        with mock.patch('time.time', return_value=time.time() + 10):
+            last_modified = self.app.get('/api/characters/11', headers=self.headers).headers['Last-Modified']
+            response = self.app.get('/api/characters/11',
+                                    headers=dict(self.headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 304)
+        with mock.patch('time.time', return_value=time.time() - 10):
+            response = self.app.get('/api/characters/11',
+                                    headers=dict(self.headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_all_characters_gzip(self):
+        """Test that the full list is compressed for clients accepting gzip"""
+        expected = json.loads(self.app.get('/api/all_characters', headers=self.headers).data)
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        response = self.app.get('/api/all_characters', headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(response.headers['ETag'].endswith('-gzip"'))
+        self.assertEqual(json.loads(gzip.decompress(response.data)), expected)
+
+        # Conditional requests accept the ETag of the compressed body
+        etag = response.headers['ETag']
+        response = self.app.get('/api/all_characters', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+        # Small responses are sent as they are, under the ETag of the uncompressed body
+        response = self.app.get('/api/characters/11', headers=headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.endswith('-gzip"'))
+        response = self.app.get('/api/characters/11', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+        # Streamed responses are never compressed
+        response = self.app.get('/api/all_characters?stream=1', headers=headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.endswith('-gzip"'))
+        response = self.app.get('/api/all_characters?stream=1', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+    def test_bulk_operations(self):
+        """Test creating, updating and deleting characters in one request"""
+        operations = [
+            {'op': 'create', 'character': {'name': 'Hot Pie', 'age': 16}},
+            {'op': 'create', 'character': {'name': 'Lommy', 'age': 'young'}},
+            {'op': 'create', 'character': {'name': 'Lommy Greenhands'}},
+            {'op': 'update', 'id': 999, 'character': {'age': 20}},
+            {'op': 'rename'}
+        ]
+        response = self.app.post('/api/characters/bulk', json=operations, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)['results']
+        self.assertEqual([result['status'] for result in results], [200, 400, 200, 404, 400])
+        self.assertEqual(results[1]['error'], "'age' must be of type int or null.")
+        first_id, second_id = results[0]['character']['id'], results[2]['character']['id']
+        self.assertEqual(second_id, first_id + 1)
+
+        operations = [
+            {'op': 'update', 'id': first_id, 'character': {'age': 17}},
+            {'op': 'delete', 'id': first_id},
+            {'op': 'delete', 'id': second_id}
+        ]
+        response = self.app.post('/api/characters/bulk', json=operations, headers=self.headers)
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[0]['character']['age'], 17)
+        self.assertEqual([result['status'] for result in results], [200, 200, 200])
+        response = self.app.get(f'/api/characters/{first_id}', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_character_stats(self):
+        """Test the statistics endpoint with a group-by and a filter"""
+        response = self.app.get('/api/characters/stats?group_by=house,death&house=stark', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['groups']['house'], [{'value': 'Stark', 'count': data['total']}])
+        self.assertEqual(sum(group['count'] for group in data['groups']['death']), data['total'])
+        self.assertEqual(data['age']['count'] + data['age']['missing'], data['total'])
+
+        response = self.app.get('/api/characters/stats?group_by=invalid_field', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_characters(self):
+        """Test the ranked search endpoint"""
+        response = self.app.get('/api/characters/search?q=tyr lan', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['characters'][0]['name'], 'Tyrion Lannister')
+
+        response = self.app.get('/api/characters/search?q=', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_fields_projection(self):
+        """Test returning only some fields of the characters"""
+        response = self.app.get('/api/characters?limit=3&fields=name,id', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([set(char) for char in json.loads(response.data)], [{'id', 'name'}] * 3)
+
+        full = json.loads(self.app.get('/api/all_characters', headers=self.headers).data)
+        response = self.app.get('/api/all_characters?fields=name', headers=self.headers)
+        self.assertEqual(json.loads(response.data), [{'name': char['name']} for char in full])
+        etag = response.headers['ETag']
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        response = self.app.get('/api/all_characters?fields=name', headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get('/api/characters/11?fields=house', headers=self.headers)
+        self.assertEqual(json.loads(response.data), {'house': 'Clegane'})
+        response = self.app.get('/api/characters/11?fields=house,password', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_metrics(self):
+        """Test that requests and their spans show up in /metrics"""
+        self.app.get('/api/characters?house=stark', headers=self.headers)
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('thrones_requests_total{method="GET",route="/api/characters",status="200"}', text)
+        self.assertIn('thrones_request_duration_seconds_count{method="GET",route="/api/characters"}', text)
+        self.assertIn('thrones_span_duration_seconds_count{route="/api/characters",span="filter"}', text)
+        self.assertIn('thrones_span_duration_seconds_count{route="/api/characters",span="auth"}', text)
+        self.assertIn('thrones_token_cache_hits_total', text)
+
+    def test_profile_request(self):
+        """Test that admins can get the profile of a request with ?profile=1"""
+        from . import app as app_module
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(app_module, 'PROFILE_DIR', tmp_dir):
+            response = self.app.get('/api/characters?house=stark&profile=1', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            headers = {'Authorization': f"Bearer {generate_token('maria', role='admin')}"}
+            response = self.app.get('/api/characters?house=stark&profile=1', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'text/plain')
+            self.assertTrue(response.get_data(as_text=True).startswith(
+                '# GET /api/characters?house=stark&profile=1 -> 200 in '))
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+    def test_failed_write_returns_an_error(self):
+        """Test that a change the storage cannot save is answered with a 500 and not kept"""
+        response = self.app.get('/api/characters/changes', headers=self.headers)
+        since = json.loads(response.data)['last_seq']
+        total = len(json.loads(self.app.get('/api/all_characters', headers=self.headers).data))
+        with mock.patch.object(characters_repository.storage, 'insert', side_effect=StorageError('disk full')):
+            response = self.app.post('/api/characters', json={'name': 'Hot Pie'}, headers=self.headers)
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('error', json.loads(response.data))
+        self.assertEqual(len(json.loads(self.app.get('/api/all_characters', headers=self.headers).data)), total)
+        response = self.app.get(f'/api/characters/changes?since={since}&timeout=0', headers=self.headers)
+        self.assertEqual(json.loads(response.data)['changes'], [])
+
+    def test_character_changes(self):
+        """Test the change feed with long-polling, server-sent events and resync"""
+        response = self.app.get('/api/characters/changes', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        since = json.loads(response.data)['last_seq']
+
+        response = self.app.post('/api/characters', json={'name': 'Hot Pie', 'age': 16}, headers=self.headers)
+        character_id = json.loads(response.data)['id']
+        self.app.delete(f'/api/characters/{character_id}', headers=self.headers)
+
+        response = self.app.get(f'/api/characters/changes?since={since}&timeout=0', headers=self.headers)
+        data = json.loads(response.data)
+        self.assertFalse(data['resync'])
+        self.assertEqual(data['last_seq'], since + 2)
+        self.assertEqual([(change['op'], change['id']) for change in data['changes']],
+                         [('add', character_id), ('delete', character_id)])
+        self.assertEqual(data['changes'][0]['character']['name'], 'Hot Pie')
+
+        headers = dict(self.headers, Accept='text/event-stream', **{'Last-Event-ID': str(since)})
+        response = self.app.get('/api/characters/changes', headers=headers, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = iter(response.response)
+        self.assertTrue(next(events).startswith(f"id: {since + 1}\nevent: change\ndata: ".encode()))
+        self.assertTrue(next(events).startswith(f"id: {since + 2}\nevent: change\ndata: ".encode()))
+        response.close()
+
+        response = self.app.get(f'/api/characters/changes?since={since + 3}&timeout=0', headers=self.headers)
+        self.assertEqual(json.loads(response.data), {'changes': [], 'last_seq': since + 2, 'resync': True})
+        response = self.app.get('/api/characters/changes?since=-1', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
     def test_invalid_sort_attribute(self):
         """Test sorting by an invalid attribute"""
         response = self.app.get('/api/characters?sort_asc=invalid_field', headers=self.headers)
@@ -0,0 +1,87 @@
+import unittest
+import threading
+import time
+from .auth import PasswordPool, PoolBusy, TokenCache, hash_password, verify_password
+
+
+class TokenCacheTestCases(unittest.TestCase):
+    def test_hit_and_miss_counters(self):
+        """Test that a cached token is a hit and an unknown one a miss"""
+        cache = TokenCache(capacity=2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', {'username': 'maria', 'exp': time.time() + 60})
+        self.assertEqual(cache.get('a')['username'], 'maria')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_expired_token_is_not_returned(self):
+        """Test that an entry is dropped once the token's exp has passed"""
+        cache = TokenCache()
+        cache.put('a', {'username': 'maria', 'exp': time.time() - 1})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        """Test the LRU eviction when the capacity is exceeded"""
+        cache = TokenCache(capacity=2)
+        for token in ['a', 'b']:
+            cache.put(token, {'exp': time.time() + 60})
+        cache.get('a')
+        cache.put('c', {'exp': time.time() + 60})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class PasswordTestCases(unittest.TestCase):
+    def test_hash_and_verify(self):
+        """Test that a hashed password verifies and is salted"""
+        stored = hash_password('pass123#', 1000)
+        self.assertNotEqual(stored, hash_password('pass123#', 1000))
+        self.assertEqual(verify_password('pass123#', stored, 1000), (True, False))
+        self.assertEqual(verify_password('wrong', stored, 1000), (False, False))
+        self.assertEqual(verify_password('pass123#', stored, 2000), (True, True))
+
+    def test_plaintext_password_needs_rehash(self):
+        """Test that legacy plaintext passwords verify and ask for a rehash"""
+        self.assertEqual(verify_password('pass123#', 'pass123#', 1000), (True, True))
+        self.assertEqual(verify_password('wrong', 'pass123#', 1000), (False, True))
+
+    def test_malformed_hashes_do_not_verify(self):
+        """Test that stored hashes with an invalid number of iterations or salt are rejected"""
+        digest = '0' * 64
+        for iterations in ['0', '-5', 'many', '1' * 30]:
+            self.assertEqual(verify_password('pass123#', f"pbkdf2_sha256${iterations}$00ff${digest}", 1000),
+                             (False, False))
+        self.assertEqual(verify_password('pass123#', f"pbkdf2_sha256$1000$xyz${digest}", 1000), (False, False))
+
+    def test_unknown_user_costs_a_verification(self):
+        """Test that unknown users are verified against a dummy hash"""
+        pool = PasswordPool(workers=1, iterations=1000)
+        self.assertEqual(pool.verify('pass123#', None), (False, False))
+        self.assertEqual(pool.verify('', None), (False, False))
+        self.assertEqual(pool.stats()['completed'], 2)
+
+    def test_pool_rejects_when_full(self):
+        """Test the admission control of the password pool"""
+        pool = PasswordPool(workers=1, max_pending=1, iterations=1000)
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait()
+
+        waiting = threading.Thread(target=pool._run, args=(slow,))
+        waiting.start()
+        started.wait()
+        with self.assertRaises(PoolBusy):
+            pool.hash('pass123#')
+        release.set()
+        waiting.join()
+        self.assertEqual(pool.stats()['rejected'], 1)
+        self.assertEqual(pool.stats()['pending'], 0)
+        self.assertTrue(verify_password('pass123#', pool.hash('pass123#'), 1000)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+from .benchmarks.common import compare, percentile, summarize
+from .benchmarks.dataset import generate_characters
+
+
+class BenchmarkTestCases(unittest.TestCase):
+    def test_generated_characters(self):
+        """Test that the generator is reproducible and fills every field"""
+        characters = generate_characters(500, seed=3)
+        self.assertEqual(characters, generate_characters(500, seed=3))
+        self.assertNotEqual(characters, generate_characters(500, seed=4))
+        self.assertEqual([char['id'] for char in characters], list(range(1, 501)))
+        self.assertEqual(set(characters[0]), {'id', 'name', 'house', 'animal', 'symbol', 'nickname',
+                                              'role', 'age', 'death', 'strength'})
+        self.assertTrue(all(char['age'] is None or 5 <= char['age'] <= 90 for char in characters))
+
+    def test_percentiles_and_baseline(self):
+        """Test the latency summary and the regression check"""
+        latencies = [number / 1000 for number in range(1, 101)]
+        self.assertEqual(percentile(latencies, 0.95), 0.095)
+        summary = summarize(latencies, 2.0)
+        self.assertEqual((summary['p50_ms'], summary['p99_ms'], summary['rps']), (50, 99, 50))
+
+        baseline = {'search': {'p95_ms': 10, 'rps': 100}}
+        metrics = {'p95_ms': False, 'rps': True}
+        self.assertEqual(compare({'search': {'p95_ms': 11, 'rps': 90}}, baseline, metrics, 0.2), [])
+        self.assertEqual(compare({'search': {'p95_ms': 13, 'rps': 70}}, baseline, metrics, 0.2),
+                         [('search', 'p95_ms', 10, 13), ('search', 'rps', 100, 70)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from .changes import ChangeFeed
+
+
+class ChangeFeedTestCases(unittest.TestCase):
+    def setUp(self):
+        """Creates a small change feed in a temporary directory for each test"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'characters.changes')
+        self.feed = ChangeFeed(self.path, capacity=4, slot_size=256)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_changes_are_numbered(self):
+        """Test that changes get increasing sequence numbers and are read from a position"""
+        self.assertEqual(self.feed.last_seq(), 0)
+        self.feed.append({'op': 'add', 'id': 1, 'character': {'id': 1, 'name': 'Jon Snow'}})
+        self.assertEqual(self.feed.append({'op': 'delete', 'id': 2}, {'op': 'delete', 'id': 3}), 3)
+
+        changes, last = self.feed.changes(0)
+        self.assertEqual(last, 3)
+        self.assertEqual([(change['seq'], change['op'], change['id']) for change in changes],
+                         [(1, 'add', 1), (2, 'delete', 2), (3, 'delete', 3)])
+        self.assertEqual(changes[0]['character'], {'id': 1, 'name': 'Jon Snow'})
+        self.assertEqual(self.feed.changes(1, limit=1)[0][0]['seq'], 2)
+        self.assertEqual(self.feed.changes(3), ([], 3))
+
+    def test_resync_when_history_is_gone(self):
+        """Test that clients behind the ring buffer or ahead of the feed must resync"""
+        for character_id in range(1, 7):
+            self.feed.append({'op': 'delete', 'id': character_id})
+        self.assertEqual(self.feed.changes(1), (None, 6))
+        self.assertEqual([change['id'] for change in self.feed.changes(2)[0]], [3, 4, 5, 6])
+        self.assertEqual(self.feed.changes(7), (None, 6))
+
+    def test_large_events_lose_their_character(self):
+        """Test that events larger than a slot are kept without the character"""
+        self.feed.append({'op': 'update', 'id': 1, 'character': {'id': 1, 'name': 'x' * 500}})
+        change = self.feed.changes(0)[0][0]
+        self.assertEqual((change['op'], change['id']), ('update', 1))
+        self.assertNotIn('character', change)
+
+    def test_history_is_shared_through_the_file(self):
+        """Test that another feed on the same file sees the changes, and that a resized feed keeps the sequence"""
+        self.feed.append({'op': 'delete', 'id': 1})
+        self.assertEqual(ChangeFeed(self.path, capacity=4, slot_size=256).changes(0)[0][0]['id'], 1)
+
+        resized = ChangeFeed(self.path, capacity=8, slot_size=256)
+        self.assertEqual(resized.last_seq(), 1)
+        self.assertEqual(resized.changes(0), (None, 1))
+        self.assertEqual(resized.append({'op': 'delete', 'id': 2}), 2)
+
+    def test_wait(self):
+        """Test that waiters wake up on a change and otherwise time out"""
+        start = time.monotonic()
+        self.assertEqual(self.feed.wait(0, 0.05), 0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+        timer = threading.Timer(0.05, self.feed.append, [{'op': 'delete', 'id': 1}])
+        timer.start()
+        start = time.monotonic()
+        self.assertEqual(self.feed.wait(0, 5), 1)
+        self.assertLess(time.monotonic() - start, 1)
+        timer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import time
+from .metrics import Histogram, Metrics, SamplingProfiler, collect_spans, span, start_spans
+
+
+class MetricsTestCases(unittest.TestCase):
+    def test_histogram_buckets(self):
+        """Test that values are counted in the first bucket not below them"""
+        histogram = Histogram((0.1, 1))
+        for value in [0.05, 0.1, 0.5, 3]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 3.65)
+
+    def test_render(self):
+        """Test the Prometheus text format of counters, histograms and gauges"""
+        metrics = Metrics()
+        metrics.describe('requests_total', 'counter', 'Requests.')
+        metrics.increment('requests_total', (('route', '/a"b'),))
+        metrics.increment('requests_total', (('route', '/a"b'),), 2)
+        metrics.observe('latency_seconds', (('route', '/a'),), 0.003)
+        text = metrics.render([('pending', 'gauge', 'Pending jobs.', 4)])
+        lines = text.splitlines()
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{route="/a\\"b"} 3', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.0025"} 0', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.005"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="+Inf"} 1', lines)
+        self.assertIn('latency_seconds_count{route="/a"} 1', lines)
+        self.assertIn('# TYPE pending gauge', lines)
+        self.assertEqual(lines[-1], 'pending 4')
+
+    def test_spans(self):
+        """Test that spans of the same name add up and are only kept during requests"""
+        with span('sort'):
+            pass
+        start_spans()
+        for _ in range(2):
+            with span('filter'):
+                time.sleep(0.01)
+        spans = collect_spans()
+        self.assertEqual(list(spans), ['filter'])
+        self.assertGreaterEqual(spans['filter'], 0.02)
+        self.assertEqual(collect_spans(), {})
+
+    def test_sampling_profiler(self):
+        """Test that the profiler samples the stack of the thread that created it"""
+        def busy_loop():
+            end = time.perf_counter() + 0.1
+            while time.perf_counter() < end:
+                pass
+
+        profiler = SamplingProfiler(0.002)
+        profiler.start()
+        busy_loop()
+        profiler.stop()
+        self.assertGreater(sum(profiler.stacks.values()), 5)
+        first_line = profiler.collapsed().splitlines()[0]
+        stack, count = first_line.rsplit(' ', 1)
+        self.assertTrue(stack.endswith('test_metrics.py:busy_loop'))
+        self.assertGreater(int(count), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import threading
+from .records import CharacterTable, DictionaryColumn, RecordList
+
+FIELDS = ['name', 'house', 'age', 'death']
+
+CHARACTERS = [
+    {'id': 1, 'name': 'Jon Snow', 'house': 'Stark', 'age': 25, 'death': None},
+    {'id': 2, 'name': 'Cersei Lannister', 'house': 'Lannister', 'age': 42, 'death': 8},
+    {'id': 4, 'name': 'Hodor', 'age': None, 'death': 6},
+    {'id': 5, 'name': 'Arya Stark', 'house': 'Stark', 'age': 18, 'death': None, 'weapon': 'Needle'}
+]
+
+
+class CharacterTableTestCases(unittest.TestCase):
+    def setUp(self):
+        """Creates a table with dictionary-encoded houses, ages and deaths"""
+        self.table = CharacterTable(FIELDS, ['house', 'age', 'death'])
+        for character in CHARACTERS:
+            self.table.add(dict(character))
+
+    def test_round_trip(self):
+        """Test that characters are materialized as they were added"""
+        self.assertEqual(self.table.records(), CHARACTERS)
+        self.assertEqual(self.table.get(4), CHARACTERS[2])
+        self.assertIsNone(self.table.get(3))
+        self.assertEqual(self.table.slice(1, 3), CHARACTERS[1:3])
+        self.assertEqual(self.table.records([5, 1], ['house', 'weapon']),
+                         [{'house': 'Stark', 'weapon': 'Needle'}, {'house': 'Stark', 'weapon': None}])
+
+    def test_values_are_stored_once(self):
+        """Test that a repeated value is kept once in the column's dictionary"""
+        column = self.table._columns['house']
+        self.assertEqual(column.values.count('Stark'), 1)
+        self.assertEqual(column.codes.typecode, 'B')
+
+    def test_update_and_delete(self):
+        """Test updates, values kept outside the columns and deletes"""
+        self.table.set(1, 'house', ['Stark', 'Targaryen'])
+        self.table.set(2, 'age', 43)
+        self.assertEqual(self.table.get(1)['house'], ['Stark', 'Targaryen'])
+        self.assertEqual(self.table.value(2, 'age'), 43)
+
+        self.assertTrue(self.table.delete(2))
+        self.assertFalse(self.table.delete(2))
+        self.assertNotIn(2, self.table)
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.ids(), [1, 4, 5])
+        self.assertEqual(self.table.get(5), CHARACTERS[3])
+
+    def test_last_rows_are_dropped_on_delete(self):
+        """Test that deleting the last rows drops them, so the highest id is read from the end"""
+        self.assertEqual(self.table.last_id(), 5)
+        self.table.delete(2)
+        self.table.delete(4)
+        self.assertEqual(self.table.last_id(), 5)
+        self.table.delete(5)
+        self.assertEqual(self.table.last_id(), 1)
+        self.assertEqual(len(self.table._ids), 1)
+        self.assertEqual(self.table._deleted, set())
+        self.table.add({'id': 2, 'name': 'Sansa Stark', 'house': 'Stark'})
+        self.assertEqual(self.table.records(), [CHARACTERS[0], {'id': 2, 'name': 'Sansa Stark', 'house': 'Stark'}])
+        self.table.delete(1)
+        self.table.delete(2)
+        self.assertEqual((self.table.last_id(), self.table.records()), (0, []))
+
+    def test_unordered_ids(self):
+        """Test that ids added out of order are still found"""
+        self.table.add({'id': 3, 'name': 'Bran Stark'})
+        self.assertEqual(self.table.ids(), [1, 2, 4, 5, 3])
+        self.assertEqual(self.table.get(3), {'id': 3, 'name': 'Bran Stark'})
+        self.assertEqual(self.table.position(3), 4)
+
+    def test_matcher_and_value_counts(self):
+        """Test checks and counts over a dictionary column"""
+        checked = []
+        matches = self.table.matcher('house', lambda value: checked.append(value) or value == 'Stark')
+        self.assertEqual([character_id for character_id in [1, 2, 4, 5] if matches(character_id)], [1, 5])
+        self.assertEqual(checked.count('Stark'), 1)
+        self.assertEqual(self.table.value_counts('house', [1, 2, 4, 5]), {'Stark': 2, 'Lannister': 1, None: 1})
+
+    def test_dictionary_codes_are_widened(self):
+        """Test that the code array grows with the number of distinct values"""
+        column = DictionaryColumn()
+        for value in range(300):
+            column.append(value)
+        self.assertEqual(column.codes.typecode, 'H')
+        self.assertEqual(column.column_values(), list(range(300)))
+
+    def test_record_list(self):
+        """Test the list view used by the repository"""
+        records = RecordList(self.table, threading.RLock())
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[-1], CHARACTERS[3])
+        self.assertEqual(records[1:3], CHARACTERS[1:3])
+        self.assertEqual(list(records), CHARACTERS)
+        self.assertEqual(records.materialize(['id']), [{'id': character['id']} for character in CHARACTERS])
+
+
+if __name__ == '__main__':
+    unittest.main()
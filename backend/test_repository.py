@@ -0,0 +1,361 @@
+import unittest
+import json
+import multiprocessing
+import os
+import tempfile
+from unittest import mock
+from .repository import CharacterRepository, UserRepository
+from .storage import JournaledJsonCharacterStorage, JsonCharacterStorage, JournaledJsonUserStorage, SqliteCharacterStorage, SqliteUserStorage, StorageError, import_json_to_sqlite
+
+
+def write_characters(file_path, characters):
+    """Helper function to write a characters file for testing"""
+    with open(file_path, 'w') as fileobj:
+        json.dump(characters, fileobj)
+
+
+def add_characters(file_path, count):
+    """Helper function adding characters from a separate worker process"""
+    repository = CharacterRepository(file_path)
+    for number in range(count):
+        repository.add({'name': f'Worker {os.getpid()} #{number}'})
+
+
+class RepositoryTestCases(unittest.TestCase):
+    def setUp(self):
+        """Creates a temporary characters file for each test"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'characters.json')
+        write_characters(self.file_path, [
+            {'id': 1, 'name': 'Jon Snow', 'house': 'Stark', 'age': 25},
+            {'id': 2, 'name': 'Cersei Lannister', 'house': 'Lannister', 'age': 42}
+        ])
+        self.repository = CharacterRepository(self.file_path, indexed_fields=['age', 'death', 'house', 'name'])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_all_returns_cached_list(self):
+        """Test that repeated reads reuse the parsed data"""
+        first = self.repository.all()
+        self.assertEqual(len(first), 2)
+        self.assertIs(first, self.repository.all())
+
+    def test_reload_after_external_change(self):
+        """Test that the cache is refreshed when the file changes on disk"""
+        self.repository.all()
+        write_characters(self.file_path, [{'id': 7, 'name': 'Arya Stark', 'house': 'Stark', 'age': 18}])
+        os.utime(self.file_path, ns=(1, 1))
+        self.assertEqual(self.repository.all()[0]['name'], 'Arya Stark')
+
+    def test_add_update_delete_are_persisted(self):
+        """Test that writes go to disk and keep the cache in sync"""
+        character = self.repository.add({'name': 'Bran Stark', 'house': 'Stark', 'age': 10})
+        self.assertEqual(character['id'], 3)
+        self.repository.update(3, {'age': 11})
+        self.assertTrue(self.repository.delete(1))
+        self.assertFalse(self.repository.delete(1))
+
+        on_disk = CharacterRepository(self.file_path)
+        self.assertEqual([char['id'] for char in on_disk.all()], [2, 3])
+        self.assertEqual(on_disk.get(3)['age'], 11)
+        self.assertIsNone(on_disk.get(1))
+
+    def test_ids_are_allocated_from_max_id(self):
+        """Test that new ids follow the highest id, even after deletes"""
+        self.repository.delete(1)
+        self.assertEqual(self.repository.add({'name': 'Sansa Stark'})['id'], 3)
+        self.assertEqual(self.repository.get(3)['name'], 'Sansa Stark')
+        self.assertEqual([char['id'] for char in self.repository.all()], [2, 3])
+
+    def test_deleted_highest_id_is_reused_like_after_reload(self):
+        """Test that the id of a deleted last character is given again, with or without a reload"""
+        self.repository.delete(2)
+        self.assertEqual(self.repository.add({'name': 'Sansa Stark'})['id'], 2)
+
+        self.repository.delete(2)
+        reloaded = CharacterRepository(self.file_path)
+        self.assertEqual(reloaded.add({'name': 'Bran Stark'})['id'], 2)
+        self.assertEqual(self.repository.bulk([('delete', 2), ('add', {'name': 'Arya Stark'})])[1]['id'], 2)
+
+    def test_versioned_all_keeps_its_version(self):
+        """Test that a list returned with a version is not changed by later writes"""
+        characters, version, _ = self.repository.versioned_all()
+        self.repository.update(1, {'age': 26})
+        self.repository.add({'name': 'Bran Stark'})
+        self.repository.delete(2)
+        self.assertEqual([(char['id'], char['age']) for char in characters], [(1, 25), (2, 42)])
+        self.assertEqual(characters.materialize(['id']), [{'id': 1}, {'id': 2}])
+
+        current, new_version, _ = self.repository.versioned_all()
+        self.assertNotEqual(new_version, version)
+        self.assertEqual([char['id'] for char in current], [1, 3])
+        self.assertEqual(self.repository.get(1)['age'], 26)
+
+    def test_write_during_load_is_not_labelled_with_the_old_version(self):
+        """Test that data read while another process writes gets the stamp of what was read"""
+        storage = JsonCharacterStorage(self.file_path)
+        load = storage.load
+
+        def load_during_write():
+            storage.load = load
+            CharacterRepository(self.file_path).add({'name': 'Bran Stark'})
+            return load()
+
+        storage.load = load_during_write
+        repository = CharacterRepository(storage)
+        characters, version, _ = repository.versioned_all()
+        self.assertEqual([char['id'] for char in characters], [1, 2, 3])
+        self.assertEqual(version, CharacterRepository(self.file_path).versioned_all()[1])
+
+    def test_find_with_indexes(self):
+        """Test substring and range filters answered by the attribute indexes"""
+        self.repository.add({'name': 'Arya Stark', 'house': 'Stark', 'age': 18, 'death': 'Alive'})
+        self.assertEqual([char['id'] for char in self.repository.find([('house', 'contains', 'sTa')])], [1, 3])
+        self.assertEqual([char['id'] for char in self.repository.find([('name', 'contains', 'stark'),
+                                                                        ('age', 'range', 20, None)])], [])
+        self.assertEqual([char['id'] for char in self.repository.find([('age', 'range', 18, 25)])], [1, 3])
+        self.assertEqual([char['id'] for char in self.repository.find([('death', 'contains', 'aliv')])], [3])
+
+    def test_find_after_update_and_delete(self):
+        """Test that the attribute indexes follow updates and deletes"""
+        self.repository.update(2, {'house': 'Baratheon', 'age': 20})
+        self.assertEqual(self.repository.find([('house', 'contains', 'lannister')]), [])
+        self.assertEqual([char['id'] for char in self.repository.find([('age', 'range', None, 30)])], [1, 2])
+        self.repository.delete(1)
+        self.assertEqual([char['id'] for char in self.repository.find([('age', 'range', None, 30)])], [2])
+
+    def test_query_sorted_pages_match_full_sort(self):
+        """Test that presorted pages match sorting the whole list"""
+        for age in [30, None, 25, 18, None, 42]:
+            self.repository.add({'name': f'Stark {age}', 'house': 'Stark', 'age': age})
+        characters = list(self.repository.all())
+        for descending in [False, True]:
+            expected = sorted(characters, key=lambda x: (x.get('age') is None, x.get('age')), reverse=descending)
+            total, page = self.repository.query(sort='age', descending=descending, skip=2, limit=3)
+            self.assertEqual(total, 8)
+            self.assertEqual(page, expected[2:5])
+
+            stark = [char for char in expected if 'stark' in char['house'].lower()]
+            total, page = self.repository.query([('house', 'contains', 'stark')], 'age', descending, 1, 4)
+            self.assertEqual(total, len(stark))
+            self.assertEqual(page, stark[1:5])
+
+    def test_stats_follow_writes(self):
+        """Test that the running aggregates match the filtered computation"""
+        self.repository.add({'name': 'Arya Stark', 'house': 'Stark', 'age': 18})
+        self.repository.update(2, {'house': 'Stark', 'age': 44})
+        self.repository.delete(1)
+        total, stats = self.repository.stats(['age', 'house'])
+        self.assertEqual(total, 2)
+        self.assertEqual(stats['house'].groups(), [{'value': 'Stark', 'count': 2}])
+        self.assertEqual(stats['age'].summary(), {
+            'count': 2, 'missing': 0, 'min': 18, 'max': 44, 'mean': 31,
+            'histogram': [{'from': 10, 'to': 19, 'count': 1}, {'from': 40, 'to': 49, 'count': 1}]
+        })
+        filtered = self.repository.stats(['age', 'house'], [('age', 'range', None, 50)])
+        self.assertEqual(filtered[1]['age'].summary(), stats['age'].summary())
+
+    def test_search_ranking_and_updates(self):
+        """Test prefix, fuzzy and ranked search following writes"""
+        repository = CharacterRepository(self.file_path, search_fields={'name': 3, 'house': 1})
+        repository.add({'name': 'Sansa Stark', 'house': 'Stark'})
+        repository.add({'name': 'Starkiller', 'house': 'Lannister'})
+        self.assertEqual([char['id'] for char in repository.search('stark')[1]], [3, 4, 1])
+        self.assertEqual(repository.search('san st'), (1, [repository.get(3)]))
+        self.assertEqual([char['id'] for char in repository.search('cersie')[1]], [2])
+
+        repository.update(3, {'name': 'Sansa Bolton'})
+        self.assertEqual(repository.search('bolton')[0], 1)
+        repository.delete(3)
+        self.assertEqual(repository.search('sansa'), (0, []))
+
+    def test_journaled_storage(self):
+        """Test that journaled writes leave the snapshot alone until compaction"""
+        storage = JournaledJsonCharacterStorage(self.file_path)
+        repository = CharacterRepository(storage)
+        with open(self.file_path) as fileobj:
+            snapshot = fileobj.read()
+        repository.add({'name': 'Bran Stark', 'house': 'Stark', 'age': 10})
+        repository.update(1, {'age': 26})
+        repository.delete(2)
+        with open(self.file_path) as fileobj:
+            self.assertEqual(fileobj.read(), snapshot)
+
+        # A torn last line from a crash is ignored on replay
+        with open(storage.journal_path, 'a') as fileobj:
+            fileobj.write('{"op": "delete", "i')
+        expected = [(1, 26), (3, 10)]
+        replayed = CharacterRepository(JournaledJsonCharacterStorage(self.file_path)).all()
+        self.assertEqual([(char['id'], char['age']) for char in replayed], expected)
+
+        storage.compact()
+        self.assertEqual(os.path.getsize(storage.journal_path), 0)
+        with open(self.file_path) as fileobj:
+            self.assertEqual([(char['id'], char['age']) for char in json.load(fileobj)], expected)
+
+    def test_append_after_torn_line(self):
+        """Test that an append after a torn last line is not lost on replay"""
+        storage = JournaledJsonCharacterStorage(self.file_path)
+        repository = CharacterRepository(storage)
+        repository.add({'name': 'Bran Stark'})
+        with open(storage.journal_path, 'a') as fileobj:
+            fileobj.write('{"op": "put", "character": {"id": 4, "na')
+        self.assertEqual(repository.add({'name': 'Arya Stark'})['id'], 4)
+        repository.update(1, {'age': 26})
+
+        replayed = CharacterRepository(JournaledJsonCharacterStorage(self.file_path))
+        self.assertEqual([char['id'] for char in replayed.all()], [1, 2, 3, 4])
+        self.assertEqual(replayed.get(1)['age'], 26)
+
+    def test_failed_write_is_dropped(self):
+        """Test that a change the journal cannot store raises and is not kept in memory"""
+        repository = CharacterRepository(JournaledJsonCharacterStorage(self.file_path), indexed_fields=['name'])
+        with mock.patch('os.write', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(StorageError):
+                repository.add({'name': 'Bran Stark'})
+            with self.assertRaises(StorageError):
+                repository.delete(2)
+        self.assertEqual([char['id'] for char in repository.all()], [1, 2])
+        self.assertEqual(repository.find([('name', 'contains', 'bran')]), [])
+        self.assertEqual(repository.add({'name': 'Bran Stark'})['id'], 3)
+
+    def test_bulk_is_persisted_in_one_write(self):
+        """Test that bulk operations are applied in order with one journal append"""
+        storage = JournaledJsonCharacterStorage(self.file_path)
+        repository = CharacterRepository(storage)
+        results = repository.bulk([('add', {'name': 'Bran Stark'}), ('update', 1, {'age': 26}),
+                                   ('delete', 2), ('delete', 2), ('update', 2, {'age': 1})])
+        self.assertEqual([results[0]['id'], results[1]['age'], results[2], results[3], results[4]],
+                         [3, 26, True, False, None])
+        self.assertEqual(storage.lock.generation(), 1)
+        replayed = CharacterRepository(JournaledJsonCharacterStorage(self.file_path)).all()
+        self.assertEqual([(char['id'], char.get('age')) for char in replayed], [(1, 26), (3, None)])
+
+    def test_concurrent_writers_in_separate_processes(self):
+        """Test that writers in several processes neither lose updates nor reuse ids"""
+        self.repository.all()
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=add_characters, args=(self.file_path, 25)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        ids = [char['id'] for char in self.repository.all()]
+        self.assertEqual(len(ids), 102)
+        self.assertEqual(sorted(ids), list(range(1, 103)))
+
+
+class UserRepositoryTestCases(unittest.TestCase):
+    def setUp(self):
+        """Creates a temporary users file for each test"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'users.json')
+        write_characters(self.file_path, {'maria': {'password': 'hash', 'role': 'admin'}})
+        self.repository = UserRepository(JournaledJsonUserStorage(self.file_path))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_registration_appends_to_journal(self):
+        """Test that new users are journaled and visible to other repositories"""
+        self.assertEqual(self.repository.get('maria')['role'], 'admin')
+        self.assertTrue(self.repository.add('jane', {'password': 'hash2', 'role': 'user'}))
+        self.assertFalse(self.repository.add('jane', {'password': 'other', 'role': 'user'}))
+        with open(self.file_path) as fileobj:
+            self.assertNotIn('jane', json.load(fileobj))
+
+        other = UserRepository(JournaledJsonUserStorage(self.file_path))
+        self.assertEqual(other.get('jane')['password'], 'hash2')
+
+    def test_registration_after_torn_line(self):
+        """Test that a registration appended after a torn last line is kept"""
+        storage = JournaledJsonUserStorage(self.file_path)
+        with open(storage.journal_path, 'a') as fileobj:
+            fileobj.write('{"op": "put", "username": "ja')
+        self.assertTrue(UserRepository(storage).add('jane', {'password': 'hash2', 'role': 'user'}))
+        self.assertEqual(UserRepository(JournaledJsonUserStorage(self.file_path)).get('jane')['password'], 'hash2')
+
+    def test_replace_password(self):
+        """Test that a password is only replaced if it did not change meanwhile"""
+        self.assertFalse(self.repository.replace_password('maria', 'stale', 'new'))
+        self.assertTrue(self.repository.replace_password('maria', 'hash', 'new'))
+        self.assertEqual(UserRepository(JournaledJsonUserStorage(self.file_path)).get('maria')['password'], 'new')
+
+    def test_journal_is_compacted(self):
+        """Test that the users journal is folded into users.json past its threshold"""
+        storage = JournaledJsonUserStorage(self.file_path, compact_threshold=200)
+        repository = UserRepository(storage)
+        for number in range(5):
+            repository.add(f'user{number}', {'password': 'hash', 'role': 'user'})
+        with open(self.file_path) as fileobj:
+            self.assertGreater(len(json.load(fileobj)), 1)
+        self.assertLess(os.path.getsize(storage.journal_path), 200)
+        self.assertEqual(len(JournaledJsonUserStorage(self.file_path).load()), 6)
+
+
+class SqliteRepositoryTestCases(unittest.TestCase):
+    def setUp(self):
+        """Imports a temporary characters file into a temporary SQLite database"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        characters_path = os.path.join(self.tmp_dir.name, 'characters.json')
+        users_path = os.path.join(self.tmp_dir.name, 'users.json')
+        self.database_path = os.path.join(self.tmp_dir.name, 'thrones.db')
+        write_characters(characters_path, [
+            {'id': 1, 'name': 'Jon Snow', 'house': 'Stark', 'age': 25},
+            {'id': 2, 'name': 'Cersei Lannister', 'house': 'Lannister', 'age': 42}
+        ])
+        write_characters(users_path, {'maria': {'password': 'pass123#', 'role': 'admin'}})
+        import_json_to_sqlite(self.database_path, characters_path, users_path)
+        self.repository = CharacterRepository(SqliteCharacterStorage(self.database_path), indexed_fields=['house'])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_import(self):
+        """Test that the importer copies characters and users"""
+        self.assertEqual([char['name'] for char in self.repository.all()], ['Jon Snow', 'Cersei Lannister'])
+        self.assertEqual(SqliteUserStorage(self.database_path).load()['maria']['role'], 'admin')
+
+    def test_writes_are_persisted_per_row(self):
+        """Test that add/update/delete are visible to a second repository"""
+        other = CharacterRepository(SqliteCharacterStorage(self.database_path))
+        other.all()
+        self.repository.add({'name': 'Arya Stark', 'house': 'Stark', 'age': 18})
+        self.repository.update(1, {'age': 26})
+        self.repository.delete(2)
+        self.assertEqual([(char['id'], char['age']) for char in other.all()], [(1, 26), (3, 18)])
+        self.assertEqual([char['id'] for char in self.repository.find([('house', 'contains', 'stark')])], [1, 3])
+
+    def test_bulk_in_one_transaction(self):
+        """Test that bulk operations are written in a single transaction"""
+        results = self.repository.bulk([('add', {'name': 'Arya Stark', 'house': 'Stark'}), ('delete', 1)])
+        self.assertEqual([results[0]['id'], results[1]], [3, True])
+        other = CharacterRepository(SqliteCharacterStorage(self.database_path))
+        self.assertEqual([char['id'] for char in other.all()], [2, 3])
+
+
+    def test_failed_write_is_dropped(self):
+        """Test that a change the database refuses raises and is not kept in memory"""
+        self.repository.all()
+        connection = self.repository.storage._connect()
+        connection.execute("CREATE TRIGGER refuse BEFORE UPDATE ON characters "
+                           "BEGIN SELECT RAISE(ABORT, 'disk I/O error'); END")
+        connection.commit()
+        with self.assertRaises(StorageError):
+            self.repository.update(1, {'house': 'Targaryen'})
+        self.assertEqual(self.repository.get(1)['house'], 'Stark')
+        self.assertEqual([char['id'] for char in self.repository.find([('house', 'contains', 'targ')])], [])
+
+        users = UserRepository(SqliteUserStorage(self.database_path))
+        connection.execute("CREATE TRIGGER refuse_users BEFORE INSERT ON users "
+                           "BEGIN SELECT RAISE(ABORT, 'disk I/O error'); END")
+        connection.commit()
+        with self.assertRaises(StorageError):
+            users.add('jane', {'password': 'hash', 'role': 'user'})
+        self.assertIsNone(users.get('jane'))
+
+
+if __name__ == '__main__':
+    unittest.main()
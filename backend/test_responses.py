@@ -0,0 +1,60 @@
+import unittest
+import json
+from flask import Flask
+from .responses import BodyCache, FastJSONProvider
+
+
+class FastJSONProviderTestCases(unittest.TestCase):
+    def setUp(self):
+        """Creates an app using the provider"""
+        self.app = Flask(__name__)
+        self.app.json = FastJSONProvider(self.app)
+
+    def test_matches_default_output(self):
+        """Test that the output has sorted keys and round-trips"""
+        data = [{'name': 'Daenerys', 'age': 16, 'house': 'Targaryen'}]
+        text = self.app.json.dumps(data)
+        self.assertEqual(json.loads(text), data)
+        self.assertLess(text.index('"age"'), text.index('"name"'))
+        self.assertEqual(self.app.json.loads(text), data)
+
+    def test_falls_back_for_unsupported_values(self):
+        """Test that values orjson cannot encode use the standard library"""
+        self.assertEqual(self.app.json.dumps({'big': 2 ** 70}), '{"big": 1180591620717411303424}')
+
+
+class BodyCacheTestCases(unittest.TestCase):
+    def test_bodies_are_built_once_per_version(self):
+        """Test that bodies are reused until the version changes"""
+        cache = BodyCache()
+        calls = []
+
+        def serialize():
+            calls.append(1)
+            return b'[]' * 1000
+
+        self.assertEqual(cache.get('v1', 'all', None, serialize), b'[]' * 1000)
+        cache.get('v1', 'all', 'gzip', serialize)
+        cache.get('v1', 'all', 'gzip', serialize)
+        self.assertEqual(len(calls), 1)
+        cache.get('v2', 'all', 'gzip', serialize)
+        self.assertEqual(len(calls), 2)
+
+
+    def test_variants_are_bounded(self):
+        """Test that the least recently used variants are dropped past max_variants"""
+        cache = BodyCache(max_variants=2)
+        calls = []
+
+        def serialize():
+            calls.append(1)
+            return b'[]'
+
+        for variant in ['all', 'all:id', 'all', 'all:name', 'all', 'all:id']:
+            cache.get('v1', variant, None, serialize)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(list(cache._bodies), ['all', 'all:id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import json
+import os
+import struct
+import tempfile
+from .records import CharacterTable
+from .repository import CharacterRepository
+from .snapshot import MAGIC, Snapshot, SnapshotError, encode_snapshot
+from .storage import (JournaledJsonCharacterStorage, JsonCharacterStorage, convert_json_to_snapshot,
+                      convert_snapshot_to_json, read_data)
+
+CHARACTERS = [
+    {'id': 1, 'name': 'Jon Snow', 'house': 'Stark', 'age': 25, 'death': None},
+    {'id': 2, 'name': 'Cersei Lannister', 'house': 'Lannister', 'age': 42, 'death': 8},
+    {'id': 4, 'name': 'Hodor', 'age': None, 'death': 6, 'titles': ['Hold the door']},
+    {'id': 5, 'name': 'Arya Stark', 'house': 'Stark', 'age': 18, 'death': None, 'alive': True}
+]
+
+
+class SnapshotTestCases(unittest.TestCase):
+    def setUp(self):
+        """Creates a temporary directory for the files of each test"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.json_path = os.path.join(self.tmp_dir.name, 'characters.json')
+        self.snapshot_path = os.path.join(self.tmp_dir.name, 'characters.snapshot')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_snapshot(self, characters, source=None):
+        """Helper function to write a snapshot file for testing"""
+        with open(self.snapshot_path, 'wb') as fileobj:
+            fileobj.write(encode_snapshot(characters, source))
+        return Snapshot(self.snapshot_path)
+
+    def test_round_trip(self):
+        """Test that a snapshot gives back the characters it was written from"""
+        snapshot = self.write_snapshot(CHARACTERS, (123, 456))
+        self.assertEqual(snapshot.characters(), CHARACTERS)
+        self.assertEqual(snapshot.ids.tolist(), [1, 2, 4, 5])
+        self.assertEqual(snapshot.source, (123, 456))
+        self.assertTrue(snapshot.ascending)
+        self.assertEqual(snapshot.fields, ['name', 'house', 'age', 'death', 'titles', 'alive'])
+
+        codes, values = snapshot.column('house')
+        self.assertEqual(codes.tolist(), [1, 2, 0, 1])
+        self.assertEqual(values[2], 'Lannister')
+        self.assertEqual(len(values), 3)
+
+    def test_rejects_other_formats(self):
+        """Test that files of another format or version are not read"""
+        with open(self.snapshot_path, 'w') as fileobj:
+            json.dump(CHARACTERS, fileobj)
+        with self.assertRaises(SnapshotError):
+            Snapshot(self.snapshot_path)
+
+        data = bytearray(encode_snapshot(CHARACTERS))
+        struct.pack_into('<I', data, len(MAGIC), 99)
+        with open(self.snapshot_path, 'wb') as fileobj:
+            fileobj.write(data)
+        with self.assertRaises(SnapshotError):
+            Snapshot(self.snapshot_path)
+
+    def test_table_from_snapshot(self):
+        """Test reads from a table over a snapshot and its first changes"""
+        snapshot = self.write_snapshot(CHARACTERS)
+        table = CharacterTable.from_snapshot(snapshot, ['name', 'house', 'role'], ['house', 'age', 'role'])
+        self.assertEqual(table.records(), CHARACTERS)
+        self.assertEqual(table.get(4), CHARACTERS[2])
+        self.assertEqual(table.slice(1, 2, ['name', 'role']), [{'name': 'Cersei Lannister', 'role': None}])
+        self.assertEqual(table.value_counts('house', [1, 2, 5]), {'Stark': 2, 'Lannister': 1})
+
+        table.set(1, 'house', 'Targaryen')
+        table.add({'id': 3, 'name': 'Bran Stark', 'house': 'Stark'})
+        self.assertTrue(table.delete(2))
+        self.assertEqual(table.ids(), [1, 4, 5, 3])
+        self.assertEqual(table.get(1)['house'], 'Targaryen')
+        self.assertEqual(table.get(3), {'id': 3, 'name': 'Bran Stark', 'house': 'Stark'})
+        self.assertEqual(snapshot.characters(), CHARACTERS)
+
+    def test_storage_writes_and_refreshes_the_snapshot(self):
+        """Test that saves write the snapshot and stale snapshots are rewritten"""
+        storage = JsonCharacterStorage(self.json_path, self.snapshot_path)
+        storage.save(CHARACTERS[:2])
+        self.assertEqual(storage.load_snapshot().characters(), CHARACTERS[:2])
+
+        with open(self.json_path, 'w') as fileobj:
+            json.dump(CHARACTERS, fileobj)
+        self.assertEqual(storage.load_snapshot().characters(), CHARACTERS)
+        self.assertIsNone(JsonCharacterStorage(self.json_path).load_snapshot())
+
+    def test_repository_over_snapshot(self):
+        """Test that a repository loaded from a snapshot reads and writes like one loaded from JSON"""
+        with open(self.json_path, 'w') as fileobj:
+            json.dump(CHARACTERS, fileobj)
+        fields = ['name', 'house', 'age']
+        repository = CharacterRepository(JsonCharacterStorage(self.json_path, self.snapshot_path), fields,
+                                         {'name': 2, 'house': 1}, ['house', 'age'])
+        self.assertEqual(list(repository.all()), CHARACTERS)
+        self.assertEqual(repository.query([('house', 'contains', 'stark')], 'age')[1], [CHARACTERS[3], CHARACTERS[0]])
+        self.assertEqual(repository.search('arya')[1], [CHARACTERS[3]])
+
+        character = repository.add({'name': 'Bran Stark', 'house': 'Stark', 'age': 10})
+        self.assertEqual(character['id'], 6)
+        repository.update(1, {'house': 'Targaryen'})
+        self.assertEqual([char['id'] for char in repository.find([('house', 'contains', 'stark')])], [5, 6])
+        self.assertEqual(repository.stats(['house'])[1]['house'].counts, {'Targaryen': 1, 'Lannister': 1,
+                                                                          None: 1, 'Stark': 2})
+
+        reloaded = CharacterRepository(JsonCharacterStorage(self.json_path, self.snapshot_path), fields)
+        self.assertEqual(reloaded.get(6), character)
+        self.assertEqual(read_data(self.json_path), list(reloaded.all()))
+
+    def test_journal_is_not_hidden_by_snapshot(self):
+        """Test that the journaled storage only uses the snapshot without pending journal entries"""
+        storage = JournaledJsonCharacterStorage(self.json_path, snapshot_path=self.snapshot_path)
+        storage.save(CHARACTERS)
+        storage.insert({'id': 6, 'name': 'Bran Stark'}, None)
+        self.assertIsNone(storage.load_snapshot())
+        storage.compact()
+        self.assertEqual(storage.load_snapshot().characters()[-1], {'id': 6, 'name': 'Bran Stark'})
+
+    def test_conversions(self):
+        """Test the conversion between the JSON and snapshot formats"""
+        with open(self.json_path, 'w') as fileobj:
+            json.dump(CHARACTERS, fileobj)
+        convert_json_to_snapshot(self.json_path, self.snapshot_path)
+        os.remove(self.json_path)
+        convert_snapshot_to_json(self.snapshot_path, self.json_path)
+        self.assertEqual(read_data(self.json_path), CHARACTERS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,88 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask import Flask, render_template, jsonify, url_for, request
+import os
 import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
+# Upstream URLs, configurable so that local stubs can replace them
+# Backend API (e.g. 'http://localhost:5000/api' when running locally)
+BACKEND_API_URL = os.getenv('BACKEND_API_URL', 'https://thronesapi-backend.onrender.com/api')
 # ThronesAPI URL for character information
-THRONES_API_URL = 'https://thronesapi.com/api/v2/Characters'
+THRONES_API_URL = os.getenv('THRONES_API_URL', 'https://thronesapi.com/api/v2/Characters')
+
+# (connect, read) timeouts in seconds for the upstream requests
+UPSTREAM_TIMEOUT = (3.05, float(os.getenv('UPSTREAM_TIMEOUT', 10)))
+# Seconds during which the ThronesAPI images are served from memory without refreshing
+IMAGES_CACHE_TTL = float(os.getenv('IMAGES_CACHE_TTL', 3600))
+
+# Shared session, so connections to the upstreams are kept alive and reused
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Runs the upstream requests concurrently
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='upstream')
+
+
+def fetch_images():
+    """Fetches the ThronesAPI characters and returns a dictionary mapping
+    their full name to their image URL."""
+    response = session.get(THRONES_API_URL, timeout=UPSTREAM_TIMEOUT)
+    response.raise_for_status()  # Raises an error if the request fails
+    return {char['fullName']: char['imageUrl'] for char in response.json()}
+
+
+class ImagesCache:
+    """Keeps the ThronesAPI name -> imageUrl dictionary in memory, since that
+    catalogue almost never changes. Within the TTL the cached dictionary is
+    returned as is. Once it is older, it is still returned (stale) while a
+    single background refresh replaces it. Only the very first request has to
+    wait for ThronesAPI."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._images = None
+        self._fetched_at = 0
+        self._refreshing = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """Starts a refresh unless one is already running, and returns its future."""
+        with self._lock:
+            if self._refreshing is None:
+                self._refreshing = executor.submit(self._fetch)
+            return self._refreshing
+
+    def _fetch(self):
+        try:
+            images = fetch_images()
+            with self._lock:
+                self._images, self._fetched_at = images, time.monotonic()
+            return images
+        except requests.exceptions.RequestException as e:
+            print(f"Error: Unable to refresh the ThronesAPI images: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._refreshing = None
+
+    def get(self):
+        """Returns a future resolving to the images dictionary."""
+        images = self._images
+        if images is None:
+            return self._refresh()
+        if time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh()
+        future = Future()
+        future.set_result(images)
+        return future
+
+
+images_cache = ImagesCache(IMAGES_CACHE_TTL)
 
 
 @app.route('/', methods=['GET'])
@@ -41,23 +119,21 @@ def get_characters_pictures():
             'Authorization': token  # Pass token in the backend API request
         }
 
-        # Fetch characters from local backend (characters.json)
+        # Fetch characters from the backend and the images from the external ThronesAPI
+        # concurrently; the images usually come from images_cache without any request
+        images_future = images_cache.get()
         # local_characters = read_data(os.path.join('..', 'backend', 'characters.json'))  -> works with localhost
-        res = requests.get('https://thronesapi-backend.onrender.com/api/all_characters', headers=headers)
+        # Only the names are needed, so the backend sends just that field
+        res = session.get(f'{BACKEND_API_URL}/all_characters', params={'fields': 'name'}, headers=headers,
+                          timeout=UPSTREAM_TIMEOUT)
         # print(f"Character API Response Status: {res.status_code}")
         if res.status_code != 200:
             return jsonify({'message': 'Failed to fetch characters from backend.'}), res.status_code
 
         local_characters = res.json()
 
-        # Fetch character images from external ThronesAPI
-        response = requests.get(THRONES_API_URL)
-        # print(f"ThronesAPI Response Status: {response.status_code}")
-        response.raise_for_status()  # Raises an error if the request fails
-        external_characters = response.json()
-
-        # Create a dictionary of external characters for quick lookup by name
-        external_characters_dict = {char['fullName']: char['imageUrl'] for char in external_characters}
+        # Dictionary of external characters for quick lookup by name
+        external_characters_dict = images_future.result()
 
         # Define a default image URL for characters without an external image
         default_image_url = url_for('static', filename='GoT.jpg')
@@ -80,6 +156,47 @@ def get_characters_pictures():
         return jsonify({"error": str(e)}), 500
 
 
+# API route returning the characters together with their pictures in a single response
+@app.route('/api/characters/enriched', methods=['GET'])
+def get_characters_enriched():
+    """API route returning the characters of the backend's /api/characters
+    endpoint, each with its 'imageUrl' added. The query parameters (filters,
+    sorting, limit/skip or cursor pagination) are passed on to the backend,
+    so the characters page can load the grid one page at a time in a single
+    request per page."""
+    try:
+        token = request.headers.get('Authorization')
+
+        if not token:
+            return jsonify({'message': 'Token is missing!'}), 401
+
+        images_future = images_cache.get()
+        res = session.get(f'{BACKEND_API_URL}/characters', params=request.args,
+                          headers={'Authorization': token}, timeout=UPSTREAM_TIMEOUT)
+        if res.status_code != 200:
+            # Passes the backend's error (e.g. an invalid filter) on to the client
+            return res.content, res.status_code, {'Content-Type': res.headers.get('Content-Type',
+                                                                                   'application/json')}
+
+        data = res.json()
+        images = images_future.result()
+        default_image_url = url_for('static', filename='GoT.jpg')
+
+        def with_image(character):
+            return dict(character, imageUrl=images.get(character.get('name'), default_image_url))
+
+        # Cursor pagination returns an object with the page under 'characters'
+        if isinstance(data, dict):
+            data['characters'] = [with_image(character) for character in data['characters']]
+        else:
+            data = [with_image(character) for character in data]
+
+        return jsonify(data), 200
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/add_character_view', methods=['GET', 'POST'])
 def add_character_view():
     return render_template('add_character_view.html')
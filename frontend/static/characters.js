@@ -29,176 +29,260 @@ document.addEventListener('DOMContentLoaded', () => {
         return response;  // Return the response if it’s not unauthorized
     };
 
-    // Fetch character pictures from the /api/characters/pictures endpoint
-    const fetchCharacterPictures = fetch('https://thronesapi-frontend.onrender.com/api/characters/pictures', { headers })
-    .then(handleUnauthorized)  // Handle expired/invalid token
-    .then(response => {
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
+    // Creates the card of a character (details and picture)
+    const renderCharacter = (character) => {
+        const characterCard = document.createElement('div');
+        characterCard.classList.add('character-card');
+        characterCard.dataset.id = character.id;
+
+        // Create and set image
+        const img = document.createElement('img');
+        img.src = character.imageUrl || 'static/default.jpg';
+        img.alt = `${character.name}'s Image`;
+        img.classList.add('character-image');
+
+        // Create and set name
+        const name = document.createElement('p');
+        name.innerHTML = `<b>Name:</b> <span>${character.name}</span>`;
+
+        // Character details (age, role, house, etc.) come with the picture, fallback to 'Unknown' if not available
+        const details = character;
+
+        // Create and set age
+        const ageElement = document.createElement('p');
+        ageElement.innerHTML = `<b>Age:</b> ${details.age || 'Unknown'}`;
+
+        // Create and set role
+        const roleElement = document.createElement('p');
+        roleElement.innerHTML = `<b>Role:</b> ${details.role || 'Unknown'}`;
+
+        // Create and set house
+        const houseElement = document.createElement('p');
+        houseElement.innerHTML = `<b>House:</b> ${details.house || 'Unknown'}`;
+
+        // Create edit button form
+        const editForm = document.createElement('form');
+        editForm.classList.add('edit-form');
+
+        const editButton = document.createElement('button');
+        editButton.classList.add('btn', 'btn-primary');
+        editButton.innerHTML = `<i class="fa fa-pencil" aria-hidden="true"></i>`;
+
+        editButton.onclick = () => {
+            const newName = prompt('Enter new name:', character.name);
+            const newAge = prompt('Enter new age:', details.age);
+            const newRole = prompt('Enter new role:', details.role);
+            const newHouse = prompt('Enter new house:', details.house);
+
+            const updatedCharacter = {
+                name: newName || character.name,
+                age: parseInt(newAge) || details.age,
+                role: newRole || details.role,
+                house: newHouse || details.house
+            };
+
+            fetch(`https://thronesapi-backend.onrender.com/api/characters/${details.id}`, {
+                method: 'PUT',
+                headers: headers,
+                body: JSON.stringify(updatedCharacter)
+            })
+                .then(handleUnauthorized)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Failed to update character. Status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    alert(data.message);
+                    name.innerHTML = `<b>Name:</b> <span>${updatedCharacter.name}</span>`;
+                    ageElement.innerHTML = `<b>Age:</b> ${updatedCharacter.age}`;
+                    roleElement.innerHTML = `<b>Role:</b> ${updatedCharacter.role}`;
+                    houseElement.innerHTML = `<b>House:</b> ${updatedCharacter.house}`;
+                })
+                .catch(error => {
+                    console.error('Error updating character:', error);
+                    alert('Failed to update character. Please try again.');
+                });
+        };
+
+        // Create delete button form
+        const deleteForm = document.createElement('form');
+        deleteForm.setAttribute('action', `https://thronesapi-backend.onrender.com/api/characters/${details.id}`);
+        deleteForm.setAttribute('method', 'DELETE');
+        deleteForm.classList.add('delete-form');
+
+        const deleteButton = document.createElement('button');
+        deleteButton.classList.add('btn', 'btn-danger');
+        deleteButton.innerHTML = `<i class="fa fa-trash" aria-hidden="true"></i>`;
+
+        deleteButton.onclick = (event) => {
+            event.preventDefault();  // Prevent default form submission
+            const confirmed = confirm('Are you sure you want to delete this character?');
+            if (confirmed) {
+                fetch(deleteForm.action, {
+                    method: 'DELETE',
+                    headers: headers  // Pass token in headers
+                })
+                .then(handleUnauthorized)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Failed to delete character. Status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    alert(data.message);  // Show success message
+                    characterCard.remove();  // Remove card from grid
+                })
+                .catch(error => {
+                    console.error('Error deleting character:', error);
+                    alert('Failed to delete character. Please try again.');
+                });
+            }
+        };
+
+        // Create a button group container for edit and delete buttons
+        const buttonGroup = document.createElement('div');
+        buttonGroup.classList.add('button-group');
+
+        // Append delete and edit button to the group
+        buttonGroup.appendChild(editButton);
+        buttonGroup.appendChild(deleteButton);
+
+        // Append the elements to the card
+        characterCard.appendChild(img);
+        characterCard.appendChild(name);
+        characterCard.appendChild(ageElement);
+        characterCard.appendChild(roleElement);
+        characterCard.appendChild(houseElement);
+        characterCard.appendChild(buttonGroup);
+
+        return characterCard;
+    };
+
+    // Cursor of the next page of characters, null once every page is loaded
+    let nextCursor = '';
+    let loading = false;
+    // Incremented when the grid is loaded again, so pages requested before are dropped
+    let generation = 0;
+    // Changes received while a page loads, applied again once it is in the grid
+    let pendingChanges = [];
+
+    // Element below the grid; the next page is loaded when it scrolls into view
+    const sentinel = document.createElement('div');
+    charactersGrid.after(sentinel);
+
+    // Fetch one page of characters with their pictures from the /api/characters/enriched endpoint
+    const loadNextPage = () => {
+        if (loading || nextCursor === null) {
+            return;
         }
-        return response.json();
-    });
+        loading = true;
+        const pageGeneration = generation;
+        fetch(`https://thronesapi-frontend.onrender.com/api/characters/enriched?limit=24&cursor=${encodeURIComponent(nextCursor)}`, { headers })
+        .then(handleUnauthorized)  // Handle expired/invalid token
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (pageGeneration !== generation) {
+                return;
+            }
+            data.characters.forEach(character => charactersGrid.appendChild(renderCharacter(character)));
+            nextCursor = data.next_cursor;
+            loading = false;
+            // The page may predate these changes, and additions are only shown after the last page
+            pendingChanges.splice(0).forEach(applyChange);
+            // Keeps loading while the end of the grid is still visible
+            if (sentinel.getBoundingClientRect().top < window.innerHeight) {
+                loadNextPage();
+            }
+        })
+        .catch(error => {
+            console.error('Error fetching characters:', error);
+            if (pageGeneration !== generation) {
+                return;
+            }
+            // The same page is requested again the next time the end of the grid scrolls into view
+            loading = false;
+            if (!charactersGrid.hasChildNodes()) {
+                charactersGrid.textContent = 'Error loading characters. Please try again later.';
+            }
+        });
+    };
 
-    // Fetch character details (age, animal, etc.) from the /api/all_characters - backend endpoint
-    const fetchCharacterDetails = fetch('https://thronesapi-backend.onrender.com/api/all_characters', {
-        headers: headers  // Include the token in the request headers
-    })
-    .then(handleUnauthorized)  // Handle expired/invalid token
-    .then(response => {
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
+    // Not observing yet: the observer loads the first page as soon as it observes the sentinel
+    const observer = new IntersectionObserver(entries => {
+        if (entries[0].isIntersecting) {
+            loadNextPage();
         }
-        return response.json();
     });
 
-    // Combine the data from both APIs
-    Promise.all([fetchCharacterPictures, fetchCharacterDetails])
-        .then(([picturesData, detailsData]) => {
-            // Create a dictionary from the character details for quick lookup by name
-            const detailsDict = detailsData.reduce((acc, character) => {
-                acc[character.name] = {
-                    id: character.id,  // Include character ID for deletion
-                    age: character.age,
-                    role: character.role,
-                    house: character.house
-                };
-                return acc;
-            }, {});
-
-            // For each character in the pictures data, create an element to display their details
-            picturesData.forEach(character => {
-                const characterCard = document.createElement('div');
-                characterCard.classList.add('character-card');
-
-                // Create and set image
-                const img = document.createElement('img');
-                img.src = character.imageUrl || 'static/default.jpg';
-                img.alt = `${character.name}'s Image`;
-                img.classList.add('character-image');
-
-                // Create and set name
-                const name = document.createElement('p');
-                name.innerHTML = `<b>Name:</b> <span>${character.name}</span>`;
-
-                // Get character details (age, role, house, etc.) from the dictionary, fallback to 'Unknown' or 'None' if not available
-                const details = detailsDict[character.name] || {};
-
-                // Create and set age
-                const ageElement = document.createElement('p');
-                ageElement.innerHTML = `<b>Age:</b> ${details.age || 'Unknown'}`;
-
-                // Create and set role
-                const roleElement = document.createElement('p');
-                roleElement.innerHTML = `<b>Role:</b> ${details.role || 'Unknown'}`;
-
-                // Create and set house
-                const houseElement = document.createElement('p');
-                houseElement.innerHTML = `<b>House:</b> ${details.house || 'Unknown'}`;
-
-                // Create edit button form
-                const editForm = document.createElement('form');
-                editForm.classList.add('edit-form');
-
-                const editButton = document.createElement('button');
-                editButton.classList.add('btn', 'btn-primary');
-                editButton.innerHTML = `<i class="fa fa-pencil" aria-hidden="true"></i>`;
-
-                editButton.onclick = () => {
-                    const newName = prompt('Enter new name:', character.name);
-                    const newAge = prompt('Enter new age:', details.age);
-                    const newRole = prompt('Enter new role:', details.role);
-                    const newHouse = prompt('Enter new house:', details.house);
-
-                    const updatedCharacter = {
-                        name: newName || character.name,
-                        age: parseInt(newAge) || details.age,
-                        role: newRole || details.role,
-                        house: newHouse || details.house
-                    };
-
-                    fetch(`https://thronesapi-backend.onrender.com/api/characters/${details.id}`, {
-                        method: 'PUT',
-                        headers: headers,
-                        body: JSON.stringify(updatedCharacter)
-                    })
-                        .then(handleUnauthorized)
-                        .then(response => {
-                            if (!response.ok) {
-                                throw new Error(`Failed to update character. Status: ${response.status}`);
-                            }
-                            return response.json();
-                        })
-                        .then(data => {
-                            alert(data.message);
-                            name.innerHTML = `<b>Name:</b> <span>${updatedCharacter.name}</span>`;
-                            ageElement.innerHTML = `<b>Age:</b> ${updatedCharacter.age}`;
-                            roleElement.innerHTML = `<b>Role:</b> ${updatedCharacter.role}`;
-                            houseElement.innerHTML = `<b>House:</b> ${updatedCharacter.house}`;
-                        })
-                        .catch(error => {
-                            console.error('Error updating character:', error);
-                            alert('Failed to update character. Please try again.');
-                        });
-                };
-
-                // Create delete button form
-                const deleteForm = document.createElement('form');
-                deleteForm.setAttribute('action', `https://thronesapi-backend.onrender.com/api/characters/${details.id}`);
-                deleteForm.setAttribute('method', 'DELETE');
-                deleteForm.classList.add('delete-form');
-
-                const deleteButton = document.createElement('button');
-                deleteButton.classList.add('btn', 'btn-danger');
-                deleteButton.innerHTML = `<i class="fa fa-trash" aria-hidden="true"></i>`;
-
-                deleteButton.onclick = (event) => {
-                    event.preventDefault();  // Prevent default form submission
-                    const confirmed = confirm('Are you sure you want to delete this character?');
-                    if (confirmed) {
-                        fetch(deleteForm.action, {
-                            method: 'DELETE',
-                            headers: headers  // Pass token in headers
-                        })
-                        .then(handleUnauthorized)
-                        .then(response => {
-                            if (!response.ok) {
-                                throw new Error(`Failed to delete character. Status: ${response.status}`);
-                            }
-                            return response.json();
-                        })
-                        .then(data => {
-                            alert(data.message);  // Show success message
-                            characterCard.remove();  // Remove card from grid
-                        })
-                        .catch(error => {
-                            console.error('Error deleting character:', error);
-                            alert('Failed to delete character. Please try again.');
-                        });
-                    }
-                };
-
-                // Create a button group container for edit and delete buttons
-                const buttonGroup = document.createElement('div');
-                buttonGroup.classList.add('button-group');
-
-                // Append delete and edit button to the group
-                buttonGroup.appendChild(editButton);
-                buttonGroup.appendChild(deleteButton);
-
-                // Append the elements to the card
-                characterCard.appendChild(img);
-                characterCard.appendChild(name);
-                characterCard.appendChild(ageElement);
-                characterCard.appendChild(roleElement);
-                characterCard.appendChild(houseElement);
-                characterCard.appendChild(buttonGroup);
-
-                // Append the character card to the grid
-                charactersGrid.appendChild(characterCard);
-            });
+    // Applies a change of the backend's change feed to the cards already in the grid
+    const applyChange = (change) => {
+        if (loading) {
+            pendingChanges.push(change);
+        }
+        const card = charactersGrid.querySelector(`[data-id="${change.id}"]`);
+        if (change.op === 'delete') {
+            if (card) {
+                card.remove();
+            }
+        } else if (!change.character) {
+            // Characters too large for the feed are sent without their details
+            return;
+        } else if (card) {
+            // Keeps the picture of the card, which the feed does not have
+            card.replaceWith(renderCharacter({...change.character, imageUrl: card.querySelector('img').src}));
+        } else if (change.op === 'add' && nextCursor === null) {
+            // New characters go last, so they are only shown once the last page is loaded
+            charactersGrid.appendChild(renderCharacter(change.character));
+        }
+    };
+
+    // Long-polls the change feed, so the grid follows the changes made by other users without reloading
+    const followChanges = (since) => {
+        fetch(`https://thronesapi-backend.onrender.com/api/characters/changes?since=${since}&timeout=25`, { headers })
+        .then(handleUnauthorized)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.resync) {
+                // Too many changes were missed, the grid is loaded again
+                generation += 1;
+                pendingChanges = [];
+                charactersGrid.replaceChildren();
+                nextCursor = '';
+                loading = false;
+                loadNextPage();
+            } else {
+                data.changes.forEach(applyChange);
+            }
+            followChanges(data.last_seq);
         })
         .catch(error => {
-            console.error('Error fetching characters:', error);
-            charactersGrid.textContent = 'Error loading characters. Please try again later.';
+            console.error('Error following changes:', error);
+            setTimeout(() => followChanges(since), 5000);
         });
+    };
+
+    // The current position in the feed is read before the first page is requested, so no change is missed
+    fetch('https://thronesapi-backend.onrender.com/api/characters/changes', { headers })
+    .then(handleUnauthorized)
+    .then(response => response.ok ? response.json() : null)
+    .then(data => {
+        if (data) {
+            followChanges(data.last_seq);
+        }
+    })
+    .catch(error => console.error('Error following changes:', error))
+    .finally(() => observer.observe(sentinel));
 });
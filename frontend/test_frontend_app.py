@@ -0,0 +1,198 @@
+import unittest
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from . import frontend_app
+from .frontend_app import ImagesCache, app
+
+THRONES_CHARACTERS = [
+    {'fullName': 'Jon Snow', 'imageUrl': 'https://thronesapi.com/assets/images/jon-snow.jpg'},
+    {'fullName': 'Arya Stark', 'imageUrl': 'https://thronesapi.com/assets/images/arya-stark.jpg'}
+]
+
+BACKEND_CHARACTERS = [{'id': 1, 'name': 'Jon Snow'}, {'id': 2, 'name': 'Hot Pie'}]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves the ThronesAPI and backend endpoints used by the frontend from
+    the settings of the stub server, counting the requests per path."""
+
+    def do_GET(self):
+        stub = self.server.stub
+        path = self.path.split('?')[0]
+        with stub.lock:
+            stub.hits[path] = stub.hits.get(path, 0) + 1
+        status, body = stub.routes.get(path, (404, {'message': 'Not found'}))
+        time.sleep(stub.delays.get(path, 0))
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client timed out
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer:
+    """Local HTTP server standing in for the upstreams of the frontend."""
+
+    def __init__(self):
+        self.routes = {
+            '/api/v2/Characters': (200, THRONES_CHARACTERS),
+            '/api/all_characters': (200, [{'name': character['name']} for character in BACKEND_CHARACTERS]),
+            '/api/characters': (200, BACKEND_CHARACTERS)
+        }
+        self.delays = {}
+        self.hits = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.stub = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FrontendAppTestCases(unittest.TestCase):
+    def setUp(self):
+        """Points the frontend at a local stub of its upstreams, with an empty images cache"""
+        self.stub = StubServer()
+        self.images_cache = ImagesCache(3600)
+        patches = [
+            mock.patch.object(frontend_app, 'BACKEND_API_URL', f"{self.stub.url}/api"),
+            mock.patch.object(frontend_app, 'THRONES_API_URL', f"{self.stub.url}/api/v2/Characters"),
+            mock.patch.object(frontend_app, 'UPSTREAM_TIMEOUT', (1, 1)),
+            mock.patch.object(frontend_app, 'images_cache', self.images_cache)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.app = app.test_client()
+        self.headers = {'Authorization': 'Bearer token'}
+
+    def tearDown(self):
+        self.stub.close()
+
+    def get_pictures(self):
+        """Helper function requesting the pictures endpoint"""
+        return self.app.get('/api/characters/pictures', headers=self.headers)
+
+    def wait_for_refresh(self):
+        """Helper function waiting for the background refresh of the images cache"""
+        refreshing = self.images_cache._refreshing
+        if refreshing is not None:
+            try:
+                refreshing.result(timeout=5)
+            except Exception:
+                pass
+        time.sleep(0.05)  # The refresh clears its future right after setting its result
+
+    def test_pictures_are_combined(self):
+        """Test that the backend characters get their ThronesAPI image, or the default one"""
+        response = self.get_pictures()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), [
+            {'name': 'Jon Snow', 'imageUrl': 'https://thronesapi.com/assets/images/jon-snow.jpg'},
+            {'name': 'Hot Pie', 'imageUrl': '/static/GoT.jpg'}
+        ])
+        self.assertEqual(self.app.get('/api/characters/pictures').status_code, 401)
+
+    def test_fresh_images_are_served_from_memory(self):
+        """Test that within the TTL the images are fetched from ThronesAPI only once"""
+        for _ in range(3):
+            self.assertEqual(self.get_pictures().status_code, 200)
+        self.assertEqual(self.app.get('/api/characters/enriched?limit=2', headers=self.headers).status_code, 200)
+        self.assertEqual(self.stub.hits['/api/v2/Characters'], 1)
+        self.assertEqual(self.stub.hits['/api/all_characters'], 3)
+
+    def test_stale_images_are_served_while_refreshing(self):
+        """Test that expired images are returned at once while a single background refresh runs"""
+        self.get_pictures()
+        self.images_cache.ttl = 0
+        self.stub.routes['/api/v2/Characters'] = (200, [{'fullName': 'Jon Snow', 'imageUrl': 'new.jpg'}])
+        self.stub.delays['/api/v2/Characters'] = 0.3
+
+        start = time.monotonic()
+        for _ in range(3):
+            self.assertEqual(self.get_pictures().get_json()[0]['imageUrl'],
+                             'https://thronesapi.com/assets/images/jon-snow.jpg')
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.wait_for_refresh()
+        self.assertEqual(self.stub.hits['/api/v2/Characters'], 2)
+
+        self.images_cache.ttl = 3600
+        self.assertEqual(self.get_pictures().get_json()[0]['imageUrl'], 'new.jpg')
+
+    def test_cold_fetch_is_shared_and_concurrent(self):
+        """Test that a cold cache fetches the images once, concurrently with the backend request"""
+        self.stub.delays = {'/api/v2/Characters': 0.4, '/api/all_characters': 0.4}
+        futures = [self.images_cache.get() for _ in range(3)]
+        self.assertTrue(all(future is futures[0] for future in futures))
+        futures[0].result(timeout=5)
+        self.assertEqual(self.stub.hits['/api/v2/Characters'], 1)
+
+        self.images_cache = ImagesCache(3600)
+        with mock.patch.object(frontend_app, 'images_cache', self.images_cache):
+            start = time.monotonic()
+            self.assertEqual(self.get_pictures().status_code, 200)
+            self.assertLess(time.monotonic() - start, 0.75)
+        self.assertEqual(self.stub.hits['/api/v2/Characters'], 2)
+
+    def test_upstream_errors(self):
+        """Test the responses when the backend or ThronesAPI fail"""
+        self.stub.routes['/api/all_characters'] = (401, {'message': 'Token is invalid!'})
+        self.stub.routes['/api/characters'] = (400, {'error': 'Invalid limit parameter. Must be an integer.'})
+        self.assertEqual(self.get_pictures().status_code, 401)
+        response = self.app.get('/api/characters/enriched?limit=x', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'error': 'Invalid limit parameter. Must be an integer.'})
+
+        self.stub.routes['/api/all_characters'] = (200, [{'name': 'Jon Snow'}])
+        self.stub.routes['/api/v2/Characters'] = (500, {'message': 'Internal Server Error'})
+        self.images_cache = ImagesCache(3600)
+        with mock.patch.object(frontend_app, 'images_cache', self.images_cache):
+            response = self.get_pictures()
+            self.assertEqual(response.status_code, 500)
+            self.assertIn('error', response.get_json())
+            self.wait_for_refresh()
+            # A failed fetch is not cached, the next request tries again
+            self.stub.routes['/api/v2/Characters'] = (200, THRONES_CHARACTERS)
+            self.assertEqual(self.get_pictures().status_code, 200)
+
+    def test_failed_refresh_keeps_stale_images(self):
+        """Test that stale images are still served when their refresh fails"""
+        self.get_pictures()
+        self.images_cache.ttl = 0
+        self.stub.routes['/api/v2/Characters'] = (500, {'message': 'Internal Server Error'})
+        self.assertEqual(self.get_pictures().status_code, 200)
+        self.wait_for_refresh()
+        self.assertEqual(self.get_pictures().get_json()[0]['imageUrl'],
+                         'https://thronesapi.com/assets/images/jon-snow.jpg')
+
+    def test_upstream_timeouts(self):
+        """Test that slow upstreams make the request fail after the read timeout"""
+        with mock.patch.object(frontend_app, 'UPSTREAM_TIMEOUT', (1, 0.2)):
+            self.stub.delays['/api/all_characters'] = 1
+            start = time.monotonic()
+            self.assertEqual(self.get_pictures().status_code, 500)
+            self.assertLess(time.monotonic() - start, 0.9)
+
+            self.stub.delays = {'/api/v2/Characters': 1}
+            self.images_cache = ImagesCache(3600)
+            with mock.patch.object(frontend_app, 'images_cache', self.images_cache):
+                self.assertEqual(self.get_pictures().status_code, 500)
+                self.assertEqual(self.app.get('/api/characters/enriched', headers=self.headers).status_code, 500)
+
+
+if __name__ == '__main__':
+    unittest.main()